@@ -1,35 +1,100 @@
 import streamlit as st
-import pandas as pd
 import os
 import json
+import sys
 import io
-import requests 
 import re 
 import time 
+import gzip
+import hashlib
+import hmac
+import math
+import zlib
+import threading
+import sqlite3
+import queue
+import collections
+import random
+import concurrent.futures
+import uuid
+import tempfile
+import shutil
+import importlib
+import logging
+import unicodedata
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 # Eliminamos la dependencia directa de FPDF ya que cambiaremos a TXT
 # from fpdf import FPDF 
 
-# Límite de caracteres para los documentos grandes en el RAG (para no exceder el límite de tokens)
-RAG_CHUNK_SIZE = 16000 
+# Recuperación indexada (BM25): tamaño de los fragmentos y cuántos se inyectan por consulta
+RAG_CHUNK_MAX_CHARS = 1500
+RAG_TOP_K = 10
+RAG_PER_DOC_MIN = 1 # Garantiza al menos un fragmento de cada documento relevante
 
-try:
-    from unidecode import unidecode 
-except ImportError:
+# Documentos personalizados: se procesan en segundo plano, una vez por contenido, y se indexan por sesión
+RAG_CUSTOM_TOP_K = 4
+CUSTOM_DOC_MIN_CHARS = 50
+CUSTOM_DOC_INGEST_WORKERS = 2
+CUSTOM_DOC_CACHE_MAX = 32
+CUSTOM_DOC_POLL_SECONDS = 1.0
+
+# Efecto de tecleo opcional al pintar respuestas (desactivado: el streaming real ya muestra el avance)
+TYPING_EFFECT_ENABLED = False
+TYPING_EFFECT_MAX_SECONDS = 3.0
+
+class LazyModule:
+    """
+    Importa el módulo en el primer acceso a uno de sus atributos. Las librerías pesadas (pandas, pypdf, requests,
+    numpy) no se cargan al arrancar el proceso, sino en la primera ruta de código que las usa: la pantalla de
+    login no paga su costo.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def module_available(name):
+    """¿Está instalado el módulo? (sin importarlo)."""
+    return importlib.util.find_spec(name) is not None
+
+
+pd = LazyModule("pandas")
+requests = LazyModule("requests")
+
+if module_available("unidecode"):
+    def unidecode(text):
+        from unidecode import unidecode as _unidecode # Importación diferida (ya en caché tras la primera llamada)
+        return _unidecode(text)
+else:
     def unidecode(text):
         return text
     st.warning("Advertencia: La librería 'unidecode' no está disponible. La búsqueda de actividades por área podría ser menos precisa.")
     
-# Importar librerías críticas para RAG.
-try:
-    import pypdf # Librería para leer PDFs
-except ImportError:
-    pypdf = None
+# Importar librerías críticas para RAG (diferidas; None si no están instaladas).
+pypdf = LazyModule("pypdf") if module_available("pypdf") else None # Librería para leer PDFs
+
+logger = logging.getLogger(__name__)
+
+# NumPy para el índice semántico (si falta, la recuperación usa sólo BM25)
+np = LazyModule("numpy") if module_available("numpy") else None
 
 # --- CONFIGURACIÓN GENERAL ---
 st.set_page_config(page_title="Asesor Progob PBR/MML Veracruz", layout="wide")
 
 # Nombres de archivo y directorios
 USERS_FILE_NAME = "users.xlsx" 
+USERS_FILE_CANDIDATES = [USERS_FILE_NAME, "users.csv", "usuarios.xlsx", "usuarios.csv"]
+# Contraseñas: PBKDF2-SHA256 con sal por usuario ("pbkdf2_sha256$iteraciones$sal$hash")
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
+PASSWORD_HASH_ITERATIONS = 200000
 DOCS_DIR = "docs"
 ACTIVIDADES_FILE = os.path.join(DOCS_DIR, "Actividades por area.csv") 
 REGLAMENTO_FILE = os.path.join(DOCS_DIR, "REGLAMENTO-INTERIOR-DE-LA-ADMINISTRACION-PUBLICA-DEL-MUNICIPIO-DE-VERACRUZ.pdf") 
@@ -39,14 +104,93 @@ GUIDE_FILE = os.path.join(DOCS_DIR, "Modulo7_PbR (IA).pdf")
 GDM_FILE = os.path.join(DOCS_DIR, "Cuaderno de trabajo GDM 2025-2027.pdf")
 ODS_FILE = os.path.join(DOCS_DIR, "Indicadores por Objetivo y Meta de los Objetivos de Desarrollo Sostenible.pdf")
 MANUAL_INDICADORES_FILE = os.path.join(DOCS_DIR, "Manual_de_indicadores_para_municipios 20250415.pdf")
+GUIA_TECNICA_FILE = os.path.join(DOCS_DIR, "Guía-Técnica-para-la-elaboración-del-Programa-Anual-de-Trabajo-2022-2025-1.pdf")
+PUEBLOS_MAGICOS_FILE = os.path.join(DOCS_DIR, "indicadores 2021 Pueblos magicos.pdf")
 
 # DOCUMENTOS DE PLANEACIÓN SUPERIOR
 LEY_ORGANICA_FILE = os.path.join(DOCS_DIR, "ley organica.pdf")
 PND_FILE = os.path.join(DOCS_DIR, "pnd.pdf")
 PVD_FILE = os.path.join(DOCS_DIR, "PVD.pdf") # Plan Veracruzano de Desarrollo
 
+# Directorio de cachés locales (texto extraído de PDFs, índices, etc.)
+CACHE_DIR = ".progob_cache"
+PDF_CACHE_DIR = os.path.join(CACHE_DIR, "pdf_text")
+PDF_CACHE_INDEX = os.path.join(PDF_CACHE_DIR, "index.json")
+# Si cambia el formato o la forma de extraer, se incrementa para invalidar la caché completa
+PDF_CACHE_VERSION = 1
+# Extracción en paralelo: procesos para (re)construir la caché y páginas por tarea (granularidad del reparto)
+PDF_INGEST_WORKERS = os.cpu_count() or 1
+PDF_INGEST_PAGES_PER_TASK = 16
+
+# Índice semántico local (TF-IDF con hashing + LSA), guardado como matrices NumPy mapeables en memoria
+VECTOR_INDEX_DIR = os.path.join(CACHE_DIR, "vectors")
+VECTOR_HASH_BUCKETS = 8192
+VECTOR_DIM = 256
+VECTOR_INDEX_VERSION = 1
+
+# Caché local de respuestas del modelo (SQLite): clave = hash de mensajes + modelo + temperatura
+RESPONSE_CACHE_FILE = os.path.join(CACHE_DIR, "responses.sqlite3")
+USERS_CACHE_FILE = os.path.join(CACHE_DIR, "users.json") # Copia del listado de usuarios para el login sin pandas
+# Avance de cada usuario (no es caché: no se borra al reconstruir índices)
+DATA_DIR = ".progob_data"
+PROGRESS_DB_FILE = os.path.join(DATA_DIR, "progress.sqlite3")
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+RESPONSE_CACHE_MAX_ENTRIES = 500
+
+# Paquetes de contexto por área precalculados (python chatbot.py build-bundles)
+AREA_BUNDLES_FILE = os.path.join(CACHE_DIR, "area_bundles.json.gz")
+AREA_BUNDLES_VERSION = 2
+AREA_BUNDLE_MAX_ARTICLES = 6
+
+# Índice estructurado (Título/Capítulo/Artículo/fracción) del Reglamento Interior y la Ley Orgánica
+LEGAL_INDEX_FILE = os.path.join(CACHE_DIR, "legal_index.sqlite3")
+LEGAL_INDEX_VERSION = 1
+
+# Catálogo de indicadores extraído del GDM y del Manual de Indicadores (búsqueda local)
+INDICATOR_CATALOG_FILE = os.path.join(CACHE_DIR, "indicator_catalog.json")
+INDICATOR_CATALOG_VERSION = 1
+INDICATOR_CATALOG_DOCUMENTS = ("gdm", "manual_ind")
+INDICATOR_TOP_K = 5 # Indicadores que se envían al modelo por consulta
+INDICATOR_LEVEL_BOOST = 1.5 # Prioridad a los recomendados para el nivel de la MIR que se está trabajando
+LEGAL_DOCUMENTS = ("reglamento", "ley_organica")
+LEGAL_CONTEXT_MAX_CHARS = 8000 # Tope de atribuciones de la UR que se envían al modelo
+
 
 # CLAVE API: Se leerá de st.secrets["deepseek_api_key"]
+LLM_API_URL = "https://api.deepseek.com/v1/chat/completions"
+# Cliente HTTP compartido: conexiones keep-alive reutilizadas por todas las sesiones del proceso
+LLM_POOL_SIZE = 20 # Conexiones simultáneas máximas hacia la API
+LLM_CONNECT_TIMEOUT = 10 # Segundos para establecer la conexión TCP/TLS
+LLM_READ_TIMEOUT = 60 # Segundos máximos de espera entre bytes recibidos (no de la respuesta completa)
+# Servicio de ejecución compartido: las llamadas a la API corren en hilos propios, no en el hilo del script
+LLM_MAX_CONCURRENCY = 8 # Llamadas simultáneas a la API por proceso (no mayor que LLM_POOL_SIZE)
+LLM_MAX_PENDING_JOBS = 50 # Solicitudes en espera antes de rechazar nuevas (contrapresión)
+# Límite global hacia el proveedor (ajustar al plan contratado) y fila justa entre usuarios
+LLM_RATE_LIMIT_RPM = 60 # Solicitudes por minuto
+LLM_RATE_LIMIT_TPM = 600000 # Tokens por minuto (prompt estimado + max_tokens)
+LLM_RATE_LIMIT_RETRY_SECONDS = 5.0 # Pausa ante un 429 sin encabezado Retry-After
+LLM_RATE_LIMIT_MAX_REQUEUES = 3 # Veces que una solicitud con 429 vuelve a la fila antes de avisar al usuario
+# Resiliencia: reintentos con backoff exponencial (sólo antes de empezar el streaming), hedging y circuit breaker
+LLM_RETRY_ATTEMPTS = 2 # Reintentos tras el primer intento fallido
+LLM_RETRY_BASE_SECONDS = 1.0
+LLM_RETRY_MAX_SECONDS = 8.0
+LLM_RETRY_STATUS_CODES = (500, 502, 503, 504)
+LLM_HEDGE_ENABLED = False # Duplica el costo de las solicitudes lentas: activar sólo si la latencia de cola lo amerita
+LLM_HEDGE_PERCENTILE = 95 # Se envía el duplicado cuando la espera supera este percentil de latencia
+LLM_HEDGE_MIN_SAMPLES = 20 # Mediciones necesarias antes de usar el percentil
+LLM_LATENCY_WINDOW = 200 # Latencias recientes (hasta los encabezados) que se conservan
+LLM_BREAKER_FAILURE_THRESHOLD = 5 # Fallas seguidas que abren el circuito
+LLM_BREAKER_RESET_SECONDS = 30 # Tiempo abierto antes de la solicitud de prueba
+LLM_QUEUE_POLL_SECONDS = 1.0 # Cada cuánto se actualiza la posición en la fila que ve el usuario
+LLM_DEFAULT_JOB_SECONDS = 30.0 # Duración supuesta de una respuesta antes de tener mediciones
+# Presupuesto de contexto: el prompt se recorta localmente antes de enviarlo para no chocar con el límite del modelo
+LLM_MODEL = "deepseek-chat"
+LLM_CONTEXT_WINDOW_TOKENS = 64000 # Ventana de contexto de deepseek-chat (entrada + salida)
+LLM_MAX_TOKENS = 4000 # Tokens reservados para la respuesta
+LLM_CONTEXT_SAFETY_TOKENS = 2000 # Margen por el error de la estimación local
+CHARS_PER_TOKEN = 3.0 # Estimación conservadora para texto en español (el tokenizador real rinde ~3.3)
+LLM_MESSAGE_OVERHEAD_TOKENS = 4 # Tokens de formato que añade cada mensaje del chat
+CONTEXT_TRUNCATION_MARK = "\n[...]" # Señala al modelo que una fuente llegó recortada
 
 
 # --- DEFINICIÓN DEL PROMPT MAESTRO (PERSONALIDAD DE PROGOB) ---
@@ -61,7 +205,7 @@ SYSTEM_PROMPT = """
 1.  **Micro-Fases y Validación:** La conversación se basa en micro-fases didácticas. **No permitas avanzar a la siguiente etapa de la MIR (Problema final, Propósito final, Componentes finales) hasta que el usuario haya validado o confirmado el enunciado propuesto o ajustado.**
 2.  **Perspectiva Transversal CRÍTICA:** En cada propuesta (Problema, Componentes, Indicadores), debes asegurar la aplicación de la perspectiva de: **niñas, niños y adolescentes, mujeres, personas de la tercera edad, y grupos vulnerables (discapacidad y LGBTI+)**. Esto debe reflejarse en la desagregación de beneficiarios, el enfoque de las actividades o la redacción de los objetivos.
 3.  **Validación Metodológica:** Cada respuesta que avance o valide un concepto debe incluir una explicación didáctica del concepto (ej. Lógica Vertical, RMAE-T) y, si es posible, opciones de redacción para que el usuario elija o proponga una propia.
-4.  **Contexto Específico (RAG):** Usa las atribuciones y actividades de la Unidad Responsable del usuario ({user_area_context}) para contextualizar las propuestas y validaciones.
+4.  **Contexto Específico (RAG):** Usa las atribuciones y actividades de la Unidad Responsable del usuario (sección **CONTEXTO DE LA UNIDAD RESPONSABLE**) para contextualizar las propuestas y validaciones.
 5.  **Alineación Estratégica:** En cada fase, asegúrate de que las propuestas estén alineadas con la **Ley Orgánica**, el **PND**, el **PVD**, los **ODS** y los indicadores del **GDM/Manual de Indicadores** cargados en el contexto (RAG).
 6.  **Formato:** Usa Markdown y Tablas para claridad y estructura.
 7.  **Lenguaje Didáctico:** Siempre que introduzcas un concepto nuevo (ej. Causa Directa, Indicador RMAE-T, Lógica Vertical), **proporciona una breve explicación didáctica y un ejemplo práctico relacionado con un servicio público**, asumiendo que el usuario no es experto en metodología.
@@ -72,18 +216,19 @@ SYSTEM_PROMPT = """
 # A. FUNCIONES CENTRALES (Carga de Usuarios y Contexto)
 # --------------------------------------------------------------------------
 
-def load_users():
-    """Carga el listado de usuarios, priorizando users.xlsx o secrets.toml."""
-    # ... (Función load_users se mantiene igual) ...
-    possible_names = [USERS_FILE_NAME, "users.csv", "usuarios.xlsx", "usuarios.csv"]
-    found_file = None
-    for name in possible_names:
+def find_users_file():
+    """Primer archivo de usuarios existente (users.xlsx, users.csv, usuarios.xlsx, usuarios.csv) o None."""
+    for name in USERS_FILE_CANDIDATES:
         if os.path.exists(name.lower()):
-            found_file = name.lower()
-            break
+            return name.lower()
         if os.path.exists(name):
-             found_file = name
-             break
+            return name
+    return None
+
+
+def load_users():
+    """Carga el listado de usuarios, priorizando users.xlsx o secrets.toml."""
+    found_file = find_users_file()
     
     if found_file:
         try:
@@ -110,168 +255,515 @@ def load_users():
         return df
     
     # Si no encuentra archivo local, intenta leer de secrets.toml
+    records = load_secrets_users()
+    return pd.DataFrame(records) if records else pd.DataFrame() 
+
+
+def load_secrets_users():
+    """Usuarios de la sección [users] de secrets.toml como lista de dicts (sin pasar por pandas)."""
     try:
         if 'users' in st.secrets:
-            df_secrets = pd.DataFrame({
-                'username': st.secrets['users']['username'],
-                'password': st.secrets['users']['password'],
-                'role': st.secrets['users']['role'],
-                'area': st.secrets['users']['area'],
-                'nombre': st.secrets['users'].get('nombre', [f"Usuario {i+1}" for i in range(len(st.secrets['users']['username']))]) 
-            })
-            df_secrets.columns = df_secrets.columns.str.lower()
-            return df_secrets
+            users = st.secrets['users']
+            nombres = users.get('nombre', [f"Usuario {i+1}" for i in range(len(users['username']))])
+            return [
+                {'username': username, 'password': password, 'role': role, 'area': area, 'nombre': nombre}
+                for username, password, role, area, nombre in zip(users['username'], users['password'], users['role'], users['area'], nombres)
+            ]
     except Exception as e:
         pass
-        
-    return pd.DataFrame() 
+    return []
+
+
+def hash_password(password, salt=None, iterations=PASSWORD_HASH_ITERATIONS):
+    """Hash con sal para guardar en el listado de usuarios (nunca la contraseña en claro)."""
+    salt = salt or os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), iterations).hex()
+    return f"{PASSWORD_HASH_ALGORITHM}${iterations}${salt}${digest}"
+
+
+def is_password_hash(stored):
+    return stored.startswith(f"{PASSWORD_HASH_ALGORITHM}$")
+
+
+def verify_password(password, stored):
+    """
+    Compara en tiempo constante. Acepta el formato con hash y, como ruta de migración, contraseñas en claro
+    heredadas del listado anterior (ver `python chatbot.py hash-passwords`).
+    """
+    if not is_password_hash(stored):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    try:
+        _, iterations, salt, _ = stored.split("$")
+        expected = hash_password(password, salt, int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected.encode('utf-8'), stored.encode('utf-8'))
+
+
+def normalize_username(username):
+    return str(username).strip().lower()
+
+
+def cell_to_text(value):
+    """Texto de una celda del listado: vacío para NaN y sin el '.0' que Excel agrega a los números."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+class UserDirectory:
+    """
+    Directorio de usuarios en memoria, indexado por usuario normalizado: el login es una búsqueda en un dict.
+    El archivo (o secrets.toml) sólo se lee al arrancar y cuando cambia su fecha de modificación.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.users = {}
+        self.source = None
+        self.signature = None
+        self.plaintext_passwords = 0 # Contraseñas heredadas en claro (pendientes de migrar)
+
+    @staticmethod
+    def _signature(path):
+        try:
+            return (path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+
+    def _current_signature(self):
+        # Sólo un stat del archivo ya conocido; si desapareció, se vuelve a buscar entre los candidatos
+        signature = self._signature(self.source) if self.source and self.source != "secrets.toml" else None
+        if signature:
+            return signature
+        found_file = find_users_file()
+        return self._signature(found_file) if found_file else ("secrets.toml", None)
+
+    def refresh(self):
+        """Recarga el listado si cambió el archivo de origen. Devuelve el propio directorio."""
+        signature = self._current_signature()
+        if signature == self.signature:
+            return self
+        with self._lock:
+            if signature != self.signature:
+                self._load(signature)
+        return self
+
+    def _read_records(self, signature):
+        """
+        Filas del listado. Para archivos se usa una copia JSON en CACHE_DIR ligada a la ruta y mtime, así un proceso
+        nuevo no necesita pandas ni openpyxl para la pantalla de login; secrets.toml se lee directamente.
+        La copia sólo se guarda si todas las contraseñas ya son hashes: las heredadas en claro no salen del archivo
+        de origen (hasta migrarlas con `python chatbot.py hash-passwords` el login sigue leyendo el archivo).
+        """
+        path, _ = signature
+        if path == "secrets.toml":
+            return load_secrets_users()
+        try:
+            with open(USERS_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('signature') == list(signature):
+                return cached['records']
+        except (OSError, ValueError):
+            pass
+        df_users = load_users()
+        if 'username' not in df_users.columns:
+            return []
+        columns = [col for col in ('username', 'password', 'role', 'area', 'nombre') if col in df_users.columns]
+        records = [{col: cell_to_text(record.get(col)) for col in columns} for record in df_users.to_dict('records')]
+        if all(not record.get('password') or is_password_hash(record['password']) for record in records):
+            # Contiene los hashes: se crea ya con permisos 0600, igual que debe protegerse el archivo de origen
+            _write_json_atomic(USERS_CACHE_FILE, {'signature': list(signature), 'records': records}, mode=0o600)
+        else:
+            try:
+                os.remove(USERS_CACHE_FILE) # Una copia anterior no debe sobrevivir a un listado con contraseñas en claro
+            except OSError:
+                pass
+        return records
+
+    def _load(self, signature):
+        users = {}
+        for record in self._read_records(signature):
+            username = normalize_username(cell_to_text(record.get('username')))
+            if not username or username in users: # Con usuarios repetidos gana la primera fila, como antes
+                continue
+            users[username] = {
+                'username': username,
+                'password': cell_to_text(record.get('password')),
+                'role': cell_to_text(record.get('role')).lower() or 'enlace',
+                'nombre': cell_to_text(record.get('nombre')) or 'Usuario',
+                'area': cell_to_text(record.get('area')) or 'Sin Área',
+            }
+        self.users = users
+        self.plaintext_passwords = sum(1 for user in users.values() if not is_password_hash(user['password']))
+        self.source = signature[0]
+        self.signature = signature
+
+    def get(self, username):
+        return self.users.get(normalize_username(username))
+
+    def is_empty(self):
+        return not self.users
+
+    def to_dataframe(self):
+        """Vista para el panel de administración (sin contraseñas)."""
+        return pd.DataFrame([{key: value for key, value in user.items() if key != 'password'} for user in self.users.values()])
+
+
+@st.cache_resource
+def get_user_directory():
+    """Directorio único por proceso; refresh() lo mantiene sincronizado con el archivo."""
+    return UserDirectory()
+
 
-def authenticate(username, password, df_users):
+def authenticate(username, password, directory):
     """Verifica credenciales y devuelve el rol, nombre y área del usuario."""
-    # ... (Función authenticate se mantiene igual) ...
-    clean_username = username.strip().lower()
-    user = df_users[(df_users['username'] == clean_username) & (df_users['password'] == password)]
-    
-    if not user.empty:
-        role = str(user['role'].iloc[0]).strip().lower() if 'role' in user.columns else 'enlace' 
-        name = str(user['nombre'].iloc[0]).strip() if 'nombre' in user.columns else 'Usuario'
-        area = str(user['area'].iloc[0]).strip() if 'area' in user.columns else 'Sin Área'
-        return role, name, area
+    user = directory.get(username)
+    if user and user['password'] and verify_password(password, user['password']):
+        return user['role'], user['nombre'], user['area']
     return None, None, None
 
 
-def extract_text_from_pdf(pdf_path):
-    """Extrae texto de un archivo PDF si pypdf está instalado."""
-    if not pypdf:
-        return "ERROR: Librería 'pypdf' no instalada."
-    if not os.path.exists(pdf_path):
-        return f"ERROR: Archivo no encontrado en {pdf_path}"
-        
+def _file_sha256(path):
+    """Calcula el hash SHA-256 del contenido de un archivo (lectura por bloques)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_pdf_cache_index():
+    """Lee el índice de la caché de extracción (ruta -> tamaño, mtime, hash)."""
     try:
-        reader = pypdf.PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text # Devolvemos el texto completo
-    except Exception as e:
-        return f"ERROR al leer el PDF: {e}"
+        with open(PDF_CACHE_INDEX, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == PDF_CACHE_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version': PDF_CACHE_VERSION, 'files': {}}
+
+
+# Protege el read-modify-write del índice de la caché de extracción: las sesiones de Streamlit son hilos de un
+# mismo proceso y dos extracciones simultáneas perderían la entrada de una de ellas
+PDF_CACHE_INDEX_LOCK = threading.Lock()
+
+
+def _unique_tmp_path(path, suffix=".tmp"):
+    """Nombre temporal junto a `path` único por proceso, hilo y llamada (varios hilos pueden escribir a la vez)."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex}{suffix}"
+
+
+def _write_json_atomic(path, data, compress=False, mode=None):
+    """
+    Escribe un JSON de forma atómica (archivo temporal + rename) para no dejar cachés corruptas.
+    El temporal es único por llamada: dos hilos que escriben el mismo archivo no se pisan el temporal.
+    tempfile lo crea con O_CREAT | O_EXCL y permisos 0600; con `mode` se fijan los permisos finales antes de
+    escribir el contenido, así el archivo nunca existe con datos y permisos más abiertos.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+        try:
+            if mode is not None:
+                os.fchmod(f.fileno(), mode)
+            f.write(gzip.compress(payload) if compress else payload)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+
+def _pdf_cache_entry(pdf_path):
+    """
+    Localiza la entrada de caché de un PDF: devuelve (índice, clave, stat, hash del contenido, archivo de caché).
+    Si tamaño y mtime no cambiaron confiamos en el hash registrado sin volver a leer el archivo.
+    """
+    stat = os.stat(pdf_path)
+    key = os.path.normpath(pdf_path)
+    index = _read_pdf_cache_index()
+    entry = index['files'].get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        content_hash = entry['sha256']
+    else:
+        content_hash = _file_sha256(pdf_path)
+    return index, key, stat, content_hash, os.path.join(PDF_CACHE_DIR, f"{content_hash}.json.gz")
+
+
+def _read_cached_pages(cache_file):
+    """Lee las páginas de un archivo de caché; None si no existe o está corrupto."""
+    try:
+        with gzip.open(cache_file, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def extract_pdf_pages(pdf_path):
+    """
+    Devuelve el texto de cada página del PDF usando una caché persistente en disco.
+    La caché se indexa por ruta, tamaño, mtime y hash del contenido: si el PDF cambia, se vuelve a extraer.
+    Lanza excepción si el archivo no existe o no puede leerse.
+    """
+    index, key, stat, content_hash, cache_file = _pdf_cache_entry(pdf_path)
+    entry = index['files'].get(key)
+
+    # 1. Caché de contenido (la llena también `python chatbot.py build-bundles` en paralelo); si falta, extracción en serie
+    pages = _read_cached_pages(cache_file)
+    if pages is None:
+        if not pypdf:
+            raise RuntimeError("Librería 'pypdf' no instalada.")
+        pages = _extract_page_range(pdf_path, 0, None)
+        _write_json_atomic(cache_file, pages, compress=True)
+
+    # 2. Actualizamos el índice si el archivo cambió (y limpiamos la versión anterior de la caché).
+    #    Se relee bajo el candado para no pisar entradas que otro hilo haya escrito mientras extraíamos.
+    if not entry or entry['sha256'] != content_hash or entry['mtime'] != stat.st_mtime_ns:
+        with PDF_CACHE_INDEX_LOCK:
+            index = _read_pdf_cache_index()
+            entry = index['files'].get(key)
+            if not entry or entry['sha256'] != content_hash or entry['mtime'] != stat.st_mtime_ns:
+                still_used = entry and any(
+                    other['sha256'] == entry['sha256'] for path, other in index['files'].items() if path != key
+                )
+                if entry and entry['sha256'] != content_hash and not still_used:
+                    try:
+                        os.remove(os.path.join(PDF_CACHE_DIR, f"{entry['sha256']}.json.gz"))
+                    except OSError:
+                        pass
+                index['files'][key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': content_hash}
+                _write_json_atomic(PDF_CACHE_INDEX, index)
+
+    return pages
+
+
+def _extract_page_range(pdf_path, start, end):
+    """
+    Extrae el texto de las páginas [start, end) (end=None: hasta el final). Es la unidad de trabajo del pool de
+    procesos, así que vive a nivel de módulo (debe poder serializarse con pickle) y sólo recibe/devuelve datos simples.
+    """
+    reader = pypdf.PdfReader(pdf_path)
+    end = len(reader.pages) if end is None else min(end, len(reader.pages))
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def _page_range_tasks(pdf_path, pages_per_task):
+    """Divide un PDF en rangos de páginas [start, end) para repartirlos entre procesos."""
+    total = len(pypdf.PdfReader(pdf_path).pages)
+    return [(pdf_path, start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task)]
+
+
+def _parallel_ingest_supported():
+    """
+    El pool sólo puede usarse si la función de trabajo se resuelve por nombre en el proceso hijo
+    (p. ej. no cuando el módulo se cargó desde un exec sin registrarse en sys.modules).
+    """
+    module = sys.modules.get(_extract_page_range.__module__)
+    return getattr(module, '_extract_page_range', None) is _extract_page_range
+
+
+def extract_pdfs_parallel(pdf_paths, workers=None, pages_per_task=None):
+    """
+    Extrae varios PDFs completos repartiendo rangos de páginas entre `workers` procesos (CPU-bound: los hilos no
+    escalan por el GIL). Devuelve {ruta: [texto por página]} o {ruta: Exception} si un documento falla.
+    No toca la caché; con workers=1 (o sin soporte de pool) todo se hace en serie en este proceso.
+    """
+    workers = max(1, workers or PDF_INGEST_WORKERS)
+    pages_per_task = pages_per_task or PDF_INGEST_PAGES_PER_TASK
+    results, tasks = {}, []
+    for path in pdf_paths:
+        try:
+            tasks.extend(_page_range_tasks(path, pages_per_task))
+            results[path] = {}
+        except Exception as e:
+            results[path] = e
+
+    if workers == 1 or len(tasks) <= 1 or not _parallel_ingest_supported():
+        chunks = ((task, _extract_page_range(*task)) for task in tasks)
+        pool = None
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+        futures = {pool.submit(_extract_page_range, *task): task for task in tasks}
+        chunks = ((futures[f], f) for f in concurrent.futures.as_completed(futures))
+    try:
+        for (path, start, _), chunk in chunks:
+            if isinstance(results[path], Exception):
+                continue
+            try:
+                results[path][start] = chunk if pool is None else chunk.result()
+            except Exception as e:
+                results[path] = e
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    # Reensamblamos cada documento en orden de página
+    return {
+        path: parts if isinstance(parts, Exception) else [text for start in sorted(parts) for text in parts[start]]
+        for path, parts in results.items()
+    }
+
+
+def ingest_pdfs(pdf_paths, workers=None):
+    """
+    Llena la caché de extracción para los PDFs que aún no la tienen, en paralelo. Los que ya están en caché no se
+    abren; los errores se dejan para que extract_pdf_pages los reporte con su mensaje habitual.
+    Sólo para los comandos de despliegue: la app (servidor multihilo) nunca crea el pool de procesos.
+    Devuelve el número de documentos extraídos.
+    """
+    if not pypdf:
+        return 0
+    pending = {}
+    for path in pdf_paths:
+        try:
+            _, _, _, _, cache_file = _pdf_cache_entry(path)
+        except OSError:
+            continue
+        if _read_cached_pages(cache_file) is None:
+            pending[path] = cache_file
+    if not pending:
+        return 0
+
+    extracted = extract_pdfs_parallel(list(pending), workers)
+    done = 0
+    for path, pages in extracted.items():
+        if not isinstance(pages, Exception):
+            _write_json_atomic(pending[path], pages, compress=True)
+            done += 1
+    return done
+
+
+# Documentos compartidos por todas las sesiones: ID -> (ruta, nombre para el prompt RAG)
+CORPUS_DOCUMENTS = {
+    "reglamento": (REGLAMENTO_FILE, "REGLAMENTO INTERIOR"),
+    "ley_organica": (LEY_ORGANICA_FILE, "LEY ORGANICA"),
+    "guia": (GUIDE_FILE, "GUÍA METODOLÓGICA"),
+    "ods": (ODS_FILE, "ODS"),
+    "gdm": (GDM_FILE, "GDM"),
+    "manual_ind": (MANUAL_INDICADORES_FILE, "MANUAL INDICADORES"),
+    "pnd": (PND_FILE, "PND"),
+    "pvd": (PVD_FILE, "PVD"),
+    "guia_tecnica": (GUIA_TECNICA_FILE, "GUÍA TÉCNICA PAT"),
+    "pueblos_magicos": (PUEBLOS_MAGICOS_FILE, "INDICADORES PUEBLOS MÁGICOS"),
+}
+
+
+@st.cache_resource(show_spinner="Consultando la base de conocimiento...")
+def load_corpus():
+    """
+    Carga UNA sola vez por proceso los documentos normativos y de planeación.
+    Devuelve un mapeo inmutable ID -> {'path', 'name', 'pages', 'text', 'error'} compartido por todas las sesiones;
+    las sesiones sólo guardan los IDs (st.session_state['corpus_doc_ids']), nunca copias del texto.
+    """
+    # En el servidor la extracción es en serie y sale de la caché; el pool de procesos sólo lo usan los comandos
+    # build-bundles y benchmark-ingest (un fork del servidor, con sus hilos y conexiones abiertas, puede bloquearse)
+    corpus = {}
+    for doc_id, (path, name) in CORPUS_DOCUMENTS.items():
+        try:
+            pages = tuple(extract_pdf_pages(path))
+            error = None
+        except Exception as e:
+            pages = ()
+            error = f"ERROR al leer el PDF: {e}"
+        corpus[doc_id] = MappingProxyType({
+            'path': path, 'name': name,
+            'pages': pages, 'text': "".join(pages),
+            'error': error,
+        })
+    return MappingProxyType(corpus)
 
 
 def load_area_context(user_area):
     """
     Carga el contexto específico del área del usuario, leyendo PDF y CSV (RAG).
-    Ajustado para cargar Ley Orgánica, PND, PVD y desplegar todas las atribuciones/actividades.
+    Los documentos normativos viven en el corpus compartido (load_corpus); aquí sólo se generan los
+    resúmenes y se guardan en la sesión las actividades del área y los IDs de los documentos disponibles.
     """
     context = {
-        "atribuciones": "", "atribuciones_resumen": "No disponible.",
-        "reglamento_content": "", "reglamento_resumen": "No disponible.",
-        "ley_organica_content": "", "ley_organica_resumen": "No disponible.",
+        "atribuciones_resumen": "No disponible.",
+        "reglamento_resumen": "No disponible.",
+        "ley_organica_resumen": "No disponible.",
         "actividades_previas": "", "actividades_resumen": "No disponibles.", 
-        "guia_metodologica": "", "guia_resumen": "No disponible.",
-        "ods_content": "", "ods_resumen": "No cargado.",
-        "gdm_content": "", "gdm_resumen": "No cargado.",
-        "manual_ind_content": "", "manual_ind_resumen": "No cargado.",
-        "pnd_content": "", "pnd_resumen": "No cargado.",
-        "pvd_content": "", "pvd_resumen": "No cargado.",
+        "guia_resumen": "No disponible.",
+        "ods_resumen": "No cargado.",
+        "gdm_resumen": "No cargado.",
+        "manual_ind_resumen": "No cargado.",
+        "pnd_resumen": "No cargado.",
+        "pvd_resumen": "No cargado.",
     }
     
     # Clave de búsqueda (normalizada)
     search_key = user_area.strip().upper()
 
-    # --- 1. CARGA DE DOCUMENTOS NORMATIVOS Y DE PLANEACIÓN ---
-    
+    # --- 1. DOCUMENTOS NORMATIVOS, DE PLANEACIÓN Y ESTRATÉGICOS (CORPUS COMPARTIDO) ---
+    corpus = load_corpus()
+    st.session_state['corpus_doc_ids'] = [doc_id for doc_id, doc in corpus.items() if not doc['error']]
+
     # LEY ORGÁNICA
-    full_ley_organica_text = extract_text_from_pdf(LEY_ORGANICA_FILE)
-    if "ERROR" not in full_ley_organica_text:
-        st.session_state['ley_organica_content'] = full_ley_organica_text[:RAG_CHUNK_SIZE]
+    ley_organica = corpus['ley_organica']
+    if not ley_organica['error']:
         context["ley_organica_resumen"] = f"Ley Orgánica Municipal cargada. Se usará para validar las facultades generales."
     else:
-        context["ley_organica_resumen"] = f"ADVERTENCIA: Ley Orgánica no encontrada o con error. ({full_ley_organica_text})"
+        context["ley_organica_resumen"] = f"ADVERTENCIA: Ley Orgánica no encontrada o con error. ({ley_organica['error']})"
 
     # REGLAMENTO INTERIOR
-    full_reglamento_text = extract_text_from_pdf(REGLAMENTO_FILE)
-    if "ERROR" not in full_reglamento_text:
-        context["reglamento_content"] = full_reglamento_text[:RAG_CHUNK_SIZE]
+    reglamento = corpus['reglamento']
+    if not reglamento['error']:
         context["reglamento_resumen"] = f"Reglamento Interior cargado. El asesor buscará atribuciones específicas para {user_area}."
-        st.session_state['reglamento_content'] = context["reglamento_content"]
     else:
-        context["reglamento_resumen"] = f"ADVERTENCIA: Error al cargar el Reglamento. ({full_reglamento_text})"
+        context["reglamento_resumen"] = f"ADVERTENCIA: Error al cargar el Reglamento. ({reglamento['error']})"
 
     # PND (Plan Nacional de Desarrollo)
-    full_pnd_text = extract_text_from_pdf(PND_FILE)
-    if "ERROR" not in full_pnd_text:
-        st.session_state['pnd_content'] = full_pnd_text[:RAG_CHUNK_SIZE]
+    pnd = corpus['pnd']
+    if not pnd['error']:
         context["pnd_resumen"] = f"Plan Nacional de Desarrollo (PND) cargado."
     else:
-        context["pnd_resumen"] = f"ADVERTENCIA: PND no encontrado o con error. ({full_pnd_text})"
+        context["pnd_resumen"] = f"ADVERTENCIA: PND no encontrado o con error. ({pnd['error']})"
         
     # PVD (Plan Veracruzano de Desarrollo)
-    full_pvd_text = extract_text_from_pdf(PVD_FILE)
-    if "ERROR" not in full_pvd_text:
-        st.session_state['pvd_content'] = full_pvd_text[:RAG_CHUNK_SIZE]
+    pvd = corpus['pvd']
+    if not pvd['error']:
         context["pvd_resumen"] = f"Plan Veracruzano de Desarrollo (PVD) cargado."
     else:
-        context["pvd_resumen"] = f"ADVERTENCIA: PVD no encontrado o con error. ({full_pvd_text})"
+        context["pvd_resumen"] = f"ADVERTENCIA: PVD no encontrado o con error. ({pvd['error']})"
 
-    # Concatenamos texto para la inyección de atribuciones (completo)
-    context["atribuciones"] = (
-        f"--- Atribuciones Ley Orgánica ---\n{full_ley_organica_text}" + 
-        f"\n\n--- Atribuciones Reglamento Interior ---\n{full_reglamento_text}"
-    )
-
-    # --- 2. CARGA DE DOCUMENTOS ESTRATÉGICOS (RAG) ---
+    # --- 2. DOCUMENTOS ESTRATÉGICOS (RAG) ---
     docs_to_load = {
-        "ods": (ODS_FILE, "Objetivos de Desarrollo Sostenible (ODS)"),
-        "gdm": (GDM_FILE, "Guía Desempeño Municipal (GDM)"),
-        "manual_ind": (MANUAL_INDICADORES_FILE, "Manual de Indicadores")
+        "ods": "Objetivos de Desarrollo Sostenible (ODS)",
+        "gdm": "Guía Desempeño Municipal (GDM)",
+        "manual_ind": "Manual de Indicadores"
     }
     
-    for key, (path, name) in docs_to_load.items():
-        full_content = extract_text_from_pdf(path)
-        if "ERROR" not in full_content:
-            context[f"{key}_content"] = full_content[:RAG_CHUNK_SIZE]
-            context[f"{key}_resumen"] = f"Documento de {name} cargado ({len(full_content)} caracteres)."
-            st.session_state[f"{key}_content"] = context[f"{key}_content"] # Aplicamos el límite RAG
+    for key, name in docs_to_load.items():
+        document = corpus[key]
+        if not document['error']:
+            context[f"{key}_resumen"] = f"Documento de {name} cargado ({len(document['text'])} caracteres)."
         else:
              context[f"{key}_resumen"] = f"ADVERTENCIA: {name} no encontrado o con error."
 
-    # --- 3. CARGA Y LISTADO EXHAUSTIVO DE ACTIVIDADES PREVIAS (CSV) ---
-    if os.path.exists(ACTIVIDADES_FILE):
-        try:
-            df_actividades = pd.read_csv(ACTIVIDADES_FILE, encoding='utf-8')
-            df_actividades.columns = df_actividades.columns.str.lower()
-            
-            if 'area' in df_actividades.columns and 'actividad' in df_actividades.columns:
-                clean_user_area_norm = unidecode(user_area.strip()).replace('.', '').upper()
-                area_keys = [clean_user_area_norm]
-                if "SIPINNA" in clean_user_area_norm:
-                     area_keys.append('SIPINNA')
-                
-                filtered_df = df_actividades[
-                    df_actividades['area'].astype(str).str.upper().apply(
-                        lambda x: any(key in unidecode(x) for key in area_keys)
-                    )
-                ]
-                
-                if not filtered_df.empty:
-                    actividades_list = filtered_df['actividad'].tolist()
-                    
-                    # LISTADO COMPLETO DE ACTIVIDADES (como string) para el prompt inicial y RAG
-                    actividades_full_text = "\n".join([f"* {a}" for a in actividades_list])
-                    context["actividades_previas"] = actividades_full_text
-                    st.session_state['actividades_content'] = actividades_full_text
-                    
-                    context["actividades_resumen"] = f"Se encontraron **{len(actividades_list)} actividades** previas. Listado Completo:\n{actividades_full_text}"
-
-                else:
-                    context["actividades_resumen"] = f"ADVERTENCIA: No se encontraron actividades previas para la UR '{user_area}'."
-            else:
-                context["actividades_resumen"] = f"ADVERTENCIA: Archivo de actividades cargado, pero faltan columnas 'area' o 'actividad'."
-
-        except Exception as e:
-            context["actividades_resumen"] = f"Error al procesar el archivo de actividades: {e}"
+    # --- 3. ACTIVIDADES PREVIAS Y ATRIBUCIONES DE LA UR (paquete precalculado, una sola búsqueda) ---
+    bundle = get_area_bundle(user_area)
+    if bundle.get('error'):
+        context["actividades_resumen"] = bundle['error']
+    elif bundle['actividades']:
+        # LISTADO COMPLETO DE ACTIVIDADES (como string) para el prompt inicial y RAG
+        actividades_full_text = "\n".join([f"* {a}" for a in bundle['actividades']])
+        context["actividades_previas"] = actividades_full_text
+        st.session_state['actividades_content'] = actividades_full_text
+        
+        context["actividades_resumen"] = f"Se encontraron **{len(bundle['actividades'])} actividades** previas. Listado Completo:\n{actividades_full_text}"
     else:
-        context["actividades_resumen"] = f"ADVERTENCIA: Archivo de actividades no encontrado."
+        context["actividades_resumen"] = f"ADVERTENCIA: No se encontraron actividades previas para la UR '{user_area}'."
+    
+    if bundle.get('reglamento_articulos'):
+        st.session_state['atribuciones_ur_content'] = format_legal_articles(bundle['reglamento_articulos'])
+        context["reglamento_resumen"] += f" Se identificaron {len(bundle['reglamento_articulos'])} artículos que rigen a la UR."
     
     # El campo 'atribuciones_resumen' contendrá el texto combinado de todas las fuentes para el prompt
     context["atribuciones_resumen"] = (
@@ -282,233 +774,3080 @@ def load_area_context(user_area):
     )
 
 
-    return context
+    return context
+
+
+# --------------------------------------------------------------------------
+# I. ÍNDICE NORMATIVO (Título / Capítulo / Artículo / fracción)
+# --------------------------------------------------------------------------
+
+LEGAL_HEADING_RE = re.compile(r'^\s*(T[IÍ]TULO|CAP[IÍ]TULO)\s+([\wÁÉÍÓÚ]+(?:\s+BIS)?)\b(.*)$', re.IGNORECASE)
+# Sufijos latinos de artículos adicionados: "60 Bis", "60 Quáter", "60 Quindecies"
+LEGAL_ARTICLE_SUFFIX = r'(?:\s+(?i:bis|ter|qu[áa]ter|quinquies|sexies|septies|octies|nonies|[a-z]*decies))?'
+LEGAL_ARTICLE_RE = re.compile(r'^\s*Art[íi]culo\s+(\d+' + LEGAL_ARTICLE_SUFFIX + r')\s*\.?\s*(.*)$')
+# Un artículo que empieza a mitad de línea ("...las siguientes: Artículo 60. Son ...")
+LEGAL_INLINE_ARTICLE_RE = re.compile(r'(?<=[.:;])\s+(?=Art[íi]culo\s+\d+' + LEGAL_ARTICLE_SUFFIX + r'\s*\.)')
+PAGE_NUMBER_RE = re.compile(r'^\s*(?:P[áa]gina\s+)?\d+\s*$', re.IGNORECASE)
+LEGAL_FRACTION_RE = re.compile(r'^\s*([IVXLC]+)\.\s+(.*)$')
+# Dependencia que rige un artículo ("Son atribuciones de la Dirección de Comercio, las siguientes")
+DEPENDENCIA_RE = re.compile(
+    r'\b(?:Direcci[óo]n|Subdirecci[óo]n|Coordinaci[óo]n|Tesorer[íi]a|Secretar[íi]a|Contralor[íi]a|Comandancia|'
+    r'Procuradur[íi]a|Unidad|Jefatura|Oficina|Comisi[óo]n|Instituto|Sindicatura|Presidencia|Regidur[íi]a)\b[^,:;]{0,100}'
+)
+DEPENDENCIA_END_RE = re.compile(r'\s+(?:las siguientes|los siguientes|adem[áa]s|tendr[áa]|estar[áa]|contar[áa]|ser[áa]|en los t[ée]rminos)\b.*$', re.IGNORECASE)
+DEPENDENCIA_PREFIX_RE = re.compile(
+    r'^(?:DIRECCION|SUBDIRECCION|COORDINACION|COMISION|JEFATURA|UNIDAD|OFICINA)\s+(?:DE|DEL|PARA)\s+(?:(?:LA|EL|LOS|LAS)\s+)?'
+)
+
+
+def dependencia_core(name):
+    """Núcleo normalizado de una dependencia: 'Dirección de Turismo y Cultura' -> 'TURISMO Y CULTURA'."""
+    return DEPENDENCIA_PREFIX_RE.sub('', normalize_area_key(name)).strip()
+
+
+def parse_legal_document(doc_id, pages):
+    """
+    Divide un documento legal en artículos con su Título, Capítulo, página, fracciones y la dependencia que rigen.
+    Devuelve [{'doc_id', 'titulo', 'capitulo', 'article', 'page', 'dependencia', 'text', 'fracciones': [(número, texto)]}].
+    """
+    articles = []
+    titulo = capitulo = None
+    pending_heading = None # 'titulo' o 'capitulo' cuyo nombre viene en la siguiente línea
+    current = None
+
+    # Encabezados/pies de página repetidos ("H. CONGRESO DEL ESTADO DE VERACRUZ") no forman parte del texto
+    page_lines = [{line.strip() for line in page_text.splitlines() if line.strip()} for page_text in pages]
+    line_pages = {}
+    for lines in page_lines:
+        for line in lines:
+            line_pages[line] = line_pages.get(line, 0) + 1
+    running_lines = {line for line, count in line_pages.items() if len(pages) >= 4 and count >= len(pages) / 2}
+
+    for page_number, page_text in enumerate(pages, start=1):
+        for raw_line in page_text.splitlines():
+            if raw_line.strip() in running_lines or PAGE_NUMBER_RE.match(raw_line):
+                continue
+            for line in LEGAL_INLINE_ARTICLE_RE.split(raw_line):
+                line = line.strip()
+                if not line:
+                    continue
+                heading = LEGAL_HEADING_RE.match(line)
+                if heading and line.upper() == line:
+                    label = f"{heading.group(1).capitalize()} {heading.group(2).upper()} {heading.group(3).strip()}".strip()
+                    if heading.group(1).upper().startswith('T'):
+                        titulo, capitulo, pending_heading = label, None, 'titulo'
+                    else:
+                        capitulo, pending_heading = label, 'capitulo'
+                    if heading.group(3).strip():
+                        pending_heading = None # El nombre venía en la misma línea
+                    continue
+                if pending_heading and line.upper() == line and not LEGAL_ARTICLE_RE.match(line):
+                    # Nombre del Título/Capítulo en la línea siguiente ("DE LOS DERECHOS HUMANOS")
+                    if pending_heading == 'titulo':
+                        titulo += f" {line}"
+                    else:
+                        capitulo += f" {line}"
+                    pending_heading = None
+                    continue
+                pending_heading = None
+
+                article = LEGAL_ARTICLE_RE.match(line)
+                if article:
+                    number = re.sub(r'\s+', ' ', article.group(1))
+                    current = {
+                        'doc_id': doc_id, 'titulo': titulo, 'capitulo': capitulo,
+                        'article': f"Artículo {number}", 'page': page_number,
+                        'intro': [article.group(2)] if article.group(2) else [], 'fracciones': [],
+                    }
+                    articles.append(current)
+                    continue
+                if current is None:
+                    continue # Preámbulo antes del primer artículo
+                fraction = LEGAL_FRACTION_RE.match(line)
+                if fraction:
+                    current['fracciones'].append([fraction.group(1), fraction.group(2)])
+                elif current['fracciones']:
+                    current['fracciones'][-1][1] += f" {line}"
+                else:
+                    current['intro'].append(line)
+
+    for article in articles:
+        intro = " ".join(article.pop('intro'))
+        match = DEPENDENCIA_RE.search(intro[:250])
+        article['dependencia'] = DEPENDENCIA_END_RE.sub('', match.group(0)).strip() if match else None
+        article['fracciones'] = [tuple(f) for f in article['fracciones']]
+        article['text'] = "\n".join(
+            [f"{article['article']}. {intro}".strip()] + [f"{num}. {text}" for num, text in article['fracciones']]
+        )
+    return articles
+
+
+def _legal_index_sources():
+    """Tamaño y mtime de los PDFs legales indexados."""
+    sources = {}
+    for doc_id in LEGAL_DOCUMENTS:
+        stat = os.stat(CORPUS_DOCUMENTS[doc_id][0])
+        sources[doc_id] = [stat.st_size, stat.st_mtime_ns]
+    return sources
+
+
+def build_legal_index(path=LEGAL_INDEX_FILE):
+    """Parsea el Reglamento Interior y la Ley Orgánica y guarda los artículos en una tabla SQLite indexada."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = _unique_tmp_path(path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE legal_articles (
+                id INTEGER PRIMARY KEY, doc_id TEXT, titulo TEXT, capitulo TEXT, article TEXT, page INTEGER,
+                dependencia TEXT, dependencia_core TEXT, heading_norm TEXT, text TEXT
+            );
+            CREATE TABLE legal_fractions (article_id INTEGER, fraccion TEXT, text TEXT);
+            CREATE INDEX idx_legal_articles_dependencia ON legal_articles(dependencia_core);
+            CREATE INDEX idx_legal_articles_article ON legal_articles(doc_id, article);
+            CREATE INDEX idx_legal_fractions_article ON legal_fractions(article_id);
+        """)
+        for doc_id in LEGAL_DOCUMENTS:
+            for article in parse_legal_document(doc_id, extract_pdf_pages(CORPUS_DOCUMENTS[doc_id][0])):
+                cursor = conn.execute(
+                    "INSERT INTO legal_articles (doc_id, titulo, capitulo, article, page, dependencia, dependencia_core, heading_norm, text)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (doc_id, article['titulo'], article['capitulo'], article['article'], article['page'],
+                     article['dependencia'], dependencia_core(article['dependencia']) if article['dependencia'] else None,
+                     normalize_area_key(article['text'][:250]), article['text']),
+                )
+                conn.executemany(
+                    "INSERT INTO legal_fractions (article_id, fraccion, text) VALUES (?, ?, ?)",
+                    [(cursor.lastrowid, num, text) for num, text in article['fracciones']],
+                )
+        conn.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [('version', str(LEGAL_INDEX_VERSION)), ('sources', json.dumps(_legal_index_sources()))],
+        )
+        conn.commit()
+    except BaseException:
+        conn.close()
+        os.remove(tmp_path) # El temporal es único por llamada: si no se borra aquí quedaría huérfano
+        raise
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+@st.cache_resource
+def get_legal_index():
+    """Ruta del índice normativo vigente; se reconstruye si falta o si cambió algún PDF legal."""
+    try:
+        with sqlite3.connect(LEGAL_INDEX_FILE) as conn:
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        if meta.get('version') == str(LEGAL_INDEX_VERSION) and json.loads(meta['sources']) == _legal_index_sources():
+            return LEGAL_INDEX_FILE
+    except (sqlite3.Error, KeyError, ValueError):
+        pass
+    build_legal_index()
+    return LEGAL_INDEX_FILE
+
+
+def legal_articles_for_area(area, limit=AREA_BUNDLE_MAX_ARTICLES):
+    """
+    Artículos que rigen a la UR: primero los que la nombran como dependencia ("Son atribuciones de la
+    Dirección de ..."); si no hay, los que la mencionan en su encabezado. Reglamento antes que Ley Orgánica.
+    """
+    # "OBRAS PÚBLICAS Y DESARROLLO URBANO - FRACCIONAMIENTOS" -> se busca la dependencia principal
+    name = dependencia_core(re.sub(r'\(.*?\)', '', re.split(r'\s+-\s*|\s*-\s+', area)[0]))
+    if len(name) < 4:
+        return []
+    columns = "id, doc_id, titulo, capitulo, article, page, text"
+    order = "ORDER BY CASE doc_id WHEN 'reglamento' THEN 0 ELSE 1 END, id LIMIT ?"
+    with sqlite3.connect(get_legal_index()) as conn:
+        cores = [row[0] for row in conn.execute("SELECT DISTINCT dependencia_core FROM legal_articles WHERE dependencia_core IS NOT NULL")]
+        matching = [core for core in cores if core == name or core.startswith(f"{name} ") or name.startswith(f"{core} ")]
+        rows = []
+        if matching:
+            rows = conn.execute(
+                f"SELECT {columns} FROM legal_articles WHERE dependencia_core IN ({','.join('?' * len(matching))}) {order}",
+                (*matching, limit),
+            ).fetchall()
+        if not rows:
+            rows = conn.execute(
+                f"SELECT {columns} FROM legal_articles WHERE heading_norm LIKE ? {order}", (f"%{name}%", limit)
+            ).fetchall()
+    keys = ('id', 'doc_id', 'titulo', 'capitulo', 'article', 'page', 'text')
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def format_legal_articles(articles, max_chars=LEGAL_CONTEXT_MAX_CHARS):
+    """Texto de los artículos con su cita (documento, Título, Capítulo, página), acotado a max_chars."""
+    parts, used = [], 0
+    for article in articles:
+        citation = " / ".join(filter(None, [CORPUS_DOCUMENTS[article['doc_id']][1], article['titulo'], article['capitulo']]))
+        part = f"[{citation}, pág. {article['page']}]\n{article['text']}"
+        if used + len(part) > max_chars:
+            parts.append(part[:max(max_chars - used, 0)].rstrip() + " …")
+            break
+        parts.append(part)
+        used += len(part)
+    return "\n\n".join(parts)
+
+
+# --------------------------------------------------------------------------
+# G. PAQUETES DE CONTEXTO POR ÁREA (precalculados en el despliegue)
+# --------------------------------------------------------------------------
+
+def normalize_area_key(area):
+    """Clave normalizada de un área (sin acentos, sin puntos, en mayúsculas)."""
+    return re.sub(r'\s+', ' ', unidecode(str(area).strip()).replace('.', '').upper())
+
+
+def _area_match_keys(area_key):
+    """Claves con las que se buscan las actividades de un área (SIPINNA se agrupa por su sigla)."""
+    keys = [area_key]
+    if "SIPINNA" in area_key:
+        keys.append('SIPINNA')
+    return keys
+
+
+def _bundle_sources():
+    """Tamaño y mtime de los archivos fuente de los paquetes (para detectar si están desactualizados)."""
+    sources = {}
+    for path in (ACTIVIDADES_FILE, REGLAMENTO_FILE, LEY_ORGANICA_FILE):
+        try:
+            stat = os.stat(path)
+            sources[path] = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            sources[path] = None
+    return sources
+
+
+def build_area_bundles():
+    """
+    Precalcula, para cada Área del CSV, sus actividades normalizadas y los artículos del Reglamento
+    Interior / Ley Orgánica que la rigen (índice normativo estructurado). Lo usa el paso de despliegue `python chatbot.py build-bundles`.
+    """
+    bundles = {'version': AREA_BUNDLES_VERSION, 'sources': _bundle_sources(), 'error': None, 'articles': [], 'areas': {}}
+    if not os.path.exists(ACTIVIDADES_FILE):
+        bundles['error'] = f"ADVERTENCIA: Archivo de actividades no encontrado."
+        return bundles
+    try:
+        df_actividades = pd.read_csv(ACTIVIDADES_FILE, encoding='utf-8')
+        df_actividades.columns = df_actividades.columns.str.lower()
+    except Exception as e:
+        bundles['error'] = f"Error al procesar el archivo de actividades: {e}"
+        return bundles
+    if 'area' not in df_actividades.columns or 'actividad' not in df_actividades.columns:
+        bundles['error'] = f"ADVERTENCIA: Archivo de actividades cargado, pero faltan columnas 'area' o 'actividad'."
+        return bundles
+
+
+    # Actividades por área (en el orden del CSV, sin espacios repetidos ni duplicados)
+    activities_by_area, area_names = {}, {}
+    for area, actividad in zip(df_actividades['area'].astype(str), df_actividades['actividad'].astype(str)):
+        area_key = normalize_area_key(area)
+        area_names.setdefault(area_key, area.strip())
+        actividad = re.sub(r'\s+', ' ', actividad).strip()
+        area_list = activities_by_area.setdefault(area_key, [])
+        if actividad and actividad not in area_list:
+            area_list.append(actividad)
+
+    article_positions = {} # id en el índice normativo -> posición en bundles['articles']
+    for area_key, area_name in area_names.items():
+        bundles['areas'][area_key] = {
+            'area': area_name,
+            # Igual que la búsqueda original: el área incluye a sus sub-áreas ("TESORERÍA MUNICIPAL - INGRESOS")
+            'actividades': [
+                actividad
+                for other_key, actividades in activities_by_area.items()
+                if any(key in other_key for key in _area_match_keys(area_key))
+                for actividad in actividades
+            ],
+            # Referencias a bundles['articles'] (cada artículo se guarda una sola vez)
+            'reglamento_articulos': [],
+        }
+        try:
+            articles = legal_articles_for_area(area_name)
+        except Exception:
+            articles = [] # Sin índice normativo, los paquetes sólo llevan actividades
+        for article in articles:
+            if article['id'] not in article_positions:
+                article_positions[article['id']] = len(bundles['articles'])
+                bundles['articles'].append({key: article[key] for key in ('doc_id', 'titulo', 'capitulo', 'article', 'page', 'text')})
+            bundles['areas'][area_key]['reglamento_articulos'].append(article_positions[article['id']])
+    return bundles
+
+
+def save_area_bundles(bundles):
+    """Guarda los paquetes en un único archivo compacto (JSON comprimido)."""
+    _write_json_atomic(AREA_BUNDLES_FILE, bundles, compress=True)
+
+
+@st.cache_resource
+def load_area_bundles():
+    """
+    Carga los paquetes UNA vez por proceso. Si no existen (no se corrió el paso de despliegue)
+    o sus fuentes cambiaron, se reconstruyen y se guardan.
+    """
+    try:
+        with gzip.open(AREA_BUNDLES_FILE, 'rt', encoding='utf-8') as f:
+            bundles = json.load(f)
+        if bundles.get('version') == AREA_BUNDLES_VERSION and bundles.get('sources') == _bundle_sources():
+            return bundles
+    except (OSError, ValueError):
+        pass
+    bundles = build_area_bundles()
+    save_area_bundles(bundles)
+    return bundles
+
+
+def get_area_bundle(user_area):
+    """
+    Devuelve el paquete de contexto de la UR con una sola búsqueda por clave.
+    Si la UR del usuario no coincide exactamente con un Área del CSV, se combinan las actividades
+    de las áreas que la contienen (p. ej. una dirección con varias sub-áreas) y los artículos se buscan para
+    la propia UR con el mismo criterio que build_area_bundles (ninguno si el índice normativo no la ubica).
+    """
+    bundles = load_area_bundles()
+    if bundles.get('error'):
+        return {'error': bundles['error'], 'actividades': [], 'reglamento_articulos': []}
+    area_key = normalize_area_key(user_area)
+    bundle = bundles['areas'].get(area_key)
+    if bundle:
+        return {
+            'area': bundle['area'],
+            'actividades': bundle['actividades'],
+            'reglamento_articulos': [bundles['articles'][i] for i in bundle['reglamento_articulos']],
+        }
+
+    match_keys = _area_match_keys(area_key)
+    matching = [b for key, b in bundles['areas'].items() if any(k in key for k in match_keys)]
+    actividades = []
+    for b in matching:
+        actividades.extend(a for a in b['actividades'] if a not in actividades)
+    try:
+        articles = legal_articles_for_area(user_area)
+    except Exception:
+        articles = [] # Sin índice normativo, igual que en build_area_bundles
+    return {
+        'area': user_area,
+        'actividades': actividades,
+        'reglamento_articulos': [
+            {key: article[key] for key in ('doc_id', 'titulo', 'capitulo', 'article', 'page', 'text')} for article in articles
+        ],
+    }
+
+
+# --------------------------------------------------------------------------
+# F. RECUPERACIÓN INDEXADA (Fragmentos por página/artículo + BM25 + índice semántico)
+# --------------------------------------------------------------------------
+
+ARTICLE_HEADING_RE = re.compile(r'^\s*ART[IÍ]CULO\s+\d+', re.IGNORECASE)
+
+# Palabras vacías en español (ya normalizadas sin acentos) que no aportan a la búsqueda
+SPANISH_STOPWORDS = frozenset("""
+a al algo algunas algunos ante antes como con contra cual cuando de del desde donde durante e el ella ellas
+ellos en entre era es esa esas ese eso esos esta estas este esto estos fue fueron ha han hasta hay la las le
+les lo los mas me mi mis muy no nos o otra otras otro otros para pero por porque que quien se sea ser si sin
+sobre su sus tambien te tiene tienen todo todos tu un una unas uno unos y ya
+""".split())
+
+
+def tokenize_es(text):
+    """Normaliza (unidecode, minúsculas) y separa en términos, quitando palabras vacías y plurales simples."""
+    tokens = []
+    for token in re.findall(r'[a-z0-9]+', unidecode(text).lower()):
+        if token in SPANISH_STOPWORDS or (len(token) < 3 and not token.isdigit()):
+            continue
+        # Stemming mínimo: "servicios" -> "servicio", "acciones" -> "accion"
+        if len(token) > 5 and token.endswith('es') and token[-3] in 'nlrd':
+            token = token[:-2]
+        elif len(token) > 4 and token.endswith('s'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def chunk_document(doc_id, pages, max_chars=RAG_CHUNK_MAX_CHARS):
+    """
+    Divide un documento en fragmentos respetando páginas y artículos.
+    Cada 'Artículo N' inicia un fragmento nuevo; los textos largos se cortan por líneas en bloques de max_chars.
+    Devuelve una lista de dicts {'doc_id', 'page', 'article', 'text'} (page empieza en 1).
+    """
+    chunks = []
+    buffer, buffer_page, current_article = [], None, None
+    buffer_len = 0
+
+    def flush():
+        text = "\n".join(buffer).strip()
+        if text:
+            chunks.append({'doc_id': doc_id, 'page': buffer_page, 'article': current_article, 'text': text})
+
+    for page_number, page_text in enumerate(pages, start=1):
+        for line in page_text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            heading = ARTICLE_HEADING_RE.match(line)
+            if heading or buffer_len + len(line) > max_chars:
+                flush()
+                buffer, buffer_page, buffer_len = [], None, 0
+                if heading:
+                    current_article = heading.group(0).strip().capitalize()
+            if buffer_page is None:
+                buffer_page = page_number
+            buffer.append(line)
+            buffer_len += len(line) + 1
+    flush()
+    return chunks
+
+
+class BM25Index:
+    """Índice léxico BM25 (Okapi) en memoria sobre una lista de fragmentos."""
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1, self.b = k1, b
+        self.postings = {} # término -> [(índice del fragmento, frecuencia)]
+        self.lengths = []
+        for idx, chunk in enumerate(chunks):
+            tokens = tokenize_es(chunk['text'])
+            self.lengths.append(len(tokens))
+            term_freqs = {}
+            for token in tokens:
+                term_freqs[token] = term_freqs.get(token, 0) + 1
+            for token, freq in term_freqs.items():
+                self.postings.setdefault(token, []).append((idx, freq))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        total = len(chunks)
+        self.idf = {
+            term: math.log(1 + (total - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in self.postings.items()
+        }
+
+    def score(self, query):
+        """Devuelve {índice del fragmento: puntaje BM25} para los fragmentos que comparten términos con la consulta."""
+        scores = {}
+        for term in set(tokenize_es(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for idx, freq in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[idx] / self.avg_length)
+                scores[idx] = scores.get(idx, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        return scores
+
+    def rank(self, query, doc_ids=None):
+        """Devuelve [(puntaje, índice)] ordenado de mayor a menor, filtrando por documento si se indica."""
+        return sorted(
+            ((score, idx) for idx, score in self.score(query).items()
+             if doc_ids is None or self.chunks[idx]['doc_id'] in doc_ids),
+            reverse=True,
+        )
+
+    def search(self, query, k=RAG_TOP_K, doc_ids=None, per_doc_min=0):
+        """Devuelve los k fragmentos más relevantes como [(puntaje, fragmento)]."""
+        return select_chunks(self.rank(query, doc_ids), self.chunks, k, per_doc_min)
+
+
+def select_chunks(ranked, chunks, k=RAG_TOP_K, per_doc_min=0):
+    """
+    Selecciona k fragmentos de una lista ordenada [(puntaje, índice)].
+    Con per_doc_min > 0 se garantiza esa cantidad de fragmentos por documento con coincidencias.
+    """
+    selected, per_doc = [], {}
+    if per_doc_min:
+        for score, idx in ranked:
+            doc_id = chunks[idx]['doc_id']
+            if per_doc.get(doc_id, 0) < per_doc_min:
+                per_doc[doc_id] = per_doc.get(doc_id, 0) + 1
+                selected.append((score, idx))
+    chosen = {idx for _, idx in selected}
+    for score, idx in ranked:
+        if len(selected) >= k:
+            break
+        if idx not in chosen:
+            selected.append((score, idx))
+            chosen.add(idx)
+    selected.sort(reverse=True)
+    return [(score, chunks[idx]) for score, idx in selected]
+
+
+def _hash_bucket(token):
+    """Cubeta estable (independiente de PYTHONHASHSEED) para el hashing de términos."""
+    return zlib.crc32(token.encode('utf-8')) % VECTOR_HASH_BUCKETS
+
+
+def _hashed_term_vector(text):
+    """Vector disperso {cubeta: 1 + log(tf)} de unigramas y bigramas normalizados."""
+    tokens = tokenize_es(text)
+    counts = {}
+    for term in tokens + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]:
+        bucket = _hash_bucket(term)
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return {bucket: 1.0 + math.log(tf) for bucket, tf in counts.items()}
+
+
+class VectorIndex:
+    """
+    Índice semántico local, sin red ni GPU: TF-IDF con hashing reducido por LSA (SVD truncada).
+    La matriz de fragmentos (N x VECTOR_DIM, normalizada) se guarda en .npy y se abre con mmap.
+    La similitud coseno de una consulta es un único producto matriz-vector.
+    """
+
+    def __init__(self, matrix, projection, idf, chunks):
+        self.matrix = matrix
+        self.projection = projection
+        self.idf = idf
+        self.chunks = chunks
+        self.doc_ids = np.array([chunk['doc_id'] for chunk in chunks])
+
+    @staticmethod
+    def corpus_key(chunks):
+        """Hash del contenido indexado y de los parámetros: si algo cambia, se reconstruye el índice."""
+        digest = hashlib.sha256(f"{VECTOR_INDEX_VERSION}:{VECTOR_HASH_BUCKETS}:{VECTOR_DIM}".encode())
+        for chunk in chunks:
+            digest.update(chunk['doc_id'].encode('utf-8'))
+            digest.update(chunk['text'].encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def build(cls, chunks, directory):
+        """Calcula TF-IDF + SVD y guarda las matrices en el directorio indicado."""
+        tf = np.zeros((len(chunks), VECTOR_HASH_BUCKETS), dtype=np.float32)
+        for row, chunk in enumerate(chunks):
+            for bucket, weight in _hashed_term_vector(chunk['text']).items():
+                tf[row, bucket] = weight
+        doc_freq = np.count_nonzero(tf, axis=0)
+        idf = (np.log((1 + len(chunks)) / (1 + doc_freq)) + 1).astype(np.float32)
+        tfidf = tf * idf
+        tfidf /= np.maximum(np.linalg.norm(tfidf, axis=1, keepdims=True), 1e-9)
+
+        _, _, vt = np.linalg.svd(tfidf, full_matrices=False)
+        projection = np.ascontiguousarray(vt[:VECTOR_DIM].T, dtype=np.float32) # buckets x dim
+        matrix = tfidf @ projection
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-9)
+
+        os.makedirs(directory, exist_ok=True)
+        for name, array in (("matrix", matrix), ("projection", projection), ("idf", idf)):
+            tmp_path = _unique_tmp_path(os.path.join(directory, name), ".tmp.npy")
+            np.save(tmp_path, array.astype(np.float32))
+            os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+        return cls.load(chunks, directory)
+
+    @classmethod
+    def load(cls, chunks, directory):
+        """Abre las matrices guardadas (la de fragmentos con mmap, sin copiarla a memoria)."""
+        matrix = np.load(os.path.join(directory, "matrix.npy"), mmap_mode='r')
+        if matrix.shape[0] != len(chunks):
+            raise ValueError("El índice vectorial no corresponde a los fragmentos actuales.")
+        projection = np.load(os.path.join(directory, "projection.npy"))
+        idf = np.load(os.path.join(directory, "idf.npy"))
+        return cls(matrix, projection, idf, chunks)
+
+    def embed(self, text):
+        """Proyecta un texto al espacio LSA (vector normalizado de VECTOR_DIM)."""
+        vector = np.zeros(self.projection.shape[1], dtype=np.float32)
+        for bucket, weight in _hashed_term_vector(text).items():
+            vector += (weight * self.idf[bucket]) * self.projection[bucket]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def rank(self, query, doc_ids=None, top=50):
+        """Devuelve [(similitud coseno, índice)] de los fragmentos más cercanos a la consulta."""
+        scores = self.matrix @ self.embed(query)
+        if doc_ids is not None:
+            scores = np.where(np.isin(self.doc_ids, list(doc_ids)), scores, -1.0)
+        top = min(top, len(scores))
+        if top == 0:
+            return []
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[idx]), int(idx)) for idx in best if scores[idx] > 0]
+
+
+@st.cache_resource(show_spinner="Indexando la base de conocimiento...")
+def load_retrieval_index():
+    """Construye UNA vez por proceso los fragmentos y el índice BM25 del corpus compartido."""
+    chunks = []
+    for doc_id, document in load_corpus().items():
+        if not document['error']:
+            chunks.extend(chunk_document(doc_id, document['pages']))
+    return BM25Index(chunks)
+
+
+@st.cache_resource(show_spinner="Preparando el índice semántico...")
+def load_vector_index():
+    """
+    Abre (o construye la primera vez) el índice semántico de los mismos fragmentos que el índice BM25.
+    Las matrices se guardan en disco por hash del contenido, así que sobreviven a reinicios del proceso.
+    """
+    chunks = load_retrieval_index().chunks
+    directory = os.path.join(VECTOR_INDEX_DIR, VectorIndex.corpus_key(chunks))
+    try:
+        return VectorIndex.load(chunks, directory)
+    except (OSError, ValueError):
+        index = VectorIndex.build(chunks, directory)
+        prune_vector_indexes(keep=directory)
+        return index
+
+
+def prune_vector_indexes(keep):
+    """
+    Borra los índices vectoriales de versiones anteriores del corpus (cada cambio crea un directorio nuevo).
+    Sólo se llama tras construir el vigente; un proceso que aún tenga abierto uno viejo con mmap no se ve afectado.
+    """
+    try:
+        names = os.listdir(VECTOR_INDEX_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(VECTOR_INDEX_DIR, name)
+        if os.path.isdir(path) and os.path.normpath(path) != os.path.normpath(keep):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def hybrid_rank(query, doc_ids=None, rrf_k=60):
+    """Fusiona los rankings léxico (BM25) y semántico (LSA) con Reciprocal Rank Fusion."""
+    rankings = [load_retrieval_index().rank(query, doc_ids)]
+    if np is not None:
+        rankings.append(load_vector_index().rank(query, doc_ids))
+    return fuse_rankings(rankings, rrf_k)
+
+
+def fuse_rankings(rankings, rrf_k=60):
+    """
+    Reciprocal Rank Fusion de varias listas [(puntaje, índice)] ya ordenadas: sólo cuenta la posición de cada
+    fragmento en cada lista, así que no hace falta normalizar puntajes de escalas distintas.
+    """
+    fused = {}
+    for ranking in rankings:
+        for position, (_, idx) in enumerate(ranking):
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (rrf_k + position + 1)
+    return sorted(((score, idx) for idx, score in fused.items()), reverse=True)
+
+
+def format_chunk_header(chunk):
+    """Encabezado de un fragmento RAG (documento, página y artículo si aplica)."""
+    if chunk['doc_id'] in CORPUS_DOCUMENTS:
+        label = CORPUS_DOCUMENTS[chunk['doc_id']][1]
+    elif chunk.get('doc_name'):
+        label = f"DOCUMENTO PERSONALIZADO: {chunk['doc_name']}"
+    else:
+        label = chunk['doc_id']
+    location = f"pág. {chunk['page']}"
+    if chunk.get('article'):
+        location += f", {chunk['article']}"
+    return f"--- CONTEXTO RAG ({label}, {location}) ---"
+
+
+def retrieve_chunks(query, doc_ids=None, k=RAG_TOP_K):
+    """
+    Recupera los fragmentos del corpus más relevantes para la consulta, de mayor a menor relevancia
+    (el presupuesto de contexto descarta primero los del final).
+    """
+    return [chunk for _, chunk in select_chunks(hybrid_rank(query, doc_ids), load_retrieval_index().chunks, k, RAG_PER_DOC_MIN)]
+
+
+def format_corpus_chunks(chunks, texts=None):
+    """
+    Formatea los fragmentos para el prompt, agrupados por documento y en orden de página para que la lectura sea coherente.
+    texts permite sustituir el texto de cada fragmento (p. ej. ya recortado por el presupuesto de contexto).
+    """
+    texts = texts if texts is not None else [f"\n\n{format_chunk_header(chunk)}\n{chunk['text']}" for chunk in chunks]
+    doc_order = {doc_id: position for position, doc_id in enumerate(CORPUS_DOCUMENTS)}
+    order = sorted(range(len(texts)), key=lambda i: (doc_order.get(chunks[i]['doc_id'], len(doc_order)), chunks[i]['page']))
+    return "".join(texts[i] for i in order)
+
+
+class CustomDocument:
+    """
+    Documento subido por un usuario, identificado por el hash de su contenido.
+    Se extrae y fragmenta una sola vez (en segundo plano); las sesiones que lo suben comparten el mismo objeto.
+    """
+
+    def __init__(self, content_hash, file_name):
+        self.content_hash = content_hash
+        self.file_name = file_name
+        self.doc_id = f"custom:{content_hash[:12]}"
+        self.pages_done = 0
+        self.pages_total = 0
+        self.chunks = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def progress(self):
+        """Avance de la extracción entre 0 y 1 (por páginas en PDFs)."""
+        if self.done.is_set():
+            return 1.0
+        return self.pages_done / self.pages_total if self.pages_total else 0.0
+
+    def ingest(self, data):
+        """Extrae el texto y lo divide en fragmentos con el mismo esquema que el corpus (se ejecuta en el trabajador)."""
+        try:
+            if self.file_name.lower().endswith('.pdf'):
+                if not pypdf:
+                    raise RuntimeError("Librería 'pypdf' no instalada.")
+                reader = pypdf.PdfReader(io.BytesIO(data))
+                self.pages_total = len(reader.pages)
+                pages = []
+                for page in reader.pages:
+                    pages.append(page.extract_text() or "")
+                    self.pages_done += 1
+            else: # Asumir .txt
+                pages = [data.decode('utf-8')]
+            if sum(len(page.strip()) for page in pages) <= CUSTOM_DOC_MIN_CHARS:
+                raise ValueError("el documento no tiene texto suficiente")
+            chunks = chunk_document(self.doc_id, pages)
+            for chunk in chunks:
+                chunk['doc_name'] = self.file_name
+            self.chunks = chunks
+        except Exception as e:
+            self.error = f"Error al procesar el archivo: {e}"
+        finally:
+            self.done.set()
+
+
+class CustomDocumentIngestor:
+    """
+    Trabajador en segundo plano para los documentos personalizados: un PDF grande nunca bloquea el chat
+    y el mismo contenido (aunque se vuelva a subir o cambie de nombre) no se vuelve a procesar.
+    Guarda los últimos CUSTOM_DOC_CACHE_MAX documentos para deduplicar; las sesiones conservan sus propias referencias.
+    """
+
+    def __init__(self, workers=CUSTOM_DOC_INGEST_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="progob-ingest")
+        self.documents = collections.OrderedDict() # hash -> CustomDocument
+        self.lock = threading.Lock()
+
+    def submit(self, file_name, data):
+        """Devuelve el CustomDocument de ese contenido, encolando la extracción sólo si es nuevo (o si falló)."""
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            document = self.documents.get(content_hash)
+            if document is None or document.error:
+                document = CustomDocument(content_hash, file_name)
+                self.documents[content_hash] = document
+                self.pool.submit(document.ingest, data)
+            self.documents.move_to_end(content_hash)
+            while len(self.documents) > CUSTOM_DOC_CACHE_MAX:
+                self.documents.popitem(last=False)
+        return document
+
+
+@st.cache_resource
+def get_custom_document_ingestor():
+    """Trabajador de ingesta de documentos personalizados, único por proceso."""
+    return CustomDocumentIngestor()
+
+
+def add_custom_document(uploaded_file):
+    """
+    Registra en la sesión un archivo del uploader. El archivo sigue en el uploader en cada rerun,
+    así que se identifica por su file_id para no volver a leerlo ni calcular su hash.
+    """
+    uploads = st.session_state.setdefault('custom_doc_uploads', {}) # file_id -> hash
+    if uploaded_file.file_id in uploads:
+        return
+    document = get_custom_document_ingestor().submit(uploaded_file.name, uploaded_file.getvalue())
+    uploads[uploaded_file.file_id] = document.content_hash
+    session_docs = st.session_state.setdefault('custom_docs', {})
+    previous = session_docs.get(document.content_hash)
+    if previous is None or (previous.error and previous is not document):
+        # Un documento que falló puede volver a subirse: se reintenta y se vuelve a avisar el resultado
+        session_docs[document.content_hash] = document
+        st.session_state.setdefault('custom_docs_announced', set()).discard(document.content_hash)
+
+
+def pending_custom_documents():
+    """Documentos personalizados de la sesión que el trabajador aún está procesando."""
+    return [doc for doc in st.session_state.get('custom_docs', {}).values() if not doc.done.is_set()]
+
+
+def get_custom_docs_index():
+    """
+    Índice BM25 de la sesión con los fragmentos de sus documentos personalizados ya procesados.
+    Se reconstruye sólo cuando cambia el conjunto de documentos (no en cada rerun ni en cada consulta).
+    """
+    documents = [doc for doc in st.session_state.get('custom_docs', {}).values() if doc.done.is_set() and doc.chunks]
+    key = tuple(doc.content_hash for doc in documents)
+    cached = st.session_state.get('custom_docs_index')
+    if cached is None or cached[0] != key:
+        cached = (key, BM25Index([chunk for doc in documents for chunk in doc.chunks]) if documents else None)
+        st.session_state['custom_docs_index'] = cached
+    return cached[1]
+
+
+def retrieve_custom_chunks(query, k=RAG_CUSTOM_TOP_K):
+    """Fragmentos de los documentos personalizados de la sesión más relevantes para la consulta."""
+    index = get_custom_docs_index()
+    if index is None:
+        return []
+    return [chunk for _, chunk in index.search(query, k, per_doc_min=RAG_PER_DOC_MIN)]
+
+
+@st.cache_resource
+def get_http_session():
+    """
+    Sesión HTTP única por proceso (thread-safe) con pool de conexiones keep-alive hacia la API.
+    Evita un handshake TCP+TLS nuevo en cada turno; las sesiones de Streamlit la comparten.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, # Un solo host (la API del modelo)
+        pool_maxsize=LLM_POOL_SIZE,
+        pool_block=True, # Si el pool está lleno se espera una conexión libre en vez de abrir otra
+        max_retries=0,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def estimate_tokens(text):
+    """
+    Estimación local (sin llamar a la API) de los tokens de un texto.
+    Es deliberadamente conservadora: sobreestimar sólo recorta un poco más de contexto; subestimar provoca el error 400.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def allocate_context_budget(sections, budget_tokens):
+    """
+    Reparte el presupuesto de tokens del prompt entre las fuentes de contexto.
+    sections es una lista de dicts {'name', 'priority', 'parts'}: priority 0 nunca se recorta; a mayor número,
+    menor prioridad. Se recorta de forma determinista empezando por la fuente de menor prioridad y, dentro de
+    ella, por su última parte (las partes deben venir ordenadas de más a menos importante). Sólo la última
+    parte conservada puede quedar truncada, en un salto de línea (o en un espacio).
+    Devuelve (secciones_recortadas, reporte), donde el reporte indica por fuente los tokens solicitados y enviados.
+    """
+    allocated = [dict(section, parts=list(section['parts'])) for section in sections]
+    requested = {section['name']: sum(estimate_tokens(part) for part in section['parts']) for section in sections}
+    excess = sum(requested.values()) - budget_tokens
+
+    trimmable = [section for section in allocated if section['priority'] > 0]
+    # sorted es estable: a igual prioridad se recorta primero la fuente declarada al final
+    for section in sorted(reversed(trimmable), key=lambda section: -section['priority']):
+        while excess > 0 and section['parts']:
+            last = section['parts'][-1]
+            cost = estimate_tokens(last)
+            limit = int((cost - excess) * CHARS_PER_TOKEN) - len(CONTEXT_TRUNCATION_MARK)
+            if limit <= 0:
+                # No cabe nada de esta parte (ni la marca de recorte): se descarta completa de una vez
+                section['parts'].pop()
+                excess -= cost
+                continue
+            # Se corta en el último salto de línea que cabe (o espacio, si el texto no tiene saltos)
+            cut = max(last.rfind("\n", 0, limit), 0) or max(last.rfind(" ", 0, limit), 0)
+            truncated = last[:cut] + CONTEXT_TRUNCATION_MARK if cut > 0 else ""
+            if truncated.strip() and estimate_tokens(truncated) < cost:
+                section['parts'][-1] = truncated
+                excess -= cost - estimate_tokens(truncated)
+            else:
+                section['parts'].pop()
+                excess -= cost
+        if excess <= 0:
+            break
+
+    report = {
+        'budget_tokens': budget_tokens,
+        'sources': [
+            {
+                'name': section['name'],
+                'requested_tokens': requested[section['name']],
+                'sent_tokens': sum(estimate_tokens(part) for part in section['parts']),
+                'parts_sent': len(section['parts']),
+                'parts_requested': len(original['parts']),
+            }
+            for section, original in zip(allocated, sections)
+        ],
+    }
+    report['sent_tokens'] = sum(source['sent_tokens'] for source in report['sources'])
+    report['trimmed'] = report['sent_tokens'] < sum(requested.values())
+    return allocated, report
+
+
+def build_llm_messages(system_prompt, corpus_context, area_context, user_query, memory_context=""):
+    """
+    Arma los mensajes en un orden determinista que maximiza la caché de prefijos del proveedor:
+    1) persona estática (idéntica byte a byte para todas las UR), 2) fragmentos del corpus compartido,
+    3) contexto propio de la UR (resumen, actividades, documentos personalizados), 4) memoria acotada de la
+    conversación, 5) instrucciones de fase. Lo más estable va primero; lo que cambia en cada turno, al final.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if corpus_context:
+        messages.append({"role": "system", "content": f"# BASE DE CONOCIMIENTO (RAG){corpus_context}"})
+    messages.append({"role": "system", "content": f"# CONTEXTO DE LA UNIDAD RESPONSABLE\n{area_context}"})
+    if memory_context:
+        messages.append({"role": "system", "content": f"# MEMORIA DE LA ASESORÍA\n{memory_context}"})
+    messages.append({"role": "user", "content": user_query})
+    return messages
+
+
+class LLMMetrics:
+    """Contadores de uso de la API compartidos por el proceso (tokens en caché vs. sin caché)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.hedges = 0
+        self.speculative_hits = 0
+        self.speculative_misses = 0
+        self.local_validations = 0
+        self.local_rejections = 0
+        self.latencies = collections.deque(maxlen=LLM_LATENCY_WINDOW)
+
+    def record_latency(self, seconds):
+        """Latencia hasta recibir los encabezados de la respuesta (base del umbral de hedging)."""
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def latency_percentile(self, percentile):
+        """Percentil de las latencias recientes, o None si aún no hay suficientes mediciones."""
+        with self._lock:
+            if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedges += 1
+
+    def record_speculation(self, hit):
+        """Resultado de una ronda de respuestas especulativas (se eligió o no una opción precalculada)."""
+        with self._lock:
+            if hit:
+                self.speculative_hits += 1
+            else:
+                self.speculative_misses += 1
+
+    def record_local_validation(self, blocked):
+        """Borrador revisado con las reglas locales; blocked=True si se respondió sin llamar al modelo."""
+        with self._lock:
+            self.local_validations += 1
+            if blocked:
+                self.local_rejections += 1
+
+    def record_usage(self, usage):
+        """Acumula el campo 'usage' de una respuesta (formato DeepSeek u OpenAI)."""
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        cached = usage.get('prompt_cache_hit_tokens') # DeepSeek
+        if cached is None:
+            cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0) # OpenAI
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_prompt_tokens += cached or 0
+            self.completion_tokens += usage.get('completion_tokens', 0)
+
+    def snapshot(self):
+        """Copia consistente de los contadores para mostrarlos en el panel de administración."""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'prompt_tokens': self.prompt_tokens,
+                'cached_prompt_tokens': self.cached_prompt_tokens,
+                'uncached_prompt_tokens': self.prompt_tokens - self.cached_prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'retries': self.retries,
+                'hedges': self.hedges,
+                'speculative_hits': self.speculative_hits,
+                'speculative_misses': self.speculative_misses,
+                'local_validations': self.local_validations,
+                'local_rejections': self.local_rejections,
+            }
+
+
+@st.cache_resource
+def get_llm_metrics():
+    """Instancia única de métricas de uso de la API por proceso."""
+    return LLMMetrics()
+
+
+class ResponseCache:
+    """
+    Caché persistente de respuestas en SQLite con TTL y expulsión LRU.
+    Cada operación abre su propia conexión, así que puede usarse desde cualquier hilo de Streamlit.
+    """
+
+    def __init__(self, path, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT, created REAL, last_access REAL, content TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def make_key(payload):
+        """Hash de lo que determina la respuesta: mensajes finales, modelo y temperatura."""
+        material = json.dumps(
+            {'messages': payload['messages'], 'model': payload['model'], 'temperature': payload.get('temperature')},
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Devuelve la respuesta guardada (y actualiza su último acceso) o None si no existe o expiró."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT content FROM responses WHERE key = ? AND created >= ?", (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def put(self, key, model, content):
+        """Guarda una respuesta y expulsa las entradas expiradas o menos usadas recientemente."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, created, last_access, content) VALUES (?, ?, ?, ?, ?)",
+                (key, model, now, now, content),
+            )
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM responses WHERE key NOT IN"
+                " (SELECT key FROM responses ORDER BY last_access DESC LIMIT ?)", (self.max_entries,)
+            )
+
+    def clear(self):
+        """Invalida toda la caché (control del panel de administración)."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def count(self):
+        """Número de respuestas guardadas."""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+@st.cache_resource
+def get_response_cache():
+    """Caché de respuestas compartida por el proceso."""
+    return ResponseCache(RESPONSE_CACHE_FILE)
+
+
+class LLMError(str):
+    """
+    Texto de error destinado al usuario dentro del flujo de la respuesta. Al ser un str se pinta igual que
+    cualquier token, pero permite distinguir una falla de una respuesta del modelo (ver commit_on_success).
+    """
+
+
+class CircuitBreaker:
+    """
+    Corta las llamadas mientras el proveedor está caído: tras LLM_BREAKER_FAILURE_THRESHOLD fallas seguidas se abre
+    y responde de inmediato durante LLM_BREAKER_RESET_SECONDS; después deja pasar una sola solicitud de prueba
+    (semiabierto) y se cierra si ésta tiene éxito.
+    """
+
+    def __init__(self, failure_threshold=LLM_BREAKER_FAILURE_THRESHOLD, reset_seconds=LLM_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.times_opened = 0
+
+    def allow(self):
+        """¿Puede salir una solicitud? En estado semiabierto sólo se autoriza una a la vez."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probe_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    self.times_opened += 1
+                self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def retry_in(self):
+        """Segundos para el siguiente intento de prueba (0 si está cerrado)."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "cerrado"
+            return "semiabierto" if time.monotonic() - self.opened_at >= self.reset_seconds else "abierto"
+
+
+@st.cache_resource
+def get_circuit_breaker():
+    """Circuit breaker hacia el proveedor, compartido por el proceso."""
+    return CircuitBreaker()
+
+
+_JOB_DONE = object() # Marca de fin en la cola de tokens de un trabajo
+
+
+class LLMRateLimited(Exception):
+    """El proveedor respondió 429: la solicitud se reencola en lugar de mostrar un error al usuario."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"429 Too Many Requests (reintentar en {retry_after:.0f} s)")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Cubeta de tokens: capacidad máxima y recarga continua (unidades por segundo). No es thread-safe por sí sola."""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.available = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """Segundos que faltan para poder consumir amount (0 si ya se puede)."""
+        self._refill()
+        amount = min(amount, self.capacity) # Una solicitud mayor que la capacidad espera a la cubeta llena
+        return max(0.0, (amount - self.available) / self.refill_per_second)
+
+    def consume(self, amount):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+
+class LLMRateLimiter:
+    """Límite global del proceso hacia el proveedor: solicitudes por minuto y tokens por minuto."""
+
+    def __init__(self, requests_per_minute=LLM_RATE_LIMIT_RPM, tokens_per_minute=LLM_RATE_LIMIT_TPM):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.paused_until = 0.0 # Pausa impuesta por un 429 (Retry-After)
+
+    def wait_time(self, cost_tokens):
+        return max(self.requests.wait_time(1), self.tokens.wait_time(cost_tokens), self.paused_until - time.monotonic(), 0.0)
+
+    def consume(self, cost_tokens):
+        self.requests.consume(1)
+        self.tokens.consume(cost_tokens)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class LLMJob:
+    """
+    Una solicitud al modelo en el servicio de ejecución. El hilo trabajador deposita los tokens en una cola;
+    la sesión los consume con stream(). Si el consumidor se detiene (rerun o salida del usuario), se cancela.
+    """
+
+    def __init__(self, session_key, user_key, produce, cost_tokens):
+        self.session_key = session_key
+        self.user_key = user_key
+        self.produce = produce
+        self.cost_tokens = cost_tokens
+        self.tokens = queue.Queue()
+        self.cancelled = threading.Event()
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.submitted_at = time.monotonic()
+        self.requeues = 0
+        self.executor = None
+
+    @classmethod
+    def finished(cls, text):
+        """Trabajo ya resuelto sin llamar a la API (respuesta en caché o error previo al envío)."""
+        job = cls(None, None, None, 0)
+        job.finish(text)
+        return job
+
+    def cancel(self):
+        """Pide al trabajador que deje de leer la respuesta (cierra la conexión en el siguiente token)."""
+        if not self.done.is_set():
+            self.cancelled.set()
+            if self.executor:
+                self.executor.wake()
+
+    def finish(self, message=None):
+        """Cierra el trabajo sin (más) respuesta del modelo, opcionalmente con un aviso para el usuario."""
+        if message:
+            self.tokens.put(message)
+        self.done.set()
+        self.tokens.put(_JOB_DONE)
+
+    def stream(self, on_wait=None):
+        """
+        Generador para st.write_stream. Al cerrarse antes de terminar (rerun de Streamlit), cancela el trabajo.
+        Mientras el trabajo espera turno, llama on_wait({'position', 'eta_seconds'}) cada LLM_QUEUE_POLL_SECONDS;
+        al empezar a llegar la respuesta llama on_wait(None).
+        """
+        waiting = False
+        try:
+            while True:
+                try:
+                    token = self.tokens.get(timeout=LLM_QUEUE_POLL_SECONDS if on_wait else None)
+                except queue.Empty:
+                    status = self.executor.queue_status(self) if self.executor else None
+                    if status:
+                        waiting = True
+                        on_wait(status)
+                    continue
+                if waiting:
+                    waiting = False
+                    on_wait(None)
+                if token is _JOB_DONE:
+                    return
+                yield token
+        finally:
+            self.cancel()
+
+
+class LLMExecutor:
+    """
+    Servicio de ejecución de llamadas al modelo compartido por el proceso: un pool de hilos con concurrencia
+    acotada, una solicitud activa por sesión (la nueva cancela la anterior) y rechazo cuando la cola se llena.
+    Un despachador admite los trabajos en turno rotativo entre usuarios (cola justa) y sólo cuando el limitador
+    global de solicitudes/tokens por minuto lo permite.
+    """
+
+    def __init__(self, max_workers=LLM_MAX_CONCURRENCY, max_pending=LLM_MAX_PENDING_JOBS, rate_limiter=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.rate_limiter = rate_limiter or LLMRateLimiter()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="progob-llm")
+        self._lock = threading.Condition()
+        self._jobs_by_session = {}
+        self._queues = {} # user_key -> deque de trabajos; el orden de inserción define el turno rotativo
+        self.pending = 0 # En cola, sin hilo asignado
+        self.active = 0 # Con la solicitud en curso
+        self.peak_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.rate_limited = 0 # Respuestas 429 del proveedor (reencoladas)
+        self.total_wait_seconds = 0.0
+        self.avg_job_seconds = LLM_DEFAULT_JOB_SECONDS # Promedio móvil de duración, para estimar la espera
+        threading.Thread(target=self._dispatch_loop, name="progob-llm-dispatcher", daemon=True).start()
+
+    def submit(self, session_key, produce, user_key=None, cost_tokens=0):
+        """
+        Encola produce() (una función que devuelve el generador de texto de la respuesta) y devuelve el LLMJob.
+        cost_tokens es la estimación de tokens de la solicitud (prompt + max_tokens) para el límite por minuto.
+        Si se excede LLM_MAX_PENDING_JOBS, el trabajo nace terminado con un aviso de saturación.
+        """
+        job = LLMJob(session_key, user_key or session_key, produce, cost_tokens)
+        job.executor = self
+        with self._lock:
+            previous = self._jobs_by_session.get(session_key)
+            if previous:
+                previous.cancel()
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                job.finish(LLMError("⚠️ Progob está atendiendo muchas solicitudes en este momento. Intenta de nuevo en unos segundos."))
+                return job
+            self._jobs_by_session[session_key] = job
+            self.submitted += 1
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job, front=False):
+        user_queue = self._queues.setdefault(job.user_key, collections.deque())
+        user_queue.appendleft(job) if front else user_queue.append(job)
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        self._lock.notify_all()
+
+    def wake(self):
+        """Despierta al despachador (p. ej. para retirar un trabajo cancelado de la cola)."""
+        with self._lock:
+            self._lock.notify_all()
+
+    def _dispatch_order(self):
+        """Orden en que se despacharán los trabajos en espera: turno rotativo entre usuarios."""
+        queues = list(self._queues.values())
+        depth = max((len(user_queue) for user_queue in queues), default=0)
+        return [user_queue[i] for i in range(depth) for user_queue in queues if i < len(user_queue)]
+
+    def _pop_next(self):
+        user_key, user_queue = next(iter(self._queues.items()))
+        job = user_queue.popleft()
+        del self._queues[user_key]
+        if user_queue:
+            self._queues[user_key] = user_queue # El usuario pasa al final del turno
+        self.pending -= 1
+        return job
+
+    def _dispatch_loop(self):
+        with self._lock:
+            while True:
+                # Los cancelados mientras esperaban se retiran sin consumir cupo
+                for job in [job for job in self._dispatch_order() if job.cancelled.is_set()]:
+                    self._queues[job.user_key].remove(job)
+                    if not self._queues[job.user_key]:
+                        del self._queues[job.user_key]
+                    self.pending -= 1
+                    self.cancelled += 1
+                    self._forget(job)
+                    job.finish()
+                if not self._queues or self.active >= self.max_workers:
+                    self._lock.wait()
+                    continue
+                head = self._dispatch_order()[0]
+                wait = self.rate_limiter.wait_time(head.cost_tokens)
+                if wait > 0:
+                    self._lock.wait(timeout=wait)
+                    continue
+                job = self._pop_next()
+                self.rate_limiter.consume(job.cost_tokens)
+                self.active += 1
+                self.total_wait_seconds += time.monotonic() - job.submitted_at
+                job.started.set()
+                self._pool.submit(self._run, job)
+
+    def _run(self, job):
+        started_at = time.monotonic()
+        chunks = None
+        requeued = False
+        try:
+            chunks = job.produce()
+            for token in chunks:
+                if job.cancelled.is_set():
+                    break
+                job.tokens.put(token)
+        except LLMRateLimited as e:
+            # El proveedor limitó pese al control local: se pausa el despacho y el trabajo vuelve al frente de su fila
+            with self._lock:
+                self.rate_limited += 1
+                self.rate_limiter.pause(e.retry_after)
+                if job.requeues < LLM_RATE_LIMIT_MAX_REQUEUES and not job.cancelled.is_set():
+                    job.requeues += 1
+                    job.started.clear()
+                    requeued = True
+            if not requeued:
+                job.tokens.put(LLMError("⚠️ El servicio del modelo está saturado en este momento. Intenta de nuevo en unos minutos."))
+        except Exception as e:
+            job.tokens.put(LLMError(f"\n\n❌ Error interno al procesar la respuesta. Detalle: {e}"))
+        finally:
+            if chunks is not None:
+                chunks.close() # Cierra la respuesta HTTP si se canceló a mitad del flujo
+            with self._lock:
+                self.active -= 1
+                if requeued:
+                    self._enqueue(job, front=True)
+                else:
+                    if job.cancelled.is_set():
+                        self.cancelled += 1
+                    else:
+                        self.completed += 1
+                        self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * (time.monotonic() - started_at)
+                    self._forget(job)
+                    self._lock.notify_all()
+            if not requeued:
+                job.finish()
+
+    def _forget(self, job):
+        if self._jobs_by_session.get(job.session_key) is job:
+            del self._jobs_by_session[job.session_key]
+
+    def queue_status(self, job):
+        """Posición en la fila (1 = el siguiente) y espera estimada, o None si el trabajo ya no está en espera."""
+        with self._lock:
+            if job.started.is_set() or job.done.is_set():
+                return None
+            order = self._dispatch_order()
+            if job not in order:
+                return None
+            ahead = order.index(job)
+            # Rondas completas de trabajadores por delante (más la que está en curso si no hay hilos libres)
+            rounds = ahead // self.max_workers + (1 if self.active >= self.max_workers else 0)
+            eta = rounds * self.avg_job_seconds + self.rate_limiter.wait_time(job.cost_tokens)
+            return {'position': ahead + 1, 'eta_seconds': eta}
+
+    def cancel_session(self, session_key):
+        """Cancela la solicitud en curso de una sesión (p. ej. al reiniciar el ciclo con INICIAR DE NUEVO)."""
+        with self._lock:
+            job = self._jobs_by_session.get(session_key)
+        if job:
+            job.cancel()
+
+    def snapshot(self):
+        """Métricas de contrapresión para el panel de administración."""
+        with self._lock:
+            started = self.submitted - self.pending
+            return {
+                'max_workers': self.max_workers,
+                'active': self.active,
+                'pending': self.pending,
+                'peak_pending': self.peak_pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'rejected': self.rejected,
+                'rate_limited': self.rate_limited,
+                'avg_wait_seconds': self.total_wait_seconds / started if started else 0.0,
+                'avg_job_seconds': self.avg_job_seconds,
+            }
+
+
+@st.cache_resource
+def get_llm_executor():
+    """Servicio de ejecución de llamadas al modelo, único por proceso."""
+    return LLMExecutor()
+
+
+def get_llm_session_key():
+    """Identificador estable de la sesión del navegador para el servicio de ejecución."""
+    if 'llm_session_key' not in st.session_state:
+        st.session_state['llm_session_key'] = uuid.uuid4().hex
+    return st.session_state['llm_session_key']
+
+
+def get_llm_response(system_prompt: str, user_query: str, rag_query: str = None, cacheable: bool = False, memory_parts=None, json_output: bool = False):
+    """
+    Función de conexión a la API, leyendo la clave **SÓLO** desde st.secrets e inyectando contexto RAG.
+    El contexto del corpus se recupera por relevancia (BM25) usando rag_query (por defecto, la consulta completa).
+    Con cacheable=True, una solicitud idéntica (mismos mensajes, modelo y temperatura) se sirve desde la caché local.
+    memory_parts es la memoria acotada de la conversación (ver build_conversation_memory).
+    Con json_output=True se pide a la API un objeto JSON (ver structured_phase_stream).
+    Devuelve la respuesta como un generador de texto para el streaming.
+    """
+    job = start_llm_job(system_prompt, user_query, rag_query, cacheable, memory_parts, json_output=json_output)
+    return job.stream(on_wait=queue_notice())
+
+
+def start_llm_job(system_prompt, user_query, rag_query=None, cacheable=False, memory_parts=None, speculative_key=None, json_output=False, max_cost_tokens=None):
+    """
+    Arma el prompt (en el hilo del script: lee st.secrets y st.session_state) y encola la llamada en el servicio
+    de ejecución. Devuelve el LLMJob; si la respuesta sale de la caché o falta la clave, el trabajo ya viene terminado.
+    Con speculative_key, el trabajo se registra bajo esa clave (no cancela la solicitud en curso de la sesión)
+    y no actualiza el reporte de presupuesto que ve el usuario.
+    Con max_cost_tokens, si el costo estimado (prompt + max_tokens) lo excede no se encola nada y devuelve None.
+    """
+    try:
+        # Lectura exclusiva de la clave desde Streamlit Secrets
+        api_key = st.secrets["deepseek_api_key"]
+    except KeyError:
+        return LLMJob.finished(LLMError("❌ Conexión fallida. Por favor, verifica tu clave API."))
+    
+    # --- INYECCIÓN RAG CRÍTICA (sólo los fragmentos relevantes del corpus compartido) ---
+    corpus_doc_ids = st.session_state.get('corpus_doc_ids', [])
+    corpus_chunks = retrieve_chunks(rag_query or user_query, doc_ids=set(corpus_doc_ids)) if corpus_doc_ids else []
+    
+    # Contexto propio de la sesión: resumen de la UR, actividades y documentos personalizados
+    atribuciones = []
+    if 'atribuciones_ur_content' in st.session_state: atribuciones.append(f"\n\n--- CONTEXTO RAG (ATRIBUCIONES DE LA UR: REGLAMENTO INTERIOR / LEY ORGÁNICA) ---\n{st.session_state['atribuciones_ur_content']}")
+    actividades = []
+    if 'actividades_content' in st.session_state: actividades.append(f"\n\n--- CONTEXTO RAG (ACTIVIDADES PREVIAS DEL ÁREA) ---\n{st.session_state['actividades_content']}")
+    custom_docs = [f"\n\n{format_chunk_header(chunk)}\n{chunk['text']}" for chunk in retrieve_custom_chunks(rag_query or user_query)]
+    
+    # Presupuesto de contexto: se recorta aquí, de forma determinista, en lugar de esperar el error 400 de la API
+    sections, budget_report = allocate_context_budget([
+        {'name': 'Persona (prompt maestro)', 'priority': 0, 'parts': [system_prompt]},
+        {'name': 'Instrucciones de fase', 'priority': 0, 'parts': [user_query]},
+        {'name': 'Resumen de la UR', 'priority': 1, 'parts': [st.session_state['area_context']['atribuciones_resumen']]},
+        {'name': 'Memoria de la conversación', 'priority': 1, 'parts': memory_parts or []},
+        {'name': 'Actividades del área', 'priority': 2, 'parts': actividades},
+        {'name': 'Atribuciones legales de la UR', 'priority': 3, 'parts': atribuciones},
+        {'name': 'Fragmentos del corpus', 'priority': 4, 'parts': [f"\n\n{format_chunk_header(chunk)}\n{chunk['text']}" for chunk in corpus_chunks]},
+        {'name': 'Documentos personalizados', 'priority': 5, 'parts': custom_docs},
+    ], LLM_CONTEXT_WINDOW_TOKENS - LLM_MAX_TOKENS - LLM_CONTEXT_SAFETY_TOKENS - 5 * LLM_MESSAGE_OVERHEAD_TOKENS)
+    if not speculative_key:
+        st.session_state['last_context_budget'] = budget_report
+    _, _, resumen, memory_parts, actividades, atribuciones, corpus_parts, custom_docs = (section['parts'] for section in sections)
+    
+    corpus_context = format_corpus_chunks(corpus_chunks[:len(corpus_parts)], corpus_parts)
+    # El orden dentro del contexto de la UR se mantiene estable para la caché de prefijos del proveedor
+    area_context = "".join(resumen + atribuciones + actividades + custom_docs)
+    # -----------------------------
+    
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    messages = build_llm_messages(system_prompt, corpus_context, area_context, user_query, "".join(memory_parts))
+    
+    payload = {
+        "model": LLM_MODEL, 
+        "messages": messages,
+        "temperature": 0.3, 
+        "max_tokens": LLM_MAX_TOKENS,
+        "stream": True, # Streaming real (SSE): los tokens se muestran conforme llegan
+        "stream_options": {"include_usage": True} # El último evento trae 'usage' (tokens en caché / sin caché)
+    }
+    if json_output:
+        payload["response_format"] = {"type": "json_object"} # Salida estructurada de las fases (la consulta trae el esquema)
+    
+    on_complete = None
+    if cacheable:
+        cache_key = ResponseCache.make_key(payload)
+        response_cache = get_response_cache()
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            return LLMJob.finished(cached_response)
+        on_complete = lambda text: response_cache.put(cache_key, payload['model'], text)
+    
+    # El presupuesto se revisa antes de encolar: un trabajo ya encolado podría despacharse (y cobrarse) antes de cancelarlo
+    cost_tokens = budget_report['sent_tokens'] + LLM_MAX_TOKENS
+    if max_cost_tokens is not None and cost_tokens > max_cost_tokens:
+        return None
+    
+    # La llamada corre en el servicio de ejecución compartido; aquí sólo se consume la cola de tokens
+    metrics = get_llm_metrics()
+    return get_llm_executor().submit(
+        speculative_key or get_llm_session_key(), lambda: request_llm_completion(headers, payload, on_complete, metrics),
+        user_key=st.session_state.get('username'), # Usuario normalizado del login (el nombre visible puede repetirse)
+        cost_tokens=cost_tokens,
+    )
+
+
+def queue_notice():
+    """
+    Aviso en pantalla mientras la solicitud espera turno (posición en la fila y espera estimada).
+    El aviso aparece dentro del contenedor donde se pinta la respuesta y se retira cuando ésta empieza a llegar.
+    """
+    placeholder = None
+
+    def notify(status):
+        nonlocal placeholder
+        if status is None:
+            if placeholder is not None:
+                placeholder.empty()
+            return
+        if placeholder is None:
+            placeholder = st.empty()
+        placeholder.info(
+            f"⏳ Hay muchas solicitudes en este momento. Tu consulta está en la posición **{status['position']}** "
+            f"de la fila; tiempo estimado de espera: ~{math.ceil(status['eta_seconds'])} s."
+        )
+    return notify
+
+
+def backoff_delay(attempt):
+    """Espera antes del reintento attempt (0, 1, ...): exponencial con jitter completo, para no sincronizar sesiones."""
+    return random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+@st.cache_resource
+def get_hedge_pool():
+    """Hilos auxiliares para enviar la solicitud original y su duplicado (hedging) en paralelo."""
+    return ThreadPoolExecutor(max_workers=2 * LLM_MAX_CONCURRENCY, thread_name_prefix="progob-hedge")
+
+
+def post_llm_request(headers, payload, metrics):
+    """
+    Envía la solicitud y devuelve la respuesta en cuanto llegan los encabezados (el cuerpo se lee en streaming).
+    Con LLM_HEDGE_ENABLED, si la primera respuesta tarda más que el percentil LLM_HEDGE_PERCENTILE de las
+    latencias recientes, se envía un duplicado y se usa el que responda primero; el otro se cierra.
+    """
+    send = lambda: get_http_session().post(
+        LLM_API_URL, headers=headers, json=payload, stream=True,
+        timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT),
+    )
+    started_at = time.monotonic()
+    hedge_delay = metrics.latency_percentile(LLM_HEDGE_PERCENTILE) if LLM_HEDGE_ENABLED else None
+    if hedge_delay is None:
+        response = send()
+    else:
+        pool = get_hedge_pool()
+        attempts = [pool.submit(send)]
+        done, _ = concurrent.futures.wait(attempts, timeout=hedge_delay)
+        if not done:
+            metrics.record_hedge()
+            attempts.append(pool.submit(send))
+        response = first_successful_response(attempts)
+    metrics.record_latency(time.monotonic() - started_at)
+    return response
+
+
+def first_successful_response(attempts):
+    """Devuelve la primera respuesta sin excepción entre los intentos en paralelo y cierra las demás al llegar."""
+    pending = set(attempts)
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+                for other in done - {future}:
+                    if other.exception() is None:
+                        other.result().close()
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+
+def request_llm_completion(headers, payload, on_complete=None, metrics=None, breaker=None):
+    """
+    Envía la solicitud a la API y entrega el texto de la respuesta conforme llega.
+    Las fallas transitorias (conexión, timeout, 5xx) se reintentan con backoff exponencial antes de empezar el
+    streaming; el circuit breaker corta de inmediato mientras el proveedor está caído.
+    No toca st.session_state ni st.secrets: se ejecuta en los hilos del servicio de ejecución.
+    """
+    metrics = metrics or get_llm_metrics()
+    breaker = breaker or get_circuit_breaker()
+    if not breaker.allow():
+        yield LLMError(
+            f"⚠️ El servicio del modelo no está respondiendo. Vuelve a enviar tu mensaje en ~{math.ceil(breaker.retry_in())} s; "
+            "tu avance se conserva."
+        )
+        return
+
+    # Conexión con streaming; los errores HTTP se detectan antes de empezar a leer el flujo.
+    # settled indica si el breaker ya recibió el resultado: toda salida sin él cuenta como falla, así una
+    # solicitud de prueba (semiabierto) nunca queda marcada como en curso para siempre.
+    settled = False
+    try:
+        for attempt in range(LLM_RETRY_ATTEMPTS + 1):
+            try:
+                response = post_llm_request(headers, payload, metrics)
+            except requests.exceptions.RequestException as e:
+                error = e
+                transient = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            else:
+                if response.status_code not in LLM_RETRY_STATUS_CODES:
+                    break
+                error = requests.exceptions.HTTPError(f"{response.status_code} Server Error: {response.reason}", response=response)
+                transient = True
+                response.close()
+            breaker.record_failure()
+            settled = True
+            if not transient or attempt == LLM_RETRY_ATTEMPTS or not breaker.allow():
+                yield LLMError(f"❌ Error en la comunicación con la API. Detalle: {error}")
+                return
+            settled = False # allow() pudo autorizar una nueva prueba: el reintento debe volver a informar
+            metrics.record_retry()
+            time.sleep(backoff_delay(attempt))
+        # El proveedor respondió (aunque sea 4xx): está disponible
+        breaker.record_success()
+        settled = True
+        
+        # Límite del proveedor: el servicio de ejecución reencola la solicitud y pausa el despacho
+        if response.status_code == 429:
+            response.close()
+            try:
+                retry_after = float(response.headers.get('Retry-After', LLM_RATE_LIMIT_RETRY_SECONDS))
+            except ValueError:
+                retry_after = LLM_RATE_LIMIT_RETRY_SECONDS
+            raise LLMRateLimited(retry_after)
+
+        # Manejo específico del error 400 (Bad Request); el presupuesto local debería evitar el de límite de tokens
+        if response.status_code == 400:
+             try:
+                 error_data = response.json()
+                 error_message = error_data.get('error', {}).get('message', 'Solicitud incorrecta (400 Bad Request).')
+                 # Si el error es de límite de contexto, lo reportamos claramente
+                 if "context length" in error_message:
+                    error_message = "❌ Límite de tokens excedido. Por favor, reinicia la conversación (INICIAR DE NUEVO) o revisa los documentos cargados. " + error_message
+                 yield LLMError(f"❌ Error en la comunicación con la API. Detalle: {error_message}")
+             except ValueError:
+                 yield LLMError(f"❌ Error en la comunicación con la API. Detalle: 400 Client Error: Bad Request.")
+             finally:
+                 response.close()
+             return
+
+        response.raise_for_status() 
+    except requests.exceptions.RequestException as e:
+        yield LLMError(f"❌ Error en la comunicación con la API. Detalle: {e}")
+        return
+    except LLMRateLimited:
+        raise
+    except Exception as e:
+        yield LLMError(f"❌ Error interno al procesar la respuesta. Detalle: {e}")
+        return
+    finally:
+        if not settled:
+            breaker.record_failure()
+    yield from stream_sse_response(response, on_complete, metrics)
+
+
+def iter_sse_events(lines):
+    """
+    Parsea un flujo Server-Sent Events de chat completions (líneas 'data: {...}').
+    Devuelve cada evento JSON decodificado hasta recibir 'data: [DONE]'.
+    """
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue # Comentarios de keep-alive (': ...') y separadores
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        yield json.loads(data)
+
+
+def stream_sse_response(response, on_complete=None, metrics=None):
+    """
+    Generador que entrega los tokens de la respuesta en cuanto llegan del servidor (para st.write_stream).
+    Si la respuesta termina completa y sin errores, llama on_complete(texto_completo).
+    """
+    metrics = metrics or get_llm_metrics()
+    response.encoding = 'utf-8' # text/event-stream sin charset: requests asumiría ISO-8859-1
+    received = False
+    tokens = []
+    try:
+        lines = response.iter_lines(decode_unicode=True)
+        for event in iter_sse_events(lines):
+            if event.get('usage'):
+                metrics.record_usage(event['usage'])
+            choices = event.get('choices') or []
+            token = (choices[0].get('delta') or {}).get('content') if choices else None
+            if token:
+                received = True
+                tokens.append(token)
+                yield token
+        # Tras [DONE] sólo queda el cierre del cuerpo: se lee para que la conexión vuelva al pool keep-alive
+        # (una respuesta sin consumir por completo se cierra en lugar de reutilizarse)
+        for _ in lines:
+            pass
+        if not received:
+            yield LLMError(f"⚠️ Progob no pudo generar una respuesta. (Código: {response.status_code})")
+        elif on_complete:
+            on_complete("".join(tokens))
+    except requests.exceptions.RequestException as e:
+        yield LLMError(f"\n\n❌ Error en la comunicación con la API (respuesta interrumpida). Detalle: {e}")
+    except ValueError as e:
+        yield LLMError(f"\n\n❌ Error interno al procesar la respuesta. Detalle: {e}")
+    finally:
+        response.close()
+
+
+# --------------------------------------------------------------------------
+# B. FUNCIONES DE PERSISTENCIA (LOCAL: DESCARGA/CARGA JSON/TXT)
+# --------------------------------------------------------------------------
+
+def get_pat_file_name(user_area):
+    """Genera el nombre de archivo para guardar el avance del PAT."""
+    clean_area = re.sub(r'[^\w\s-]', '', user_area.replace(' ', '_'))
+    return f"avance_pat_{clean_area}"
+
+class StaleProgressError(Exception):
+    """El avance guardado cambió desde que esta sesión lo leyó (p. ej. otra pestaña del mismo usuario)."""
+
+
+class ProgressStore:
+    """
+    Avance de cada usuario en SQLite (modo WAL): fase, pat_data y mensajes. Los mensajes se guardan como
+    anexos (sólo los nuevos de cada turno), así que el costo de guardar no crece con la conversación.
+    Cada fila lleva una versión que aumenta en cada guardado: una sesión sólo escribe si conoce la última
+    (control optimista), así una pestaña desactualizada no pisa el avance más reciente.
+    Cada operación abre su propia conexión, como ResponseCache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS progress ("
+                " username TEXT PRIMARY KEY, area TEXT, current_phase TEXT, pat_data TEXT,"
+                " message_count INTEGER, updated REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " username TEXT, seq INTEGER, role TEXT, content TEXT, PRIMARY KEY (username, seq))"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(progress)")]
+            if 'version' not in columns: # Bases creadas antes del control de versiones
+                conn.execute("ALTER TABLE progress ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA synchronous=NORMAL") # Seguro en WAL: una caída sólo puede perder el último turno
+        return conn
+
+    def save(self, username, area, pat_data, current_phase, messages, replace=False, expected_version=None):
+        """
+        Guarda el estado en una transacción, anexando sólo los mensajes que aún no están en la base.
+        replace=True reescribe el historial completo (cuando se sustituyó, p. ej. al cargar un archivo).
+        expected_version es la versión que la sesión leyó (0 = sin avance guardado); si la base tiene otra, lanza
+        StaleProgressError sin escribir nada. Devuelve la nueva versión.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE") # Lectura de la versión y escritura sin que otra sesión se intercale
+            row = conn.execute("SELECT message_count, version FROM progress WHERE username = ?", (username,)).fetchone()
+            stored, version = row if row else (0, 0)
+            if expected_version is not None and expected_version != version:
+                raise StaleProgressError(f"El avance guardado va en la versión {version}; esta sesión leyó la {expected_version}.")
+            if replace or stored > len(messages):
+                conn.execute("DELETE FROM messages WHERE username = ?", (username,))
+                stored = 0
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (username, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(username, seq, message['role'], message['content']) for seq, message in enumerate(messages[stored:], stored)],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO progress (username, area, current_phase, pat_data, message_count, updated, version)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (username, area, current_phase, json.dumps(pat_data, ensure_ascii=False), len(messages), time.time(), version + 1),
+            )
+        return version + 1
+
+    def load(self, username):
+        """
+        Último avance guardado del usuario ({'area', 'current_phase', 'pat_data', 'messages', 'updated', 'version'})
+        o None.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT area, current_phase, pat_data, message_count, updated, version FROM progress WHERE username = ?",
+                (username,),
+            ).fetchone()
+            if not row:
+                return None
+            messages = conn.execute(
+                "SELECT role, content FROM messages WHERE username = ? AND seq < ? ORDER BY seq", (username, row[3])
+            ).fetchall()
+        return {
+            'area': row[0],
+            'current_phase': row[1],
+            'pat_data': json.loads(row[2]),
+            'messages': [{"role": role, "content": content} for role, content in messages],
+            'updated': row[4],
+            'version': row[5],
+        }
+
+    def clear(self, username):
+        """Borra el avance del usuario (al reiniciar el ciclo con INICIAR DE NUEVO)."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM messages WHERE username = ?", (username,))
+            conn.execute("DELETE FROM progress WHERE username = ?", (username,))
+
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM progress").fetchone()[0]
+
+
+@st.cache_resource
+def get_progress_store():
+    """Almacén de avance compartido por el proceso."""
+    return ProgressStore(PROGRESS_DB_FILE)
+
+
+def save_pat_progress(user_area, pat_data, replace=False):
+    """
+    Autoguardado del avance (fase, pat_data y mensajes) de la sesión actual en el servidor.
+    Se llama al terminar cada turno; sin usuario identificado (p. ej. sesión antigua) no hace nada.
+    """
+    username = st.session_state.get('username')
+    if not username:
+        return
+    try:
+        st.session_state['progress_version'] = get_progress_store().save(
+            username, user_area, pat_data, st.session_state.get('current_phase', 'inicio'), st.session_state.get('messages', []),
+            replace=replace, expected_version=st.session_state.get('progress_version', 0),
+        )
+        st.session_state['drive_status'] = f"✅ Avance guardado automáticamente ({time.strftime('%H:%M')})."
+    except StaleProgressError:
+        st.session_state['drive_status'] = (
+            "⚠️ Tu avance se actualizó desde otra pestaña o sesión, así que este turno no se guardó en el servidor. "
+            "Recarga la página para continuar con el avance más reciente (o descarga esta conversación como respaldo)."
+        )
+    except sqlite3.Error as e:
+        st.session_state['drive_status'] = f"⚠️ No se pudo guardar el avance en el servidor: {e}. Descarga la conversación como respaldo."
+
+
+def restore_pat_progress(user_area):
+    """
+    Reanuda el último avance guardado del usuario para esta UR. Devuelve True si se restauró.
+    """
+    username = st.session_state.get('username')
+    saved = get_progress_store().load(username) if username else None
+    # Aunque no se restaure (otra UR), la sesión parte de la versión vigente para poder guardar sobre ella
+    st.session_state['progress_version'] = saved['version'] if saved else 0
+    if not saved or saved['area'] != user_area or not saved['messages']:
+        return False
+    st.session_state.pat_data = coerce_pat_data(saved['pat_data'])
+    st.session_state.messages = saved['messages']
+    st.session_state.current_phase = saved['current_phase']
+    st.session_state['drive_status'] = f"✅ Avance restaurado automáticamente (guardado el {time.strftime('%Y-%m-%d %H:%M', time.localtime(saved['updated']))})."
+    return True
+    
+# Claves de sesión que identifican al usuario autenticado; sobreviven al reinicio del ciclo ('INICIAR DE NUEVO')
+SESSION_IDENTITY_KEYS = ('authenticated', 'role', 'user_name', 'user_area', 'username')
+
+
+def restart_pat_cycle():
+    """
+    Empieza un PAT nuevo sin cerrar la sesión: cancela las llamadas en curso, borra el avance guardado en el servidor
+    y limpia la sesión conservando la identidad del usuario y los archivos ya importados.
+    """
+    get_llm_executor().cancel_session(get_llm_session_key())
+    cancel_speculative_jobs()
+    username = st.session_state.get('username')
+    if username:
+        get_progress_store().clear(username) # El nuevo ciclo empieza sin el avance anterior
+    kept = {key: st.session_state[key] for key in SESSION_IDENTITY_KEYS if key in st.session_state}
+    # El archivo que siga en el uploader no se reimporta
+    kept['imported_progress_hashes'] = st.session_state.get('imported_progress_hashes', set())
+    st.session_state.clear()
+    st.session_state.update(kept)
+
+
+def generate_txt_conversation(messages, user_area):
+    """Genera una transcripción de la conversación en formato TXT/MD."""
+    
+    output = f"--- ASESORÍA PROGOB (MIR) ---\n"
+    output += f"UNIDAD RESPONSABLE: {user_area}\n"
+    output += f"FECHA DE EXPORTACIÓN: {time.strftime('%Y-%m-%d %H:%M')}\n"
+    output += f"--- INICIO DE CONVERSACIÓN ---\n\n"
+    
+    for msg in messages:
+        role = msg["role"].upper()
+        content = msg["content"]
+        
+        output += f"## {role}:\n"
+        output += content + "\n\n"
+        
+    output += f"--- FIN DE CONVERSACIÓN ---\n"
+    
+    # Codificamos a UTF-8 para preservar tildes y eñes
+    return output.encode('utf-8') 
+
+def load_pat_progress(user_area):
+    """
+    Maneja el uploader para restaurar el historial y el estado.
+    """
+    
+    st.sidebar.markdown("---")
+    # Este uploader ahora permite cargar un archivo JSON (con estado completo) o un TXT (solo historial)
+    uploaded_file = st.sidebar.file_uploader(
+        "⬆️ Cargar Conversación Previa (.json / .txt)",
+        type=['json', 'txt'],
+        key="pat_file_uploader",
+        help="Sube el archivo JSON de avance completo para restaurar la lógica, o un TXT para restaurar el historial de chat."
+    )
+    
+    # Definición del estado inicial vacío
+    empty_state = new_pat_data()
+    
+    messages = []
+    current_phase = 'inicio'
+
+    # El archivo sigue en el uploader en las recargas siguientes: cada contenido se importa una sola vez, o cada
+    # recarga volvería a sustituir el avance que se haya guardado desde entonces
+    imported = st.session_state.setdefault('imported_progress_hashes', set())
+    upload_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest() if uploaded_file is not None else None
+    if upload_hash is not None and upload_hash not in imported:
+        imported.add(upload_hash)
+        try:
+            bytes_data = uploaded_file.getvalue()
+            content = bytes_data.decode('utf-8')
+            
+            if uploaded_file.type == 'application/json':
+                 # Intenta cargar un estado completo (JSON)
+                 full_state = json.loads(content)
+                 pat_data = coerce_pat_data(full_state.get('pat_data')) # Sólo campos conocidos y con el tipo correcto
+                 messages = full_state.get('messages', [])
+                 current_phase = full_state.get('current_phase', 'inicio')
+                 
+                 # Si la carga es exitosa, restauramos los mensajes y la fase actual
+                 st.session_state['messages'] = messages
+                 st.session_state['current_phase'] = current_phase
+                 st.session_state['pat_data'] = pat_data
+                 
+                 save_pat_progress(user_area, pat_data, replace=True)
+                 st.session_state['drive_status'] = f"✅ Avance '{uploaded_file.name}' cargado exitosamente."
+                 st.rerun() # Forzamos la recarga con el nuevo estado
+            
+            else: # Asume TXT o formato simple: restaurar solo el historial de mensajes
+                st.sidebar.warning("Solo se cargó el historial de texto. La lógica metodológica (fases) debe reiniciarse.")
+                # Creamos un historial simple a partir del texto
+                
+                # Buscamos el inicio de la conversación (para evitar metadata)
+                start_index = content.find("## ASSISTANT:") 
+                
+                if start_index == -1:
+                    # Si no encontramos el formato estructurado, usamos el texto completo como un mensaje
+                    messages = [{"role": "assistant", "content": "Historial restaurado, pero no se pudo parsear el formato estructurado."}, {"role": "user", "content": content}]
+                else:
+                    # Parseo simple para restaurar el historial (puede ser impreciso, es mejor que el usuario suba JSON)
+                    # Aquí solo guardaremos la última parte para reiniciar el chat
+                    messages = [{"role": "assistant", "content": "Historial de conversación restaurado. Por favor, reintroduce el Problema Central definitivo."}]
+                
+                st.session_state['messages'] = messages
+                st.session_state['pat_data'] = empty_state
+                st.session_state['current_phase'] = 'Diagnostico_Problema_Definicion' # Reiniciamos la fase.
+                save_pat_progress(user_area, empty_state, replace=True)
+                st.rerun()
+
+            
+        except Exception as e:
+            imported.discard(upload_hash) # Un archivo que no se pudo importar puede volver a intentarse
+            st.sidebar.error(f"❌ Error al cargar el archivo: {e}")
+            
+    
+    st.session_state['drive_status'] = "⚠️ Persistencia: Esperando que cargue un avance o inicie un nuevo PAT."
+    # Retorna el estado inicial, ya que el estado cargado se maneja directamente con st.session_state
+    return empty_state, []
+
+
+def typing_effect(chunks, max_seconds=None, chunk_delay=0.02):
+    """
+    Efecto de tecleo opcional: pausa breve por FRAGMENTO (no por carácter) con un tope de tiempo total.
+    Al agotarse max_seconds, el resto del texto se entrega sin pausas.
+    """
+    max_seconds = TYPING_EFFECT_MAX_SECONDS if max_seconds is None else max_seconds
+    deadline = time.monotonic() + max_seconds
+    for chunk in chunks:
+        yield chunk
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(min(chunk_delay, remaining))
+
+
+def render_stream(chunks):
+    """Prepara el flujo para st.write_stream: en vivo por defecto, con efecto de tecleo sólo si se habilita."""
+    return typing_effect(chunks) if TYPING_EFFECT_ENABLED else chunks
+
+
+# --------------------------------------------------------------------------
+# K. CATÁLOGO DE INDICADORES (GDM y Manual de Indicadores, extraído sin LLM)
+# --------------------------------------------------------------------------
+# Los dos documentos traen cientos de fichas de indicadores. Se extraen una vez a un catálogo estructurado
+# (JSON en la caché) y se buscan localmente con BM25; al modelo sólo le llegan las mejores coincidencias.
+
+GDM_INDICATOR_RE = re.compile(r'^\s*(\d+\.\d+\.\d+)\s+(\S.*)$')
+GDM_THEME_RE = re.compile(r'^\s*(?:Tema:\s*)?(\d+\.\d+)\.?\s+([A-ZÁÉÍÓÚ][^\d]*?)[\s.]*(?:\d+\s*)*$')
+GDM_MODULE_RE = re.compile(r'^\s*M[óo]dulo\s+(\d+)\.?\s+([A-ZÁÉÍÓÚ][^\d]*?)\s*\d*\s*$')
+GDM_SCORE_RE = re.compile(r'[<>]\s*=?\s*\d|=\s*\d') # Filas de las tablas de semaforización (no son fichas)
+GDM_FREQUENCY_RE = re.compile(r'\((revisi[óo]n\s+\w+|una vez en [óo]ptimo[^)]*)\)?\s*$', re.IGNORECASE)
+GDM_CHECK_ITEM_RE = re.compile(r'^\s*([a-z])\)\s+(.*)$')
+GDM_HEADER_RE = re.compile(r'^Guía Consultiva de Desempeño Municipal 2025 \S 2027$') # Encabezado de cada página
+MANUAL_INDICATOR_RE = re.compile(r'^\s*(\d{1,3})\.\s+(\S.*)$')
+MANUAL_SECTION_RE = re.compile(r'^\s*(\d+\.\d+)\s+(Indicadores de .+)$')
+MANUAL_FOOTER_RE = re.compile(r'www\.gob\.mx/inafed|^Relación de$')
+GLUED_FRACTION_RE = re.compile(r'([a-záéíóúñ0-9)])([A-ZÁÉÍÓÚÑ])') # Numerador y denominador pegados al extraer la fórmula
+
+
+def _clean_line(line):
+    return re.sub(r'\s+', ' ', line).strip()
+
+
+def parse_gdm_indicators(pages):
+    """
+    Fichas de la Guía Consultiva de Desempeño Municipal: 'M.T.N Nombre (revisión anual)' seguido del método de
+    cálculo (indicadores de desempeño) o de los elementos verificables a), b), ... (indicadores de gestión).
+    """
+    modules, themes, indicators = {}, {}, {}
+    lines = [
+        (page_number, _clean_line(line)) for page_number, text in enumerate(pages, start=1) for line in text.splitlines()
+        if not GDM_HEADER_RE.match(_clean_line(line))
+    ]
+    for _, line in lines:
+        module = GDM_MODULE_RE.match(line)
+        if module:
+            modules.setdefault(module.group(1), module.group(2).strip(" ."))
+        theme = GDM_THEME_RE.match(line)
+        if theme and len(theme.group(2)) > len(themes.get(theme.group(1), "")):
+            themes[theme.group(1)] = theme.group(2).strip(" .") # La forma más completa (el índice a veces la corta)
+
+    kind = None
+    for position, (page, line) in enumerate(lines):
+        if line.startswith("Indicadores de Gestión"):
+            kind = "Gestión"
+        elif line.startswith("Indicadores de Desempeño"):
+            kind = "Desempeño"
+        match = GDM_INDICATOR_RE.match(line)
+        if not match or GDM_SCORE_RE.search(line) or match.group(1) in indicators:
+            continue
+        code, name = match.group(1), match.group(2)
+        formula, items, body = [], [], lines[position + 1:position + 40]
+        for offset, (_, following) in enumerate(body):
+            if GDM_INDICATOR_RE.match(following) or following.startswith(("Tema:", "Indicadores de", "Resultado")):
+                break
+            item = GDM_CHECK_ITEM_RE.match(following)
+            if following.startswith("Método de cálculo"):
+                formula = [text for _, text in body[offset + 1:offset + 4] if text and not text.startswith("Variable")][:1]
+            elif item:
+                items.append(f"{item.group(1)}) {item.group(2)}")
+            elif items and following and not formula:
+                items[-1] += f" {following}" # Elemento que continúa en la línea siguiente
+            elif not items and not formula and following and offset < 2 and not GDM_FREQUENCY_RE.search(name):
+                name += f" {following}" # Nombre que continúa en la línea siguiente
+        if not formula and not items:
+            continue
+        frequency = GDM_FREQUENCY_RE.search(name)
+        if frequency:
+            name = name[:frequency.start()].strip()
+            frequency = frequency.group(1)
+            frequency = "Anual" if "anual" in frequency.lower() else "Única (no se vuelve a revisar al alcanzar el óptimo)"
+        module_code, theme_code = code.split(".")[0], ".".join(code.split(".")[:2])
+        indicators[code] = {
+            'id': f"GDM-{code}",
+            'name': name.strip(" ."),
+            'formula': formula[0] if formula else "Elementos verificables: " + "; ".join(items),
+            'frequency': frequency,
+            'source': "GDM 2025-2027",
+            'theme': " / ".join(filter(None, [modules.get(module_code), f"{theme_code} {themes.get(theme_code, '')}".strip()])),
+            'type': kind,
+            'level': None,
+            'definition': "; ".join(items) if items else "",
+            'page': page,
+        }
+    return list(indicators.values())
+
+
+def parse_manual_indicators(pages):
+    """
+    Fichas del Manual de Indicadores para Municipios: 'N. Nombre', Definición, Variables, Método de cálculo,
+    unidad/sentido/dimensión y tipo/nivel recomendados. La numeración reinicia en cada apartado (5.1, 5.2, ...);
+    el tema sale de la relación de indicadores que abre cada apartado (encabezados sin número).
+    """
+    lines = [
+        (page_number, line) for page_number, text in enumerate(pages, start=1)
+        for line in map(_clean_line, text.splitlines())
+        if line and not PAGE_NUMBER_RE.match(line) and not MANUAL_FOOTER_RE.search(line)
+    ]
+    indicators, themes = {}, {}
+    section, section_name, current_theme = None, None, None
+    for position, (page, line) in enumerate(lines):
+        heading = MANUAL_SECTION_RE.match(line)
+        if heading:
+            section, section_name, current_theme = heading.group(1), heading.group(2).strip(" ."), None
+            continue
+        match = MANUAL_INDICATOR_RE.match(line)
+        if not match:
+            # Encabezado de tema en la relación: empieza con mayúscula (las continuaciones de nombre, no)
+            if line[0].isupper() and len(line) < 100 and not re.search(r'\d{3,}', line):
+                current_theme = line.strip(" .")
+            continue
+        header, card_start = [match.group(2)], None
+        for following_page, following in lines[position + 1:position + 4]:
+            if following.startswith("Definición"):
+                card_start = lines.index((following_page, following), position)
+                break
+            header.append(following)
+        key = (section, match.group(1))
+        if card_start is None:
+            themes.setdefault(key, current_theme) # Entrada de la relación de indicadores
+            continue
+        if key in indicators:
+            continue
+        card = []
+        for _, following in lines[card_start + 1:card_start + 80]:
+            if MANUAL_INDICATOR_RE.match(following) and card and card[-1].startswith(("Estratégico", "Gestión")):
+                break
+            card.append(following)
+        text = "\n".join(card)
+
+        def between(start, end):
+            found = re.search(re.escape(start) + r'\s*(.*?)\s*(?:' + end + r')', text, re.DOTALL)
+            return found.group(1) if found else ""
+
+        definition = _clean_line(between("", "Variables"))
+        variables = [_clean_line(v) for v in between("Variables", "Método de cálculo").split("•") if _clean_line(v)]
+        formula = unicodedata.normalize('NFKC', between("Método de cálculo", "Unidad de medida"))
+        formula = _clean_line(GLUED_FRACTION_RE.sub(r'\1 / \2', formula))
+        measure = re.search(r'Unidad de medida Sentido del indicador Dimensión\s*\n(.*)', text)
+        level = re.search(r'Tipo de indicador recomendado Nivel recomendado\s*\n(\S+)\s+(.*)', text)
+        unit = measure.group(1).rsplit(" ", 2)[0] if measure and len(measure.group(1).split()) >= 3 else None
+        theme = themes.get(key)
+        if theme and section_name and theme.lower() == section_name.lower():
+            theme = None # La relación del apartado no tiene subtemas
+        indicators[key] = {
+            'id': f"MIM-{section}.{match.group(1)}" if section else f"MIM-{match.group(1)}",
+            'name': _clean_line(" ".join(header)).strip(" ."),
+            'formula': formula or ("Variables: " + "; ".join(variables) if variables else ""),
+            'frequency': None, # El Manual no la determina (la fija cada municipio)
+            'source': "Manual de Indicadores para Municipios (INAFED)",
+            'theme': " / ".join(filter(None, [section_name, theme])) or None,
+            'type': level.group(1) if level else None,
+            'level': level.group(2).strip() if level else None,
+            'definition': definition + (f" Variables: {'; '.join(variables)}." if variables else "") + (f" Unidad: {unit}." if unit else ""),
+            'page': page,
+        }
+    return list(indicators.values())
+
+
+def _indicator_catalog_sources():
+    """Tamaño y mtime de los PDFs de los que sale el catálogo."""
+    return {
+        doc_id: [os.stat(CORPUS_DOCUMENTS[doc_id][0]).st_size, os.stat(CORPUS_DOCUMENTS[doc_id][0]).st_mtime_ns]
+        for doc_id in INDICATOR_CATALOG_DOCUMENTS
+    }
+
+
+def build_indicator_catalog(path=INDICATOR_CATALOG_FILE):
+    """Extrae las fichas de indicadores del GDM y del Manual y guarda el catálogo en la caché."""
+    indicators = (
+        parse_gdm_indicators(extract_pdf_pages(CORPUS_DOCUMENTS['gdm'][0]))
+        + parse_manual_indicators(extract_pdf_pages(CORPUS_DOCUMENTS['manual_ind'][0]))
+    )
+    _write_json_atomic(path, {
+        'version': INDICATOR_CATALOG_VERSION, 'sources': _indicator_catalog_sources(), 'indicators': indicators,
+    })
+    return indicators
+
+
+class IndicatorCatalog:
+    """Catálogo de indicadores con búsqueda BM25 sobre nombre, tema, definición y fórmula."""
+
+    def __init__(self, indicators, error=None):
+        self.indicators = indicators
+        self.error = error # Motivo por el que no se pudo construir (se muestra en el panel del administrador)
+        self.index = BM25Index([
+            {'doc_id': record['source'], 'text': " ".join(filter(None, [
+                record['name'], record['name'], record['theme'], record['definition'], record['formula'],
+            ]))}
+            for record in indicators
+        ])
+
+    def search(self, query, k=INDICATOR_TOP_K, level=None, source=None):
+        """
+        Los k indicadores más relevantes para la consulta. level ('Propósito', 'Componente', ...) da prioridad a los
+        recomendados para ese nivel de la MIR; source filtra por documento.
+        """
+        ranked = []
+        for score, idx in self.index.rank(query, {source} if source else None):
+            record = self.indicators[idx]
+            if level and record['level'] == level:
+                score *= INDICATOR_LEVEL_BOOST
+            ranked.append((score, idx))
+        ranked.sort(reverse=True)
+        return [self.indicators[idx] for _, idx in ranked[:k]]
+
+
+@st.cache_resource(show_spinner="Preparando el catálogo de indicadores...")
+def get_indicator_catalog():
+    """Catálogo vigente; se reconstruye si falta o si cambió alguno de los PDFs de origen."""
+    try:
+        with open(INDICATOR_CATALOG_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == INDICATOR_CATALOG_VERSION and data.get('sources') == _indicator_catalog_sources():
+            return IndicatorCatalog(data['indicators'])
+    except (OSError, ValueError):
+        pass
+    # Sin PDFs, sin pypdf o con un PDF ilegible las fases siguen funcionando sin sugerencias locales; cualquier otro
+    # error es un fallo del extractor y debe verse
+    errors = (OSError, ValueError, RuntimeError) + ((pypdf.errors.PyPdfError,) if pypdf else ())
+    try:
+        return IndicatorCatalog(build_indicator_catalog())
+    except errors as e:
+        logger.warning("No se pudo construir el catálogo de indicadores: %s", e, exc_info=True)
+        return IndicatorCatalog([], error=f"{type(e).__name__}: {e}")
+
+
+def format_indicator_candidates(indicators):
+    """Lista compacta de indicadores del catálogo para la consulta al modelo."""
+    lines = []
+    for record in indicators:
+        details = [f"Fórmula: {record['formula'][:300]}"]
+        if record['frequency']:
+            details.append(f"Frecuencia: {record['frequency']}")
+        if record['level']:
+            details.append(f"Nivel recomendado: {record['level']}")
+        if record['theme']:
+            details.append(f"Tema: {record['theme']}")
+        lines.append(f"- [{record['id']}] {record['name']} ({record['source']}, pág. {record['page']}). " + " | ".join(details))
+    return "\n".join(lines)
+
+
+def indicator_suggestions(query, level=None, k=INDICATOR_TOP_K):
+    """Bloque para la consulta de fase con los indicadores del catálogo más afines (vacío si no hay coincidencias)."""
+    matches = get_indicator_catalog().search(query, k, level=level)
+    if not matches:
+        return ""
+    return (
+        "\n**INDICADORES DEL CATÁLOGO LOCAL (GDM / Manual de Indicadores, mejores coincidencias):**\n"
+        + format_indicator_candidates(matches)
+        + "\nSi alguno aplica, basa el indicador en él y cita su clave entre corchetes; si ninguno aplica, propón uno nuevo."
+    )
+
+
+# --------------------------------------------------------------------------
+# V. VALIDACIÓN SINTÁCTICA LOCAL DE ENUNCIADOS MIR (reglas en español, sin LLM)
+# --------------------------------------------------------------------------
+# Las reglas de sintaxis de la Guía (Problema sin "falta de", Propósito = beneficiario + verbo en presente + resultado,
+# Componente = bien/servicio + participio pasado) se revisan aquí en milisegundos. Si el borrador no las cumple se
+# responde al instante sin llamar al modelo; si las cumple, el modelo sólo revisa lo semántico.
+
+# Verbos frecuentes en enunciados MIR (infinitivo, sin acentos). De aquí salen las formas conjugadas.
+MIR_VERBS = frozenset("""
+acceder adquirir ampliar apoyar atender aumentar beneficiar brindar capacitar consolidar construir contar contribuir
+crear cumplir desarrollar difundir disfrutar disminuir disponer dotar elaborar elevar entregar establecer
+fomentar fortalecer garantizar generar gestionar gozar habitar implementar impulsar incrementar instalar lograr
+mantener mejorar modernizar obtener ofrecer operar optimizar otorgar participar percibir poseer presentar prestar
+promover proporcionar realizar recibir reducir rehabilitar resolver satisfacer superar tener transitar utilizar
+vivir
+""".split())
+
+# Presente de indicativo irregular (3.ª persona singular y plural) de los verbos de la tabla
+MIR_IRREGULAR_PRESENT = {
+    'tener': ('tiene', 'tienen'), 'obtener': ('obtiene', 'obtienen'), 'mantener': ('mantiene', 'mantienen'),
+    'contar': ('cuenta', 'cuentan'), 'disponer': ('dispone', 'disponen'), 'promover': ('promueve', 'promueven'),
+    'resolver': ('resuelve', 'resuelven'), 'satisfacer': ('satisface', 'satisfacen'), 'ofrecer': ('ofrece', 'ofrecen'),
+    'fortalecer': ('fortalece', 'fortalecen'), 'establecer': ('establece', 'establecen'),
+    'construir': ('construye', 'construyen'), 'contribuir': ('contribuye', 'contribuyen'),
+    'disminuir': ('disminuye', 'disminuyen'), 'percibir': ('percibe', 'perciben'), 'vivir': ('vive', 'viven'),
+    'reducir': ('reduce', 'reducen'), 'adquirir': ('adquiere', 'adquieren'),
+}
+
+# Participios irregulares (el resto termina en -ado/-ido y sus variantes de género y número)
+IRREGULAR_PARTICIPLES = frozenset("""
+hecho dicho puesto impreso provisto resuelto devuelto cubierto abierto escrito visto vuelto satisfecho dispuesto
+""".split())
+PARTICIPLE_RE = re.compile(r'^[a-z]{2,}(?:ad|id)(?:o|a|os|as)$')
+# Sustantivos comunes con terminación de participio que NO cuentan como verbo
+PARTICIPLE_LOOKALIKES = frozenset("""
+estado estados mercado mercados resultado resultados cuidado cuidados partido partidos sentido contenido contenidos
+apartado apartados medida medidas salida salidas comida comidas bebida bebidas vida vidas partida partidas
+unidad ciudad edad soldado pescado ganado teclado tejido tejidos ruido ruidos nido vestido vestidos alumbrado
+empleado empleados
+""".split())
+
+# Palabras que indican la población o el beneficiario
+POPULATION_WORDS = frozenset("""
+poblacion habitantes familias personas ciudadanos ciudadania ninas ninos nina nino jovenes mujeres hombres
+productores comerciantes usuarios contribuyentes estudiantes alumnos adultos mayores colonias comunidades
+localidades hogares empresas negocios turistas visitantes pacientes trabajadores servidores municipio vecinos
+beneficiarios deportistas emprendedores pescadores agricultores ganaderos artesanos
+""".split())
+
+# Enunciados de ausencia de servicio (no son problemas sino la falta de una solución)
+ABSENCE_RE = re.compile(
+    r'\b(?:falta|ausencia|carencia|inexistencia)\s+de\b|\bno\s+(?:hay|existe|existen)\b|\bno\s+cuenta(?:n)?\s+con\b'
+)
+# El problema no debe incluir la solución
+SOLUTION_RE = re.compile(r'\b(?:mediante|a traves de|por medio de)\b')
+# Respuestas que no son un enunciado (aceptar, rechazar, elegir una opción): no se revisan localmente.
+# 'la'/'el' y 'opcion' sólo cuentan seguidos de la letra o el número de la opción, y 'no' sólo como respuesta:
+# "La población ...", "El municipio no cuenta con ..." o "No hay ..." sí son borradores que deben revisarse.
+NON_STATEMENT_RE = re.compile(
+    r'^(?:si|ok|de acuerdo|acepto|estoy de acuerdo'
+    r'|no\s+(?:estoy|acepto|me|quiero|prefiero|gracias|es|esta|creo)'
+    r'|(?:elijo|escojo|prefiero|selecciono|me quedo con)'
+    r'|(?:la|el)\s+(?:opcion\s+)?[a-c1-3]|opcion\s+[a-c1-3])\b'
+)
+
+MIR_MIN_WORDS = 5
+
+MIR_SYNTAX_RULES = {
+    'problema': "Población afectada + situación no deseada (sin 'falta de' y sin incluir la solución).",
+    'proposito': "Beneficiario + verbo en presente + resultado logrado (p. ej., 'Los habitantes de ... cuentan con ...').",
+    'componentes': "Bien o servicio entregado + verbo en participio pasado (p. ej., 'Apoyos económicos otorgados').",
+}
+
+
+def _present_forms():
+    """Formas de presente (3.ª persona) de MIR_VERBS: regulares por terminación e irregulares de la tabla."""
+    endings = {'ar': ('a', 'an'), 'er': ('e', 'en'), 'ir': ('e', 'en')}
+    forms = {}
+    for lemma in MIR_VERBS:
+        conjugated = MIR_IRREGULAR_PRESENT.get(lemma) or tuple(lemma[:-2] + ending for ending in endings[lemma[-2:]])
+        for form in conjugated:
+            forms[form] = lemma
+    return forms
+
+
+MIR_PRESENT_FORMS = _present_forms()
+
+
+def _mir_words(text):
+    return re.findall(r'[a-z0-9]+', unidecode(text).lower())
+
+
+def is_mir_statement(text):
+    """Distingue un enunciado de una pregunta, una elección de opción o una confirmación breve."""
+    words = _mir_words(text)
+    return '?' not in text and len(words) >= 3 and not NON_STATEMENT_RE.match(" ".join(words))
+
+
+def is_participle(word):
+    return word in IRREGULAR_PARTICIPLES or (PARTICIPLE_RE.match(word) is not None and word not in PARTICIPLE_LOOKALIKES)
+
+
+def is_conjugated_other_tense(word):
+    """Formas de los verbos de la tabla en futuro o pasado (p. ej., 'mejoraran', 'contaron', 'mejoro')."""
+    for lemma in MIR_VERBS:
+        stem = lemma[:-2]
+        if word.startswith(stem) and word != lemma and word not in MIR_PRESENT_FORMS and not is_participle(word):
+            suffix = word[len(stem):]
+            if suffix in ('ara', 'aran', 'era', 'eran', 'ira', 'iran', 'aron', 'ieron', 'o', 'io', 'aba', 'aban', 'ia', 'ian'):
+                return True
+    return False
+
+
+def split_components(text):
+    """Elementos de una lista de componentes: uno por línea o separados por ';' (las viñetas iniciales se quitan)."""
+    items = [re.sub(r'^\s*(?:[-*•]+|\d+[.)]|[a-z][.)])\s*', '', line).strip() for line in re.split(r'[\n;]+', text)]
+    return [item for item in items if item]
+
+
+def validate_mir_statement(kind, text):
+    """
+    Revisa localmente la sintaxis MIR de un borrador ('problema', 'proposito' o 'componentes').
+    Devuelve {'errors': [...], 'warnings': [...]}: los errores rompen una regla de la Guía; las advertencias
+    señalan algo que probablemente falta, pero que el modelo puede valorar.
+    """
+    errors, warnings = [], []
+    normalized = " ".join(_mir_words(text))
+    words = normalized.split()
+
+    if kind == 'problema':
+        if ABSENCE_RE.search(normalized):
+            errors.append("Está redactado como ausencia de un bien o servicio ('falta de', 'no hay', 'no cuenta con'): "
+                          "describe la situación negativa que vive la población, no la solución que falta.")
+        if SOLUTION_RE.search(normalized) or (words and words[0] in MIR_VERBS):
+            errors.append("Incluye la solución o una acción ('mediante', 'a través de', verbo en infinitivo al inicio): "
+                          "el Problema sólo describe la situación no deseada.")
+        if len(words) < MIR_MIN_WORDS:
+            errors.append(f"Es demasiado breve (menos de {MIR_MIN_WORDS} palabras) para identificar población y situación.")
+        if not POPULATION_WORDS.intersection(words):
+            warnings.append("No se identifica la población afectada (habitantes, familias, productores, ...).")
+
+    elif kind == 'proposito':
+        verb_at = next((i for i, word in enumerate(words) if word in MIR_PRESENT_FORMS), None)
+        if verb_at is None:
+            # Verbo fuera de la tabla: se acepta una forma de 3.ª persona del plural tras el beneficiario (-an/-en)
+            verb_at = next((i for i, word in enumerate(words[1:], start=1) if len(word) >= 5 and word.endswith(('an', 'en'))
+                            and word not in SPANISH_STOPWORDS and not is_participle(word)
+                            and not is_conjugated_other_tense(word)), None)
+            if verb_at is not None:
+                warnings.append(f"Verifica que '{words[verb_at]}' sea el verbo en presente del enunciado.")
+        if words and words[0] in MIR_VERBS:
+            errors.append("Empieza con un verbo en infinitivo: el Propósito es un resultado logrado, no una acción por realizar.")
+        elif verb_at is None:
+            if any(is_conjugated_other_tense(word) for word in words):
+                errors.append("El verbo no está en presente (p. ej., 'mejorarán' o 'contaron'): usa presente ('mejoran', 'cuentan').")
+            else:
+                errors.append("No se identifica el verbo en presente que une al beneficiario con el resultado ('cuentan con', 'acceden a', 'reducen', ...).")
+        else:
+            if verb_at == 0 or (verb_at == 1 and words[0] == 'se'):
+                errors.append("Falta el beneficiario antes del verbo (quién recibe el resultado).")
+            elif not POPULATION_WORDS.intersection(words[:verb_at]):
+                warnings.append("El beneficiario no parece ser una población (habitantes, familias, productores, ...).")
+            if len(words) - verb_at - 1 < 2:
+                errors.append("Falta el resultado después del verbo (qué logra el beneficiario).")
+
+    elif kind == 'componentes':
+        items = split_components(text)
+        for position, item in enumerate(items, start=1):
+            item_words = _mir_words(item)
+            label = f"Componente {position} ('{item[:60]}')"
+            if item_words and item_words[0] in MIR_VERBS:
+                errors.append(f"{label} empieza con un verbo en infinitivo: eso es una Actividad; el Componente es el bien o servicio entregado.")
+            elif not any(is_participle(word) for word in item_words):
+                errors.append(f"{label} no tiene verbo en participio pasado ('entregados', 'otorgados', 'realizadas', ...).")
+        if not items:
+            errors.append("No se identificó ningún Componente.")
+        elif len(items) > 5:
+            warnings.append(f"Se listan {len(items)} componentes: la Guía recomienda concentrarse en los 2 o 3 principales.")
+
+    return {'errors': errors, 'warnings': warnings}
+
+
+def render_local_validation(kind, report):
+    """Respuesta inmediata (sin LLM) cuando el borrador no cumple la sintaxis MIR."""
+    lines = [f"**Revisión de sintaxis MIR (inmediata):** {MIR_SYNTAX_RULES[kind]}", ""]
+    lines += [f"- ❌ {error}" for error in report['errors']]
+    lines += [f"- ⚠️ {warning}" for warning in report['warnings']]
+    lines += ["", "Ajusta la redacción y envíala de nuevo. Si consideras que es correcta, envíala otra vez tal cual y la revisaré a fondo."]
+    return "\n".join(lines)
+
+
+def local_validation_note(kind, report):
+    """Resultado de la revisión local para la consulta al modelo: así se concentra en lo semántico."""
+    if report['errors']:
+        status = "el usuario la reenvió sin cambios pese a estas observaciones: " + " ".join(report['errors'])
+    else:
+        status = "cumple las reglas de sintaxis (" + MIR_SYNTAX_RULES[kind] + ")"
+    note = f"\n**REVISIÓN SINTÁCTICA LOCAL (ya realizada):** la redacción {status}"
+    if report['warnings']:
+        note += " Advertencias: " + " ".join(report['warnings'])
+    return note + " Enfócate en lo semántico (atribuciones, lógica vertical, coherencia) y no repitas la revisión de sintaxis."
+
+
+# --------------------------------------------------------------------------
+# Z. LÓGICA DE FASES (Maneja el flujo secuencial y didáctico)
+# --------------------------------------------------------------------------
+
+# Términos de búsqueda por fase para recuperar los fragmentos normativos/metodológicos pertinentes
+PHASE_RAG_TOPICS = {
+    'Diagnostico_Problema_Definicion': "problema central poblacion situacion atribuciones",
+    'Diagnostico_Problema_Validacion': "arbol de problemas causas efectos directos indirectos",
+    'Diagnostico_Arbol_Validacion': "proposito objetivo logica vertical arbol de objetivos",
+    'Proposito_Definicion': "proposito sintaxis beneficiario resultado logica vertical",
+    'Proposito_Validacion': "indicador estrategico proposito medio de verificacion componentes",
+    'Componentes_Definicion': "componentes bienes servicios entregados",
+    'Componentes_Validacion': "indicador de gestion componente actividades calendario programa anual de trabajo",
+}
+# Consulta para el diagnóstico inicial (ODS, PND/PVD, atribuciones e indicadores)
+INITIAL_DIAGNOSTIC_RAG_TOPICS = "atribuciones objetivos de desarrollo sostenible plan nacional plan veracruzano indicadores desempeño municipal"
+
+# Memoria acotada de la conversación: artefactos validados + últimos turnos + resumen comprimido del resto.
+# Su tamaño no crece con la longitud de la conversación.
+MEMORY_RECENT_MESSAGES = 4 # Mensajes (usuario/asistente) que se envían íntegros
+MEMORY_MESSAGE_MAX_CHARS = 1500 # Tope por mensaje reciente
+MEMORY_SUMMARY_MAX_MESSAGES = 12 # Mensajes anteriores que se conservan comprimidos (los más nuevos)
+MEMORY_SUMMARY_CHARS = 160 # Caracteres por mensaje comprimido
+# Artefactos del PAT en orden metodológico: (campo validado, campo borrador, etiqueta)
+PAT_MEMORY_FIELDS = [
+    ('problema', 'problema_borrador', "Problema Central"),
+    ('arbol_problemas', None, "Árbol de Problemas"),
+    ('proposito', 'proposito_borrador', "Propósito"),
+    ('indicador_proposito', None, "Indicador del Propósito"),
+    ('componentes_final', 'componentes_propuestos', "Componentes"),
+]
+
+
+def compress_message(content, max_chars=MEMORY_SUMMARY_CHARS):
+    """Versión comprimida de un mensaje: sin formato Markdown, en una línea y truncada en una palabra."""
+    text = re.sub(r"[*#>`|_]+", " ", content)
+    text = re.sub(r"\s+", " ", text).strip()
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars] + "…"
+
+
+def format_artefact(value):
+    """Artefacto del PAT en una línea: listas de texto separadas por ';' y estructuras como JSON compacto."""
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return "; ".join(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    return value
+
+
+def build_conversation_memory(pat_data, messages, current_phase):
+    """
+    Memoria acotada para el prompt, como lista de partes de más a menos importante (para el presupuesto de contexto):
+    1) resumen estructurado de los artefactos del PAT (validados o en borrador) y la fase actual,
+    2) los últimos MEMORY_RECENT_MESSAGES mensajes, 3) los anteriores comprimidos a una línea.
+    messages no debe incluir el mensaje que se está respondiendo (ya va en las instrucciones de fase).
+    """
+    artefactos = [f"Fase actual: {current_phase.replace('_', ' ')}"]
+    for field, draft_field, label in PAT_MEMORY_FIELDS:
+        if pat_data.get(field):
+            artefactos.append(f"{label} (VALIDADO): {format_artefact(pat_data[field])}")
+        elif draft_field and pat_data.get(draft_field):
+            artefactos.append(f"{label} (borrador en revisión): {format_artefact(pat_data[draft_field])}")
+    parts = ["--- ARTEFACTOS DEL PAT ---\n" + "\n".join(f"- {line}" for line in artefactos)]
+
+    recent = messages[-MEMORY_RECENT_MESSAGES:] if MEMORY_RECENT_MESSAGES else []
+    if recent:
+        parts.append("\n\n--- ÚLTIMOS TURNOS ---" + "".join(
+            f"\n[{message['role'].upper()}]: {message['content'][:MEMORY_MESSAGE_MAX_CHARS]}" for message in recent
+        ))
+
+    older = messages[:len(messages) - len(recent)]
+    if older:
+        summarized = older[-MEMORY_SUMMARY_MAX_MESSAGES:]
+        omitted = len(older) - len(summarized)
+        header = "\n\n--- TURNOS ANTERIORES (RESUMEN) ---"
+        if omitted:
+            header += f"\n({omitted} mensajes más antiguos omitidos)"
+        parts.append(header + "".join(
+            f"\n[{message['role'].upper()}]: {compress_message(message['content'])}" for message in summarized
+        ))
+    return parts
+
+
+# Salidas estructuradas por fase: el modelo responde un objeto JSON (modo json_object de la API) que se valida
+# contra el esquema de la fase; los artefactos se guardan tipados en pat_data y el Markdown se arma aquí.
+STRUCTURED_OUTPUT_REPAIR_ATTEMPTS = 1 # Correcciones automáticas (sin turno del usuario) si el JSON no cumple
+
+JSON_SCHEMA_TYPES = {'object': dict, 'array': list, 'string': str, 'boolean': bool, 'null': type(None)}
+
+
+def nullable(schema):
+    """Variante del esquema que también admite null (campos de pat_data aún sin definir)."""
+    return {**schema, 'type': [schema['type'], 'null']}
+
+
+def text_schema(description):
+    return {'type': 'string', 'minLength': 1, 'description': description}
+
+
+def text_list_schema(description, min_items=0, max_items=None):
+    schema = {'type': 'array', 'items': {'type': 'string', 'minLength': 1}, 'minItems': min_items, 'description': description}
+    if max_items:
+        schema['maxItems'] = max_items
+    return schema
+
+
+INDICATOR_SCHEMA = {
+    'type': 'object',
+    'required': ['nombre', 'resultado', 'medicion', 'alcance', 'escala', 'temporalidad', 'formula', 'medio_verificacion'],
+    'properties': {
+        'nombre': text_schema("Nombre del indicador"),
+        'resultado': text_schema("R: resultado que se mide"),
+        'medicion': text_schema("M: unidad de medida"),
+        'alcance': text_schema("A: población o cobertura"),
+        'escala': text_schema("E: escala o meta"),
+        'temporalidad': text_schema("T: frecuencia de medición"),
+        'formula': text_schema("Método de cálculo"),
+        'medio_verificacion': text_schema("Fuente pública que permite verificarlo"),
+    },
+}
+
+OPTIONS_SCHEMA = {
+    'type': 'array',
+    'maxItems': 3,
+    'description': "Redacciones propuestas para que el usuario elija (vacío si no hay que proponer)",
+    'items': {
+        'type': 'object',
+        'required': ['opcion', 'redaccion'],
+        'properties': {
+            'opcion': {'type': 'string', 'enum': ['A', 'B', 'C']},
+            'redaccion': text_schema("Redacción completa, lista para copiar"),
+        },
+    },
+}
+
+CAUSAL_TREE_SCHEMA = {
+    'type': 'object',
+    'required': ['causas_directas', 'efectos_directos'],
+    'properties': {
+        'causas_directas': {
+            'type': 'array', 'minItems': 3,
+            'items': {
+                'type': 'object', 'required': ['causa', 'causas_indirectas'],
+                'properties': {'causa': text_schema("Causa directa"), 'causas_indirectas': text_list_schema("Causas indirectas", 2)},
+            },
+        },
+        'efectos_directos': {
+            'type': 'array', 'minItems': 1,
+            'items': {
+                'type': 'object', 'required': ['efecto', 'efectos_indirectos'],
+                'properties': {'efecto': text_schema("Efecto directo"), 'efectos_indirectos': text_list_schema("Efectos indirectos")},
+            },
+        },
+    },
+}
+
+ACTIVITY_SCHEMA = {
+    'type': 'object',
+    'required': ['componente', 'indicador_componente', 'actividad', 'indicador_actividad'],
+    'properties': {
+        'componente': text_schema("Componente confirmado"),
+        'indicador_componente': INDICATOR_SCHEMA,
+        'actividad': text_schema("Actividad (sustantivo derivado de un verbo + complemento)"),
+        'indicador_actividad': INDICATOR_SCHEMA,
+    },
+}
+
+# Modelo tipado de pat_data: lo que no cumple su esquema (p. ej. un archivo antiguo o editado) se descarta al cargar
+PAT_DATA_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'problema': nullable({'type': 'string'}),
+        'problema_borrador': nullable({'type': 'string'}),
+        'arbol_problemas': nullable(CAUSAL_TREE_SCHEMA),
+        'proposito': nullable({'type': 'string'}),
+        'proposito_borrador': nullable({'type': 'string'}),
+        'indicador_proposito': nullable(INDICATOR_SCHEMA),
+        'componentes_borrador': nullable({'type': 'string'}),
+        'componentes_propuestos': nullable({'type': 'array', 'items': {'type': 'string'}}),
+        'componentes_final': nullable({'type': 'array', 'items': {'type': 'string'}}),
+        'componentes_actividades': {'type': 'array', 'items': ACTIVITY_SCHEMA},
+    },
+}
+
+
+def phase_output_schema(required=(), **properties):
+    """Esquema de la respuesta de una fase: 'mensaje' (se muestra en vivo) + campos de la fase + 'pregunta' final."""
+    return {
+        'type': 'object',
+        'required': ['mensaje', *required, 'pregunta'],
+        'properties': {
+            'mensaje': text_schema("Explicación didáctica en Markdown; no repite lo que va en los demás campos"),
+            **properties,
+            'pregunta': text_schema("Pregunta o instrucción final para el usuario"),
+        },
+    }
+
+
+PHASE_OUTPUT_SCHEMAS = {
+    'Diagnostico_Problema_Definicion': phase_output_schema(
+        ['dentro_de_atribuciones', 'cumple_sintaxis', 'observaciones', 'opciones'],
+        dentro_de_atribuciones={'type': 'boolean'},
+        cumple_sintaxis={'type': 'boolean', 'description': "Población + situación no deseada, sin soluciones ni 'falta de'"},
+        observaciones=text_list_schema("Observaciones puntuales sobre la redacción"),
+        opciones=OPTIONS_SCHEMA,
+    ),
+    'Diagnostico_Problema_Validacion': phase_output_schema(
+        ['problema_confirmado', 'arbol'],
+        problema_confirmado=text_schema("Redacción completa del Problema Central que el usuario confirmó"),
+        arbol=CAUSAL_TREE_SCHEMA,
+    ),
+    'Diagnostico_Arbol_Validacion': phase_output_schema(
+        ['opciones'],
+        arbol={**CAUSAL_TREE_SCHEMA, 'description': "Sólo si el usuario modificó el árbol: el árbol completo ajustado"},
+        opciones={**OPTIONS_SCHEMA, 'minItems': 3},
+    ),
+    'Proposito_Definicion': phase_output_schema(
+        ['cumple_logica_vertical', 'cumple_sintaxis', 'observaciones', 'opciones'],
+        cumple_logica_vertical={'type': 'boolean'},
+        cumple_sintaxis={'type': 'boolean', 'description': "Beneficiario + verbo en presente + resultado"},
+        observaciones=text_list_schema("Observaciones puntuales sobre la redacción"),
+        opciones=OPTIONS_SCHEMA,
+    ),
+    'Proposito_Validacion': phase_output_schema(
+        ['proposito_confirmado', 'indicador'],
+        proposito_confirmado=text_schema("Redacción completa del Propósito que el usuario confirmó"),
+        indicador=INDICATOR_SCHEMA,
+    ),
+    'Componentes_Definicion': phase_output_schema(
+        ['observaciones', 'componentes_propuestos'],
+        observaciones=text_list_schema("Evaluación de cada componente del usuario"),
+        componentes_propuestos=text_list_schema("Lista final ajustada (bien o servicio + participio pasado)", 1, 5),
+    ),
+    'Componentes_Validacion': phase_output_schema(
+        ['componentes_confirmados', 'actividades'],
+        componentes_confirmados=text_list_schema("Componentes que el usuario confirmó, uno por elemento", 1),
+        actividades={'type': 'array', 'minItems': 1, 'items': ACTIVITY_SCHEMA},
+    ),
+}
+# Preguntas conceptuales o fases sin artefacto: sólo explicación y recordatorio del paso pendiente
+DEFAULT_PHASE_OUTPUT_SCHEMA = phase_output_schema()
+
+# Campo de pat_data <- campo de la respuesta validada, por fase (se confirma junto con la transición)
+PHASE_OUTPUT_FIELDS = {
+    'Diagnostico_Problema_Validacion': {'problema': 'problema_confirmado', 'arbol_problemas': 'arbol'},
+    'Diagnostico_Arbol_Validacion': {'arbol_problemas': 'arbol'},
+    'Proposito_Validacion': {'proposito': 'proposito_confirmado', 'indicador_proposito': 'indicador'},
+    'Componentes_Definicion': {'componentes_propuestos': 'componentes_propuestos'},
+    'Componentes_Validacion': {'componentes_final': 'componentes_confirmados', 'componentes_actividades': 'actividades'},
+}
+
+
+def validate_json(value, schema, path="respuesta"):
+    """
+    Validación del subconjunto de JSON Schema que usan los esquemas de fase (type, required, properties, items,
+    enum, minLength, minItems, maxItems). Devuelve la lista de errores legibles (vacía si es válido).
+    """
+    types = schema.get('type')
+    types = [types] if isinstance(types, str) else types or []
+    if types and not any(isinstance(value, JSON_SCHEMA_TYPES[name]) for name in types):
+        return [f"{path}: se esperaba {' o '.join(types)}"]
+    if value is None:
+        return []
+    errors = []
+    if 'enum' in schema and value not in schema['enum']:
+        errors.append(f"{path}: debe ser uno de {', '.join(schema['enum'])}")
+    if isinstance(value, str) and len(value.strip()) < schema.get('minLength', 0):
+        errors.append(f"{path}: no puede estar vacío")
+    if isinstance(value, list):
+        if len(value) < schema.get('minItems', 0):
+            errors.append(f"{path}: se esperaban al menos {schema['minItems']} elementos")
+        if len(value) > schema.get('maxItems', len(value)):
+            errors.append(f"{path}: se esperaban como máximo {schema['maxItems']} elementos")
+        for position, item in enumerate(value):
+            errors.extend(validate_json(item, schema.get('items', {}), f"{path}[{position}]"))
+    if isinstance(value, dict):
+        errors.extend(f"{path}.{key}: falta" for key in schema.get('required', []) if key not in value)
+        for key, subschema in schema.get('properties', {}).items():
+            if key in value:
+                errors.extend(validate_json(value[key], subschema, f"{path}.{key}"))
+    return errors
+
+
+def new_pat_data():
+    """pat_data vacío (inicio de un PAT)."""
+    return {field: [] if field == 'componentes_actividades' else None for field in PAT_DATA_SCHEMA['properties']}
+
+
+def coerce_pat_data(data):
+    """
+    Convierte datos guardados o subidos al modelo tipado de pat_data: conserva sólo los campos conocidos que cumplen
+    su esquema y deja el resto vacío.
+    """
+    pat_data = new_pat_data()
+    if isinstance(data, dict):
+        for field, schema in PAT_DATA_SCHEMA['properties'].items():
+            if field in data and not validate_json(data[field], schema, field):
+                pat_data[field] = data[field]
+    return pat_data
+
+
+def parse_structured_output(raw, schema):
+    """
+    Interpreta la respuesta JSON de una fase. Devuelve (salida, errores); la salida sólo conserva los campos del
+    esquema. Tolera que el modelo envuelva el JSON en un bloque ```json.
+    """
+    text = re.sub(r"^\s*```(?:json)?\s*|\s*```\s*$", "", raw)
+    try:
+        output = json.loads(text)
+    except ValueError as e:
+        return None, [f"JSON inválido ({e})"]
+    errors = validate_json(output, schema)
+    if errors:
+        return None, errors
+    return {key: output[key] for key in schema['properties'] if key in output}, []
+
+
+def structured_output_instructions(schema):
+    """Instrucción de formato que se agrega al final de la consulta de cada fase."""
+    return (
+        "\n**FORMATO DE RESPUESTA (OBLIGATORIO):** responde ÚNICAMENTE con un objeto JSON válido, sin texto fuera del "
+        "JSON ni bloques de código, que cumpla este JSON Schema (respeta el orden: 'mensaje' primero, 'pregunta' al "
+        "final; el Markdown sólo dentro de 'mensaje'):\n"
+        + json.dumps(schema, ensure_ascii=False)
+    )
+
+
+JSON_STRING_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+JSON_HEX4_RE = re.compile(r'[0-9a-fA-F]{4}')
+
+
+class JsonStringFieldReader:
+    """
+    Decodifica en vivo el valor de un campo de texto de un JSON que llega por partes (p. ej. 'mensaje'),
+    para mostrarlo mientras el resto de la respuesta sigue llegando. raw acumula el JSON completo.
+    Un escape \\u inválido detiene la decodificación en vivo (la respuesta completa la valida parse_structured_output
+    o la reparación); un sustituto sin pareja se muestra como U+FFFD.
+    """
+
+    def __init__(self, field):
+        self.pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.raw = ""
+        self.position = None # Índice en raw del siguiente carácter del valor por decodificar
+        self.finished = False
+
+    def feed(self, chunk):
+        """Agrega un fragmento del JSON y devuelve el texto nuevo del campo que ya puede mostrarse."""
+        self.raw += chunk
+        if self.finished:
+            return ""
+        if self.position is None:
+            match = self.pattern.search(self.raw)
+            if not match:
+                return ""
+            self.position = match.end()
+        decoded, i, raw = [], self.position, self.raw
+        while i < len(raw):
+            char = raw[i]
+            if char == '"':
+                self.finished = True
+                i += 1
+                break
+            if char != '\\':
+                decoded.append(char)
+                i += 1
+                continue
+            if i + 1 >= len(raw):
+                break # Escape incompleto: se espera el siguiente fragmento
+            if raw[i + 1] != 'u':
+                decoded.append(JSON_STRING_ESCAPES.get(raw[i + 1], raw[i + 1]))
+                i += 2
+                continue
+            if i + 6 > len(raw):
+                break
+            if not JSON_HEX4_RE.fullmatch(raw[i + 2:i + 6]):
+                self.finished = True
+                break
+            code = int(raw[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00: # Par sustituto (emoji): hacen falta los dos escapes
+                following = raw[i + 6:i + 12]
+                if not "\\u".startswith(following[:2]):
+                    code = 0xFFFD # Sustituto alto sin el bajo
+                elif len(following) < 6:
+                    break
+                elif not JSON_HEX4_RE.fullmatch(following[2:]):
+                    self.finished = True
+                    break
+                elif 0xDC00 <= int(following[2:], 16) < 0xE000:
+                    code = 0x10000 + ((code - 0xD800) << 10) + (int(following[2:], 16) - 0xDC00)
+                    i += 6
+                else:
+                    code = 0xFFFD # El escape siguiente no es un sustituto bajo: se decodifica en su propio turno
+            elif 0xDC00 <= code < 0xE000:
+                code = 0xFFFD # Sustituto bajo suelto
+            decoded.append(chr(code))
+            i += 6
+        self.position = i
+        return "".join(decoded)
+
+
+def markdown_cell(text):
+    """Texto apto para una celda de tabla Markdown."""
+    return str(text).replace("|", "\\|").replace("\n", " ")
 
 
-def get_llm_response(system_prompt: str, user_query: str):
-    """
-    Función de conexión a la API, leyendo la clave **SÓLO** desde st.secrets e inyectando contexto RAG.
-    Devuelve la respuesta como un generador de texto para el streaming.
-    """
-    try:
-        # Lectura exclusiva de la clave desde Streamlit Secrets
-        api_key = st.secrets["deepseek_api_key"]
-    except KeyError:
-        return iter(["❌ Conexión fallida. Por favor, verifica tu clave API."])
-    
-    # --- INYECCIÓN RAG CRÍTICA (Se mantiene la inyección de los chunks limitados) ---
-    rag_context = ""
-    # Documentos base
-    if 'reglamento_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (REGLAMENTO INTERIOR) ---\n{st.session_state['reglamento_content']}"
-    if 'ley_organica_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (LEY ORGANICA) ---\n{st.session_state['ley_organica_content']}"
-    if 'guia_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (GUÍA METODOLÓGICA) ---\n{st.session_state['guia_content']}"
-    if 'actividades_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (ACTIVIDADES PREVIAS DEL ÁREA) ---\n{st.session_state['actividades_content']}"
-    
-    # Documentos de alineación estratégica
-    if 'ods_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (ODS) ---\n{st.session_state['ods_content']}"
-    if 'gdm_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (GDM) ---\n{st.session_state['gdm_content']}"
-    if 'manual_ind_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (MANUAL INDICADORES) ---\n{st.session_state['manual_ind_content']}"
-    if 'pnd_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (PND) ---\n{st.session_state['pnd_content']}"
-    if 'pvd_content' in st.session_state: rag_context += f"\n\n--- CONTEXTO RAG (PVD) ---\n{st.session_state['pvd_content']}"
-    
-    # Documentos personalizados
-    if 'custom_docs_content' in st.session_state:
-        for doc_name, doc_content in st.session_state['custom_docs_content'].items():
-            # También limitamos el tamaño de los documentos personalizados
-            rag_context += f"\n\n--- CONTEXTO RAG (DOCUMENTO PERSONALIZADO: {doc_name}) ---\n{doc_content[:RAG_CHUNK_SIZE]}"
-
-
-    final_system_prompt = system_prompt.replace("{user_area_context}", st.session_state['area_context']['atribuciones_resumen'])
-    final_system_prompt += rag_context
-    # -----------------------------
-    
-    API_URL = "https://api.deepseek.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    messages = [
-        {"role": "system", "content": final_system_prompt},
-        {"role": "user", "content": user_query}
+def render_indicator(title, indicador):
+    rows = [
+        ("Nombre", 'nombre'), ("Resultado (R)", 'resultado'), ("Medición (M)", 'medicion'), ("Alcance (A)", 'alcance'),
+        ("Escala (E)", 'escala'), ("Temporalidad (T)", 'temporalidad'), ("Fórmula", 'formula'),
+        ("Medio de verificación", 'medio_verificacion'),
     ]
-    
-    payload = {
-        "model": "deepseek-chat", 
-        "messages": messages,
-        "temperature": 0.3, 
-        "max_tokens": 4000 
-    }
-    
-    # Usamos la conexión síncrona, pero con manejo de errores más específico.
-    try:
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=60)
-        
-        # Manejo específico del error 400 (Bad Request) y límites de tokens
-        if response.status_code == 400:
-             try:
-                 error_data = response.json()
-                 error_message = error_data.get('error', {}).get('message', 'Solicitud incorrecta (400 Bad Request).')
-                 # Si el error es de límite de contexto, lo reportamos claramente
-                 if "context length" in error_message:
-                    error_message = "❌ Límite de tokens excedido. Por favor, reinicia la conversación (INICIAR DE NUEVO) o revisa los documentos cargados. " + error_message
-                 return iter([f"❌ Error en la comunicación con la API. Detalle: {error_message}"])
-             except:
-                 return iter([f"❌ Error en la comunicación con la API. Detalle: 400 Client Error: Bad Request."])
+    return f"**{title}**\n\n| Elemento | Descripción |\n|---|---|\n" + "\n".join(
+        f"| {label} | {markdown_cell(indicador[key])} |" for label, key in rows
+    )
 
-        response.raise_for_status() 
-        
-        data = response.json()
-        
-        if data and 'choices' in data and data['choices']:
-            full_response = data['choices'][0]['message']['content']
-            
-            def stream_generator():
-                for char in full_response:
-                    yield char
-                    time.sleep(0.005) 
-            
-            return stream_generator()
-        else:
-            return iter([f"⚠️ Progob no pudo generar una respuesta. (Código: {response.status_code})"])
 
-    except requests.exceptions.RequestException as e:
-        return iter([f"❌ Error en la comunicación con la API. Detalle: {e}"])
-    except Exception as e:
-        return iter([f"❌ Error interno al procesar la respuesta. Detalle: {e}"])
+def render_causal_tree(arbol):
+    causas = "\n".join(
+        f"| {markdown_cell(item['causa'])} | {markdown_cell('; '.join(item['causas_indirectas']))} |"
+        for item in arbol['causas_directas']
+    )
+    efectos = "\n".join(
+        f"| {markdown_cell(item['efecto'])} | {markdown_cell('; '.join(item['efectos_indirectos']))} |"
+        for item in arbol['efectos_directos']
+    )
+    return (
+        "**Árbol de Problemas**\n\n| Causa directa | Causas indirectas |\n|---|---|\n" + causas
+        + "\n\n| Efecto directo | Efectos indirectos |\n|---|---|\n" + efectos
+    )
 
 
-# --------------------------------------------------------------------------
-# B. FUNCIONES DE PERSISTENCIA (LOCAL: DESCARGA/CARGA JSON/TXT)
-# --------------------------------------------------------------------------
+def render_check(label, ok, detail):
+    return f"{'✅' if ok else '⚠️'} **{label}:** {detail[0] if ok else detail[1]}"
 
-def get_pat_file_name(user_area):
-    """Genera el nombre de archivo para guardar el avance del PAT."""
-    clean_area = re.sub(r'[^\w\s-]', '', user_area.replace(' ', '_'))
-    return f"avance_pat_{clean_area}"
 
-def save_pat_progress(user_area, pat_data):
+# Orden y forma en que cada campo de la respuesta se convierte a Markdown ('mensaje' se muestra aparte, en vivo)
+PHASE_OUTPUT_RENDERERS = [
+    ('dentro_de_atribuciones', lambda v: render_check("Atribuciones", v, ("corresponde a la UR.", "no parece corresponder a la UR."))),
+    ('cumple_logica_vertical', lambda v: render_check("Lógica vertical", v, ("resuelve el Problema Central.", "no resuelve directamente el Problema Central."))),
+    ('cumple_sintaxis', lambda v: render_check("Sintaxis MIR", v, ("la redacción es válida.", "la redacción requiere ajustes."))),
+    ('observaciones', lambda v: "**Observaciones:**\n" + "\n".join(f"- {item}" for item in v)),
+    ('problema_confirmado', lambda v: f"**Problema Central confirmado:** *{v}*"),
+    ('proposito_confirmado', lambda v: f"**Propósito confirmado:** *{v}*"),
+    ('arbol', render_causal_tree),
+    ('indicador', lambda v: render_indicator("Indicador del Propósito (RMAE-T)", v)),
+    ('componentes_propuestos', lambda v: "**Componentes propuestos:**\n" + "\n".join(f"{n}. {item}" for n, item in enumerate(v, 1))),
+    ('componentes_confirmados', lambda v: "**Componentes confirmados:**\n" + "\n".join(f"{n}. {item}" for n, item in enumerate(v, 1))),
+    ('actividades', lambda v: "\n\n".join(
+        f"**Componente:** {item['componente']}\n\n" + render_indicator("Indicador de Gestión del Componente", item['indicador_componente'])
+        + f"\n\n**Actividad:** {item['actividad']}\n\n" + render_indicator("Indicador de Gestión de la Actividad", item['indicador_actividad'])
+        for item in v
+    )),
+    ('opciones', lambda v: "\n".join(f"- **Opción {item['opcion']}:** \"{item['redaccion']}\"" for item in v)),
+    ('pregunta', lambda v: v),
+]
+
+
+def render_phase_output(output):
+    """Markdown de los campos estructurados de una respuesta validada (sin 'mensaje')."""
+    sections = [render(output[field]) for field, render in PHASE_OUTPUT_RENDERERS if output.get(field) not in (None, [], "")]
+    return "".join(f"\n\n{section}" for section in sections)
+
+
+def structured_phase_stream(chunks, request, result):
     """
-    Esta función ya no se usa para la lógica de avance (eliminación del JSON).
+    Reenvía en vivo el 'mensaje' del JSON de la fase y, al terminar, valida la respuesta y entrega el resto en Markdown.
+    Si no cumple el esquema se pide una corrección automática (hasta STRUCTURED_OUTPUT_REPAIR_ATTEMPTS) con los errores,
+    sin turno extra del usuario. La salida validada queda en result['output']; si no se logra, se entrega un LLMError.
     """
-    pass
-    
-def generate_txt_conversation(messages, user_area):
-    """Genera una transcripción de la conversación en formato TXT/MD."""
-    
-    output = f"--- ASESORÍA PROGOB (MIR) ---\n"
-    output += f"UNIDAD RESPONSABLE: {user_area}\n"
-    output += f"FECHA DE EXPORTACIÓN: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M')}\n"
-    output += f"--- INICIO DE CONVERSACIÓN ---\n\n"
-    
-    for msg in messages:
-        role = msg["role"].upper()
-        content = msg["content"]
-        
-        output += f"## {role}:\n"
-        output += content + "\n\n"
-        
-    output += f"--- FIN DE CONVERSACIÓN ---\n"
-    
-    # Codificamos a UTF-8 para preservar tildes y eñes
-    return output.encode('utf-8') 
+    shown = False # Si ya se mostró un 'mensaje', el de la corrección no se repite
+    for attempt in range(STRUCTURED_OUTPUT_REPAIR_ATTEMPTS + 1):
+        reader = JsonStringFieldReader('mensaje')
+        streamed = False
+        for chunk in chunks:
+            if isinstance(chunk, LLMError):
+                yield chunk
+                return
+            text = reader.feed(chunk)
+            if text and not shown:
+                streamed = True
+                yield text
+        shown = shown or streamed
 
-def load_pat_progress(user_area):
+        output, errors = parse_structured_output(reader.raw, request['schema'])
+        if output is not None:
+            result['output'] = output
+            if not shown:
+                yield output['mensaje']
+            yield render_phase_output(output)
+            return
+        if attempt < STRUCTURED_OUTPUT_REPAIR_ATTEMPTS:
+            repair_query = (
+                request['query']
+                + "\n\nTu respuesta anterior NO cumplió el formato: " + "; ".join(errors[:10])
+                + ". Responde de nuevo con el objeto JSON completo y válido."
+            )
+            chunks = get_llm_response(SYSTEM_PROMPT, repair_query, request['rag_query'], memory_parts=request['memory_parts'], json_output=True)
+    yield LLMError(f"\n\n⚠️ La respuesta no tuvo el formato esperado ({errors[0]}). Envía de nuevo tu mensaje para reintentar.")
+
+
+def commit_on_success(chunks, commit):
     """
-    Maneja el uploader para restaurar el historial y el estado.
+    Reenvía el flujo de la respuesta y, si terminó sin ningún LLMError, ejecuta commit().
+    Si el flujo se interrumpe (rerun) o falla, commit() no se ejecuta.
     """
-    
-    st.sidebar.markdown("---")
-    # Este uploader ahora permite cargar un archivo JSON (con estado completo) o un TXT (solo historial)
-    uploaded_file = st.sidebar.file_uploader(
-        "⬆️ Cargar Conversación Previa (.json / .txt)",
-        type=['json', 'txt'],
-        key="pat_file_uploader",
-        help="Sube el archivo JSON de avance completo para restaurar la lógica, o un TXT para restaurar el historial de chat."
-    )
-    
-    # Definición del estado inicial vacío
-    empty_state = {
-        "problema": None, "problema_borrador": None,
-        "proposito": None, "proposito_borrador": None,
-        "componentes_final": None, "componentes_borrador": None,
-        "componentes_actividades": []
-    }
-    
-    messages = []
-    current_phase = 'inicio'
-
-    if uploaded_file is not None:
-        try:
-            bytes_data = uploaded_file.getvalue()
-            content = bytes_data.decode('utf-8')
-            
-            if uploaded_file.type == 'application/json':
-                 # Intenta cargar un estado completo (JSON)
-                 full_state = json.loads(content)
-                 pat_data = full_state.get('pat_data', empty_state)
-                 messages = full_state.get('messages', [])
-                 current_phase = full_state.get('current_phase', 'inicio')
-                 
-                 # Si la carga es exitosa, restauramos los mensajes y la fase actual
-                 st.session_state['messages'] = messages
-                 st.session_state['current_phase'] = current_phase
-                 st.session_state['pat_data'] = pat_data
-                 
-                 st.session_state['drive_status'] = f"✅ Avance '{uploaded_file.name}' cargado exitosamente."
-                 st.rerun() # Forzamos la recarga con el nuevo estado
-            
-            else: # Asume TXT o formato simple: restaurar solo el historial de mensajes
-                st.sidebar.warning("Solo se cargó el historial de texto. La lógica metodológica (fases) debe reiniciarse.")
-                # Creamos un historial simple a partir del texto
-                
-                # Buscamos el inicio de la conversación (para evitar metadata)
-                start_index = content.find("## ASSISTANT:") 
-                
-                if start_index == -1:
-                    # Si no encontramos el formato estructurado, usamos el texto completo como un mensaje
-                    messages = [{"role": "assistant", "content": "Historial restaurado, pero no se pudo parsear el formato estructurado."}, {"role": "user", "content": content}]
-                else:
-                    # Parseo simple para restaurar el historial (puede ser impreciso, es mejor que el usuario suba JSON)
-                    # Aquí solo guardaremos la última parte para reiniciar el chat
-                    messages = [{"role": "assistant", "content": "Historial de conversación restaurado. Por favor, reintroduce el Problema Central definitivo."}]
-                
-                st.session_state['messages'] = messages
-                st.session_state['pat_data'] = empty_state
-                st.session_state['current_phase'] = 'Diagnostico_Problema_Definicion' # Reiniciamos la fase.
-                st.rerun()
+    failed = False
+    for chunk in chunks:
+        failed = failed or isinstance(chunk, LLMError)
+        yield chunk
+    if not failed:
+        commit()
 
-            
-        except Exception as e:
-            st.sidebar.error(f"❌ Error al cargar el archivo: {e}")
-            
-    
-    st.session_state['drive_status'] = "⚠️ Persistencia: Esperando que cargue un avance o inicie un nuevo PAT."
-    # Retorna el estado inicial, ya que el estado cargado se maneja directamente con st.session_state
-    return empty_state, []
 
+# Fases en las que el usuario escribe un borrador que primero se revisa con las reglas locales
+LOCAL_VALIDATION_PHASES = {
+    'Diagnostico_Problema_Definicion': 'problema',
+    'Proposito_Definicion': 'proposito',
+    'Componentes_Definicion': 'componentes',
+}
 
-# --------------------------------------------------------------------------
-# Z. LÓGICA DE FASES (Maneja el flujo secuencial y didáctico)
-# --------------------------------------------------------------------------
 
-def handle_phase_logic(user_prompt: str, user_area: str):
-    """Maneja la lógica de avance por fases, haciendo hincapié en la validación."""
-    
-    current_phase = st.session_state.current_phase
-    
-    # La respuesta ya no es un string, sino un generador (iterable)
-    response_generator = None 
+def build_phase_request(current_phase: str, user_prompt: str, user_area: str, pat_data: dict, history: list, local_report=None):
+    """
+    Arma la solicitud de una fase sin enviarla: instrucciones para el modelo, consulta RAG, memoria y la transición
+    (siguiente fase y datos del PAT) que se confirmará si la respuesta es exitosa.
+    history son los mensajes previos al que se está respondiendo; local_report, la revisión sintáctica local del borrador.
+    """
+    # Transición pendiente: se aplica en commit_transition() sólo tras una respuesta exitosa
+    next_phase = None
+    pat_updates = {}
     
     # Contexto RAG para simplificar los prompts internos. Usamos el resumen de atribuciones.
     system_context_rag = f"Contexto de la UR ({user_area}): {st.session_state.area_context['atribuciones_resumen']}. Actividades: {st.session_state.area_context['actividades_resumen']}"
+
+    # Memoria acotada de los turnos previos
+    memory_parts = build_conversation_memory(pat_data, history, current_phase)
+
+    # Consulta de recuperación (BM25): área + tema de la fase + lo que el usuario escribió + artefactos validados
+    rag_query = " ".join(filter(None, [
+        user_area,
+        PHASE_RAG_TOPICS.get(current_phase, ""),
+        user_prompt,
+        pat_data.get('problema'),
+        pat_data.get('proposito'),
+    ]))
     
     # ----------------------------------------------------------------------
     # FASE 1: DIAGNÓSTICO (PROBLEMA CENTRAL) - DEFINICIÓN/PROPUESTA INICIAL
     # ----------------------------------------------------------------------
     if current_phase == 'Diagnostico_Problema_Definicion':
         # 1. Guarda la propuesta del usuario como borrador
-        st.session_state.pat_data['problema_borrador'] = user_prompt
+        pat_updates['problema_borrador'] = user_prompt
         
         # Prompt basado en la Guía Metodológica para validación (Módulo 7)
         query_llm = f"""
@@ -518,35 +3857,31 @@ def handle_phase_logic(user_prompt: str, user_area: str):
         Como Enlace Senior de Progob: 
         1.  **Explica didácticamente** qué es el Problema Central y su estructura (población + situación no deseada).
         2.  Usando el Reglamento Interior y la Ley Orgánica (RAG), **valida brevemente** si el problema está dentro de las atribuciones de la UR.
-        3.  Usando la Guía Metodológica (RAG), evalúa el enunciado. Si la redacción del usuario es correcta, **confirma que es una redacción válida y ajusta la sintaxis si es necesario**. Si el enunciado incumple reglas (es ausencia de servicio, o incluye soluciones), propón una redacción ajustada (Opción A, B).
-        4.  **Pregunta al usuario** si está de acuerdo con la validación y la redacción final, o si desea modificarla. **IMPORTANTE: El Problema Central definitivo DEBE ser copiado y pegado o redactado por el usuario en su próxima respuesta.**
-        5.  Instrucción de Respuesta: Responde con la redacción completa elegida o propuesta. **NO AVANCES A CAUSAS/EFECTOS.**
+        3.  Usando la Guía Metodológica (RAG), evalúa el enunciado (campos cumple_sintaxis y observaciones). Si la redacción del usuario es correcta, **confirma que es una redacción válida y ajusta la sintaxis si es necesario**. Si el enunciado incumple reglas (es ausencia de servicio, o incluye soluciones), propón una redacción ajustada (opciones A, B).
+        4.  **Pregunta al usuario** si está de acuerdo con la validación y la redacción final, o si desea modificarla; indícale que responda con la opción elegida o con su propia redacción completa. **NO AVANCES A CAUSAS/EFECTOS.**
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
-        st.session_state.current_phase = 'Diagnostico_Problema_Validacion'
+        next_phase = 'Diagnostico_Problema_Validacion'
         
     # ----------------------------------------------------------------------
     # FASE 2: PROBLEMA CENTRAL - VALIDACIÓN FINAL Y GENERACIÓN DE ÁRBOL
     # ----------------------------------------------------------------------
     elif current_phase == 'Diagnostico_Problema_Validacion':
         
-        # Si llegamos aquí, asumimos que el usuario proporcionó la redacción completa o la corrigió.
-        st.session_state.pat_data['problema'] = user_prompt
-            
+        # El Problema Central confirmado (y el árbol) salen de la respuesta validada: ver PHASE_OUTPUT_FIELDS
         # Pasamos a la siguiente fase real de generación de árbol
         query_llm = f"""
         **FASE ACTUAL: Problema Central (Confirmado).** {system_context_rag}
-        El Problema Central FINAL confirmado es: "{user_prompt}".
+        Problema Central propuesto (borrador): "{pat_data.get('problema_borrador') or 'N/A'}".
+        El usuario confirma el Problema Central con esta respuesta: "{user_prompt}".
         
         Como Enlace Senior de Progob: 
-        1.  **Confirma la recepción** del Problema Central definitivo de manera didáctica, citándolo.
+        1.  **Determina la redacción completa** del Problema Central confirmado (si el usuario eligió una opción propuesta, usa su redacción íntegra) y devuélvela en problema_confirmado.
         2.  **Explica didácticamente** qué es el Análisis Causal / Árbol de Problemas y la diferencia entre Causas Directas e Indirectas.
-        3.  Usando el Problema Central confirmado y la Guía Metodológica (RAG), **genera** 3 Causas Directas y al menos 2 Causas Indirectas por cada una, explorando enfoques diferentes (social, institucional, operativo, etc.). **Asegúrate de generar los Efectos Directos e Indirectos correspondientes al problema central** y preséntalos en una tabla estructurada y clara.
+        3.  Usando el Problema Central confirmado y la Guía Metodológica (RAG), **genera** 3 Causas Directas y al menos 2 Causas Indirectas por cada una, explorando enfoques diferentes (social, institucional, operativo, etc.). **Asegúrate de generar los Efectos Directos e Indirectos correspondientes al problema central**. El árbol va en el campo arbol (se presentará como tabla).
         4.  **Pregunta al usuario** si está de acuerdo con la lógica causal del Árbol propuesto (Causas y Efectos) antes de avanzar a la transformación en Propósito/Objetivos. (Ej: Responde 'Acepto el Árbol' o 'Propongo la siguiente modificación a la causa 2...'). **NO AVANCES A PROPÓSITO.**
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
         # TRANSICIÓN A LA FASE: VALIDACIÓN DEL ÁRBOL
-        st.session_state.current_phase = 'Diagnostico_Arbol_Validacion'
+        next_phase = 'Diagnostico_Arbol_Validacion'
         
     # ----------------------------------------------------------------------
     # FASE 3: ÁRBOL DE PROBLEMAS - VALIDACIÓN FINAL Y PROPUESTAS DE PROPÓSITO
@@ -554,7 +3889,7 @@ def handle_phase_logic(user_prompt: str, user_area: str):
     elif current_phase == 'Diagnostico_Arbol_Validacion':
         # El prompt del usuario es la confirmación/corrección del Árbol de Problemas.
         
-        problema_final = st.session_state.pat_data.get('problema', 'Problema no definido')
+        problema_final = pat_data.get('problema', 'Problema no definido')
         
         query_llm = f"""
         **FASE ACTUAL: Árbol de Problemas (Confirmado).** {system_context_rag}
@@ -562,23 +3897,21 @@ def handle_phase_logic(user_prompt: str, user_area: str):
         El usuario ha validado o ajustado el Árbol de Problemas (su última respuesta fue: "{user_prompt}").
         
         Como Enlace Senior de Progob: 
-        1.  **Felicita al usuario** por completar el Análisis Causal.
+        1.  **Felicita al usuario** por completar el Análisis Causal. Si el usuario propuso cambios al árbol, devuelve el árbol completo ajustado en el campo arbol.
         2.  **Guía al usuario** a la siguiente fase: **Propósito**. Explica que el Propósito es la imagen en positivo del Problema Central (Objetivo General) y la importancia de la Lógica Vertical.
-        3.  Usando el Problema Central ("{problema_final}") y las Actividades Previas (RAG), **propón tres opciones de Propósito** que se deriven directamente de la superación del problema validado (Opciones A, B, C). Deben seguir la sintaxis de la MIR (Beneficiario + verbo en presente + resultado).
-        4.  Instruye al usuario a seleccionar una opción. **IMPORTANTE: El Propósito definitivo DEBE ser copiado y pegado o redactado por el usuario en su próxima respuesta.**
-        5.  Instrucción de Respuesta: Responde con la redacción completa elegida o propuesta.
+        3.  Usando el Problema Central ("{problema_final}") y las Actividades Previas (RAG), **propón tres opciones de Propósito** que se deriven directamente de la superación del problema validado (opciones A, B, C). Deben seguir la sintaxis de la MIR (Beneficiario + verbo en presente + resultado).
+        4.  Instruye al usuario a seleccionar una opción o a escribir su propia redacción completa.
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
         # TRANSICIÓN A LA FASE: DEFINICIÓN DEL PROPÓSITO
-        st.session_state.current_phase = 'Proposito_Definicion'
+        next_phase = 'Proposito_Definicion'
         
     # ----------------------------------------------------------------------
     # FASE 4: PROPÓSITO - DEFINICIÓN Y VALIDACIÓN METODOLÓGICA
     # ----------------------------------------------------------------------
     elif current_phase == 'Proposito_Definicion':
         # 1. Guarda la propuesta del usuario como borrador
-        st.session_state.pat_data['proposito_borrador'] = user_prompt
-        problema_final = st.session_state.pat_data.get('problema', 'Problema no definido')
+        pat_updates['proposito_borrador'] = user_prompt
+        problema_final = pat_data.get('problema', 'Problema no definido')
         
         query_llm = f"""
         **FASE ACTUAL: Propósito (Borrador).** {system_context_rag}
@@ -587,31 +3920,33 @@ def handle_phase_logic(user_prompt: str, user_area: str):
         
         Como Enlace Senior de Progob: 
         1.  **Define brevemente** el Propósito según la MML (RAG).
-        2.  **Valida** si el Propósito cumple con la **Lógica Vertical** (ser la solución directa al Problema) y las reglas de sintaxis de la MIR (Beneficiario + verbo en presente + resultado). Si no lo está, **propónle una redacción ajustada** que cumpla el criterio (Opción A, B).
+        2.  **Valida** si el Propósito cumple con la **Lógica Vertical** (ser la solución directa al Problema) y las reglas de sintaxis de la MIR (Beneficiario + verbo en presente + resultado). Si no lo está, **propónle una redacción ajustada** que cumpla el criterio (opciones A, B).
         3.  **Pregunta al usuario** si está de acuerdo con la validación y la redacción final, o si desea modificarla. (Ej: Responde 'Acepto la opción A' o 'Propongo la siguiente corrección...').
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
-        st.session_state.current_phase = 'Proposito_Validacion'
+        next_phase = 'Proposito_Validacion'
 
     # ----------------------------------------------------------------------
     # FASE 5: PROPÓSITO - CONFIRMACIÓN E INDICADOR RMAE-T
     # ----------------------------------------------------------------------
     elif current_phase == 'Proposito_Validacion':
-        # 1. El prompt del usuario es la validación final del propósito
-        st.session_state.pat_data['proposito'] = user_prompt
-        
+        # 1. El prompt del usuario es la validación final del propósito (la redacción sale de la respuesta validada)
         query_llm = f"""
         **FASE ACTUAL: Propósito (Confirmado).** {system_context_rag}
-        Propósito FINAL confirmado: "{user_prompt}".
+        Propósito propuesto (borrador): "{pat_data.get('proposito_borrador') or 'N/A'}".
+        El usuario confirma el Propósito con esta respuesta: "{user_prompt}".
         
         Como Enlace Senior de Progob: 
+        0.  **Determina la redacción completa** del Propósito confirmado (si eligió una opción, su redacción íntegra) y devuélvela en proposito_confirmado.
         1.  **Explica didácticamente** qué es un Indicador RMAE-T (Resultado, Medición, Alcance, Escala, Temporalidad) y por qué los indicadores de Propósito deben ser Estratégicos.
-        2.  **Genera** un borrador de Indicador del Propósito (RMAE-T) y el Medio de Verificación.
+        2.  **Genera** un borrador de Indicador del Propósito (RMAE-T) y el Medio de Verificación (campo indicador).
         3.  **Guía al usuario** a la siguiente fase: **Componentes**. Explica que los Componentes son los productos/servicios que la UR debe entregar (imagen en positivo de las causas directas).
         4.  Pídele al usuario que, basado en sus Actividades Previas (RAG), **liste los 2 o 3 productos/servicios principales** que su área debe entregar para alcanzar ese Propósito.
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
-        st.session_state.current_phase = 'Componentes_Definicion'
+        # Sólo las mejores fichas del catálogo local viajan al modelo, no los PDFs de indicadores completos
+        query_llm += indicator_suggestions(
+            f"{pat_data.get('proposito_borrador') or ''} {user_prompt} {pat_data.get('problema') or ''}", level='Propósito'
+        )
+        next_phase = 'Componentes_Definicion'
 
 
     # ----------------------------------------------------------------------
@@ -620,8 +3955,8 @@ def handle_phase_logic(user_prompt: str, user_area: str):
     elif current_phase == 'Componentes_Definicion':
          
          # 1. Guardamos la propuesta de Componentes del usuario como borrador
-         st.session_state.pat_data['componentes_borrador'] = user_prompt
-         proposito_final = st.session_state.pat_data.get('proposito', 'Propósito no definido')
+         pat_updates['componentes_borrador'] = user_prompt
+         proposito_final = pat_data.get('proposito', 'Propósito no definido')
          
          query_llm = f"""
         **FASE ACTUAL: Componentes (Borrador).** {system_context_rag}
@@ -630,41 +3965,39 @@ def handle_phase_logic(user_prompt: str, user_area: str):
         
         Como Enlace Senior de Progob: 
         1.  **Define brevemente** qué es un Componente según la MML (RAG).
-        2.  **Evalúa** la lista del usuario (separa la lista en 2 o 3 elementos) y valida su coherencia con el Propósito (Lógica Vertical).
-        3.  Usando la regla de sintaxis de la MIR (Bien / servicio entregado + verbo en pasado participio), **propón** una lista final ajustada.
+        2.  **Evalúa** la lista del usuario (separa la lista en 2 o 3 elementos) y valida su coherencia con el Propósito (Lógica Vertical) en observaciones.
+        3.  Usando la regla de sintaxis de la MIR (Bien / servicio entregado + verbo en pasado participio), **propón** una lista final ajustada (componentes_propuestos, un componente por elemento).
         4.  **Pregunta al usuario** si está de acuerdo con la lista final o si desea modificarla. (Ej: Responde 'Acepto la lista' o 'Propongo la siguiente lista corregida...').
         """
-         response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
-         st.session_state.current_phase = 'Componentes_Validacion'
+         next_phase = 'Componentes_Validacion'
          
     # ----------------------------------------------------------------------
     # FASE 7: VALIDACIÓN DE COMPONENTES Y CIERRE DE MIR
     # ----------------------------------------------------------------------
     elif current_phase == 'Componentes_Validacion':
         
-        # 1. El prompt del usuario es la validación final de los componentes
-        # Dividimos la respuesta en una lista de componentes (asumiendo que vienen separados por lista, coma o nueva línea)
-        componentes_list = [c.strip() for c in re.split(r'[\n\r\t*•-]', user_prompt) if c.strip()]
-        st.session_state.pat_data['componentes_final'] = componentes_list
-        
-        primer_componente = componentes_list[0] if componentes_list else "Componente no definido"
+        # 1. La respuesta del usuario confirma (o corrige) la lista propuesta. La lista definitiva la devuelve el modelo
+        #    como arreglo JSON (componentes_confirmados): un componente con guiones o viñetas ya no se parte en pedazos.
+        componentes_propuestos = pat_data.get('componentes_propuestos') or []
         
         query_llm = f"""
         **FASE ACTUAL: Componentes (Confirmados).** {system_context_rag}
-        Propósito: "{st.session_state.pat_data.get('proposito', 'Propósito no definido')}".
-        Componentes FINALES confirmados: "{', '.join(componentes_list)}".
+        Propósito: "{pat_data.get('proposito', 'Propósito no definido')}".
+        Componentes propuestos: {json.dumps(componentes_propuestos, ensure_ascii=False)}.
+        El usuario confirma los Componentes con esta respuesta: "{user_prompt}".
         
         Como Enlace Senior de Progob: 
+        0.  **Determina la lista definitiva** de Componentes confirmados (la propuesta si la aceptó, o la que escribió el usuario) y devuélvela en componentes_confirmados, un componente por elemento.
         1.  **Felicita al usuario** por completar la Lógica Vertical (Fin, Propósito, Componentes).
         2.  **Explica** la fase de **Actividades** (imagen en positivo de las Causas Indirectas).
-        3.  Usando la Guía Metodológica (RAG), genera:
-            a) Un borrador de Indicador de Gestión (RMAE-T) para el Componente: "{primer_componente}".
+        3.  Usando la Guía Metodológica (RAG), genera en actividades, al menos para el primer Componente confirmado:
+            a) Un borrador de Indicador de Gestión (RMAE-T) para el Componente.
             b) Un borrador de Indicador de Gestión para la Actividad (Sustantivo derivado de un verbo + complemento) que se requeriría para producir ese componente.
         4.  Instruye al usuario sobre cómo estos Componentes y Actividades deben pasar al Calendario de Trabajo Anual (PAT) y finalizar la MIR.
         5.  Declara el proceso de la Lógica Vertical como 'COMPLETADO' y recuérdale al usuario la importancia de la **Lógica Horizontal** (Indicadores, Medios de Verificación y Supuestos) para finalizar la MIR.
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
-        st.session_state.current_phase = 'Fin_MIR'
+        query_llm += indicator_suggestions(f"{' '.join(componentes_propuestos)} {user_prompt}", level='Componente')
+        next_phase = 'Fin_MIR'
 
 
     # ----------------------------------------------------------------------
@@ -675,10 +4008,10 @@ def handle_phase_logic(user_prompt: str, user_area: str):
         
         # Mapeo de fases y progreso para dar contexto a la IA
         fase_map = {
-            'Diagnostico_Problema_Validacion': f"Validación del Problema: **{st.session_state.pat_data.get('problema_borrador', 'N/A')}**",
-            'Diagnostico_Arbol_Validacion': f"Validación del Árbol de Problemas con Problema: **{st.session_state.pat_data.get('problema', 'N/A')}**",
-            'Proposito_Validacion': f"Validación del Propósito: **{st.session_state.pat_data.get('proposito_borrador', 'N/A')}**",
-            'Componentes_Validacion': f"Validación de Componentes: **{st.session_state.pat_data.get('componentes_borrador', 'N/A')}**"
+            'Diagnostico_Problema_Validacion': f"Validación del Problema: **{pat_data.get('problema_borrador', 'N/A')}**",
+            'Diagnostico_Arbol_Validacion': f"Validación del Árbol de Problemas con Problema: **{pat_data.get('problema', 'N/A')}**",
+            'Proposito_Validacion': f"Validación del Propósito: **{pat_data.get('proposito_borrador', 'N/A')}**",
+            'Componentes_Validacion': f"Validación de Componentes: **{pat_data.get('componentes_borrador', 'N/A')}**"
         }
         
         progreso_actual = fase_map.get(current_phase, "Fase: Inicio")
@@ -696,20 +4029,170 @@ def handle_phase_logic(user_prompt: str, user_area: str):
         2.  **NO AVANCES DE FASE.**
         3.  Recuérdale, de manera cortés, el paso pendiente que debe completar para avanzar en la fase **{current_phase.replace('_', ' ')}**.
         """
-        response_generator = get_llm_response(SYSTEM_PROMPT, query_llm)
     
-    # 2. Obtener el contenido completo del generador
-    response_content = "".join(list(response_generator))
+    if local_report is not None:
+        query_llm += local_validation_note(LOCAL_VALIDATION_PHASES[current_phase], local_report)
+
+    schema = PHASE_OUTPUT_SCHEMAS.get(current_phase, DEFAULT_PHASE_OUTPUT_SCHEMA)
+    return {
+        'query': query_llm + structured_output_instructions(schema),
+        'rag_query': rag_query,
+        'memory_parts': memory_parts,
+        'next_phase': next_phase,
+        'pat_updates': pat_updates,
+        'schema': schema,
+        'output_fields': PHASE_OUTPUT_FIELDS.get(current_phase, {}),
+    }
+
+
+# Modo especulativo: mientras el usuario lee las opciones (A, B, C), se precalcula la respuesta de la fase
+# siguiente para cada una. Si elige una textualmente, se sirve esa respuesta y se descartan las demás.
+SPECULATIVE_PREFETCH_ENABLED = False # Consume tokens por opciones que no se elegirán: activar según el presupuesto
+SPECULATIVE_PHASES = ('Diagnostico_Problema_Validacion', 'Proposito_Validacion') # Fases lentas (árbol, indicador RMAE-T)
+SPECULATIVE_MAX_OPTIONS = 3
+SPECULATIVE_TOKEN_BUDGET = 60000 # Tokens (prompt estimado + max_tokens) por ronda de opciones
+OPTION_LINE_RE = re.compile(r"^[\s>*#•\-]*(?:\*\*)?\s*Opci[oó]n\s+([A-C])\b[\s*:.)\-–—]*(.*)$", re.IGNORECASE)
+OPTION_QUOTED_RE = re.compile(r"[\"“«](.{15,}?)[\"”»]")
+
+
+def extract_offered_options(text):
+    """Opciones propuestas por el modelo como {letra: redacción}; si la línea trae texto entrecomillado, se usa ése."""
+    options = {}
+    lines = text.splitlines()
+    for index, line in enumerate(lines):
+        match = OPTION_LINE_RE.match(line)
+        if not match or match.group(1).upper() in options:
+            continue
+        statement = match.group(2).strip()
+        if not statement.strip("*_: "): # La redacción viene en la línea siguiente
+            statement = next((following.strip() for following in lines[index + 1:] if following.strip()), "")
+        quoted = OPTION_QUOTED_RE.search(statement)
+        statement = (quoted.group(1) if quoted else statement).strip(" *_\"“”«»")
+        if statement:
+            options[match.group(1).upper()] = statement
+    return options
 
-    # 3. Guardar avance después de cada paso lógico y actualizar el estado de descarga
-    # Ya no llamamos a save_pat_progress aquí.
+
+def normalize_option(text):
+    """Forma comparable de una opción: sin acentos, mayúsculas, puntuación ni el prefijo 'Opción X'."""
+    text = re.sub(r"^\W*opcion\s+[a-c]\b", "", unidecode(text).lower())
+    return " ".join(re.findall(r"\w+", text))
+
+
+def cancel_speculative_jobs():
+    """Descarta las respuestas especulativas pendientes de la sesión."""
+    speculative = st.session_state.pop('speculative_jobs', None)
+    if speculative:
+        for job in speculative['jobs'].values():
+            job.cancel()
+
+
+def start_speculative_prefetch(assistant_message, user_area):
+    """
+    Tras una respuesta que ofrece opciones, encola en segundo plano la fase actual para cada opción, dentro de
+    SPECULATIVE_TOKEN_BUDGET. Los trabajos comparten la fila justa del usuario, así que no desplazan a otros usuarios.
+    """
+    cancel_speculative_jobs()
+    phase = st.session_state.current_phase
+    # Opciones de la respuesta estructurada; el diagnóstico inicial (texto libre) se interpreta del Markdown
+    options = st.session_state.pop('offered_options', None) or extract_offered_options(assistant_message)
+    if not SPECULATIVE_PREFETCH_ENABLED or phase not in SPECULATIVE_PHASES:
+        return
+    jobs, spent = {}, 0
+    for letter, statement in list(options.items())[:SPECULATIVE_MAX_OPTIONS]:
+        # Mismo historial que tendrá la solicitud real: todo lo previo al mensaje con la opción elegida
+        request = build_phase_request(phase, statement, user_area, st.session_state.pat_data, st.session_state.messages)
+        job = start_llm_job(
+            SYSTEM_PROMPT, request['query'], request['rag_query'], memory_parts=request['memory_parts'],
+            speculative_key=f"{get_llm_session_key()}:especulativa:{letter}", json_output=True,
+            max_cost_tokens=SPECULATIVE_TOKEN_BUDGET - spent, # Sin cupo no se encola (no hay que cancelar nada)
+        )
+        if job is None:
+            break
+        spent += job.cost_tokens
+        jobs[normalize_option(statement)] = job
+    if jobs:
+        st.session_state['speculative_jobs'] = {'phase': phase, 'jobs': jobs}
+
+
+def take_speculative_job(current_phase, user_prompt):
+    """Devuelve el trabajo precalculado si el usuario eligió textualmente una opción; descarta los demás."""
+    speculative = st.session_state.pop('speculative_jobs', None)
+    if not speculative:
+        return None
+    job = speculative['jobs'].pop(normalize_option(user_prompt), None) if speculative['phase'] == current_phase else None
+    for other in speculative['jobs'].values():
+        other.cancel()
+    if job and job.cancelled.is_set():
+        job = None
+    get_llm_metrics().record_speculation(hit=job is not None)
+    return job
+
+
+def handle_phase_logic(user_prompt: str, user_area: str):
+    """
+    Maneja la lógica de avance por fases, haciendo hincapié en la validación.
+    Devuelve el generador de la respuesta para pintarlo en vivo con st.write_stream.
+    """
+    current_phase = st.session_state.current_phase
+
+    # Revisión sintáctica local del borrador: si rompe una regla de la Guía se responde al instante, sin llamar al modelo.
+    # Si el usuario reenvía el mismo texto, se respeta su criterio y pasa al modelo junto con las observaciones.
+    local_report = None
+    kind = LOCAL_VALIDATION_PHASES.get(current_phase)
+    if kind and is_mir_statement(user_prompt):
+        local_report = validate_mir_statement(kind, user_prompt)
+        draft_key = (current_phase, normalize_option(user_prompt))
+        insisted = st.session_state.pop('rejected_draft', None) == draft_key
+        get_llm_metrics().record_local_validation(blocked=bool(local_report['errors']) and not insisted)
+        if local_report['errors'] and not insisted:
+            st.session_state['rejected_draft'] = draft_key
+            return iter([render_local_validation(kind, local_report)])
+
+    # El último mensaje del historial es el que se está respondiendo
+    request = build_phase_request(
+        current_phase, user_prompt, user_area, st.session_state.pat_data, st.session_state.messages[:-1], local_report
+    )
+    
+    # Si el usuario eligió textualmente una opción ya precalculada, se sirve esa respuesta (o su flujo en curso)
+    speculative_job = take_speculative_job(current_phase, user_prompt)
+    if speculative_job:
+        response_generator = speculative_job.stream(on_wait=queue_notice())
+    else:
+        response_generator = get_llm_response(
+            SYSTEM_PROMPT, request['query'], request['rag_query'], memory_parts=request['memory_parts'], json_output=True
+        )
+    
+    # Devolvemos el generador: la vista lo pinta en vivo conforme llegan los tokens ('mensaje') y después los
+    # artefactos en Markdown. El avance de fase (y lo capturado en pat_data) se confirma sólo si la respuesta llegó
+    # completa, sin errores y cumpliendo el esquema; si falla, el usuario puede reenviar el mismo mensaje.
+    result = {}
+    def commit_transition():
+        output = result['output']
+        st.session_state.pat_data.update(request['pat_updates'])
+        st.session_state.pat_data.update(
+            {field: output[key] for field, key in request['output_fields'].items() if output.get(key)}
+        )
+        st.session_state['offered_options'] = {item['opcion']: item['redaccion'] for item in output.get('opciones', [])}
+        if request['next_phase']:
+            st.session_state.current_phase = request['next_phase']
     
-    return response_content
+    return commit_on_success(structured_phase_stream(response_generator, request, result), commit_transition)
 
 # --------------------------------------------------------------------------
 # C. VISTA DEL ASESOR (CHAT INTERACTIVO)
 # --------------------------------------------------------------------------
 
+@st.fragment(run_every=CUSTOM_DOC_POLL_SECONDS)
+def custom_docs_progress():
+    """Barra de avance de los documentos personalizados en proceso; al terminar todos, vuelve a pintar la app."""
+    pending = pending_custom_documents()
+    if not pending:
+        st.rerun(scope="app")
+    for document in pending:
+        st.progress(document.progress, text=f"Procesando '{document.file_name}'...")
+
+
 def chat_view(user_name, user_area):
     """Nueva interfaz principal basada en chat y flujo secuencial."""
     st.title(f"Asesor Metodológico Progob | {user_area}")
@@ -718,8 +4201,10 @@ def chat_view(user_name, user_area):
     # --- 1. Inicializar/Cargar estados ---
     # La función load_pat_progress ahora devuelve pat_data y messages
     if 'pat_data' not in st.session_state:
-        st.session_state.pat_data, initial_messages = load_pat_progress(user_area)
-        st.session_state.messages = initial_messages
+        # Primero el avance guardado en el servidor (reanudación instantánea); si no hay, el cargador de archivos
+        if not restore_pat_progress(user_area):
+            st.session_state.pat_data, initial_messages = load_pat_progress(user_area)
+            st.session_state.messages = initial_messages
     
     # Determinar la fase actual basado en los datos cargados
     if 'current_phase' not in st.session_state:
@@ -735,9 +4220,9 @@ def chat_view(user_name, user_area):
         # 🌟 CARGA CRÍTICA DEL CONTEXTO (RAG) - USAMOS LOS RESÚMENES AQUÍ
         st.session_state.area_context = load_area_context(user_area)
         
-        # Inicializamos el contenedor de documentos personalizados si no existe
-        if 'custom_docs_content' not in st.session_state:
-            st.session_state['custom_docs_content'] = {}
+        # Inicializamos el contenedor de documentos personalizados si no existe (hash -> CustomDocument)
+        if 'custom_docs' not in st.session_state:
+            st.session_state['custom_docs'] = {}
         
         # Generar el mensaje de bienvenida completo SÓLO si la conversación es nueva
         if not st.session_state.messages:
@@ -758,6 +4243,13 @@ def chat_view(user_name, user_area):
                  
                  # Nuevo Prompt para generar el Diagnóstico Inicial Detallado (puntos 1-5)
                  # Se agrega la instrucción de buscar alineación PND y PVD y proponer problemas.
+                 # Los indicadores candidatos salen del catálogo local (búsqueda por el nombre y las actividades de la UR)
+                 catalog = get_indicator_catalog()
+                 catalog_query = f"{user_area} {st.session_state.area_context['actividades_previas']}"
+                 gdm_candidates = format_indicator_candidates(catalog.search(catalog_query, 6, source="GDM 2025-2027"))
+                 manual_candidates = format_indicator_candidates(
+                     catalog.search(catalog_query, 6, source="Manual de Indicadores para Municipios (INAFED)")
+                 )
                  initial_query = f"""
                  Genera el mensaje de diagnóstico inicial para la Unidad Responsable '{user_area}'. 
                  Debes cumplir **estrictamente** los siguientes puntos usando el RAG:
@@ -765,23 +4257,40 @@ def chat_view(user_name, user_area):
                  2.  Identifica y explica de forma exhaustiva las prioridades vinculadas al área de la UR en el **Plan Nacional de Desarrollo (PND)** y en el **Plan Veracruzano de Desarrollo (PVD)** (contextos RAG).
                  3.  Explica y lista las **atribuciones completas** de la UR, citando el Reglamento Interior y la Ley Orgánica.
                  4.  Presenta el **LISTADO COMPLETO** de sus actividades previas (del CSV).
-                 5.  Identifica y lista 3 indicadores aplicables del **GDM** y 3 del **Manual de Indicadores para Municipios** que debe considerar la UR.
+                 5.  De los candidatos del catálogo local que siguen, elige y lista 3 indicadores aplicables del **GDM** y 3 del **Manual de Indicadores para Municipios** que debe considerar la UR (cita su clave entre corchetes; si un grupo no tiene candidatos, usa el RAG).
+                     Candidatos GDM:
+{gdm_candidates or "                     (sin coincidencias)"}
+                     Candidatos Manual de Indicadores:
+{manual_candidates or "                     (sin coincidencias)"}
                  6.  Explica brevemente qué es la Metodología de Marco Lógico (MML), que su primer paso es el **Problema Central**, qué es el Problema Central y su estructura, y el por qué usaremos **microfases** (validación obligatoria del usuario). Finalmente, **propón 3 opciones de Problema Central** basados en el análisis de atribuciones y actividades (Opciones A, B, C).
                  """
                  # Ejecutamos el LLM para obtener el generador de respuesta
-                 response_generator = get_llm_response(SYSTEM_PROMPT, initial_query)
+                 # El diagnóstico es determinista por UR: se sirve desde la caché local si ya se generó antes
+                 response_generator = get_llm_response(
+                     SYSTEM_PROMPT, initial_query, f"{user_area} {INITIAL_DIAGNOSTIC_RAG_TOPICS}", cacheable=True
+                 )
                  
                  # Usamos Streamlit para escribir la respuesta en el chat en tiempo real
+                 succeeded = []
                  with st.chat_message("assistant"):
                      # El generador devuelve los trozos de la respuesta.
-                     full_response_content = st.write_stream(response_generator)
-                 
-                 # Guardamos la respuesta COMPLETA (ya streameada) en el historial de mensajes
-                 st.session_state.messages.append({"role": "assistant", "content": full_response_content})
-                 st.session_state.current_phase = 'Diagnostico_Problema_Definicion'
+                     full_response_content = st.write_stream(render_stream(
+                         commit_on_success(response_generator, lambda: succeeded.append(True))
+                     ))
                  
-                 # FIX CRÍTICO DE FLUJO: Forzar el RERUN para que el chat_input aparezca.
-                 st.rerun() 
+                 if succeeded:
+                     # Guardamos la respuesta COMPLETA (ya streameada) en el historial de mensajes
+                     st.session_state.messages.append({"role": "assistant", "content": full_response_content})
+                     st.session_state.current_phase = 'Diagnostico_Problema_Definicion'
+                     save_pat_progress(user_area, st.session_state.pat_data)
+                     start_speculative_prefetch(full_response_content, user_area)
+                     
+                     # FIX CRÍTICO DE FLUJO: Forzar el RERUN para que el chat_input aparezca.
+                     st.rerun() 
+                 else:
+                     # Falló: no se avanza de fase ni se guarda; el error queda a la vista y el diagnóstico se vuelve
+                     # a pedir en la siguiente interacción (sin rerun inmediato, para no insistir al proveedor caído)
+                     del st.session_state['area_context']
     
     # -----------------------------------------------------------------
     # SIDEBAR: BOTONES DE PERSISTENCIA Y CARGA DE DOCUMENTOS
@@ -815,42 +4324,43 @@ def chat_view(user_name, user_area):
     )
     
     if uploaded_custom_file is not None:
-        file_name = uploaded_custom_file.name
-        
-        # Lógica para extraer contenido (se mantiene)
-        content = ""
-        try:
-            if file_name.endswith('.pdf'):
-                tfile = uploaded_custom_file
-                pdf_reader = pypdf.PdfReader(tfile)
-                for page in pdf_reader.pages:
-                    content += page.extract_text() or ""
-            else: # Asumir .txt
-                 content = uploaded_custom_file.getvalue().decode('utf-8')
-        except Exception as e:
-            st.sidebar.error(f"Error al procesar el archivo: {e}")
-            content = ""
+        # Se procesa en segundo plano y una sola vez por contenido (los reruns no lo vuelven a leer)
+        add_custom_document(uploaded_custom_file)
 
-        
-        if content and len(content) > 50:
-            if 'custom_docs_content' not in st.session_state:
-                st.session_state['custom_docs_content'] = {}
-            
-            # Solo guardamos un chunk para que no exceda el límite de tokens RAG
-            st.session_state['custom_docs_content'][file_name] = content[:RAG_CHUNK_SIZE]
-            st.sidebar.success(f"✅ Documento '{file_name}' cargado al contexto RAG.")
-            # Reforzamos el mensaje de bienvenida con el nuevo contexto
-            st.session_state.messages.append({"role": "assistant", "content": f"**Progob Nota:** El documento '{file_name}' ha sido incorporado al contexto de conocimiento. Lo usaré para alinear mis respuestas a sus lineamientos internos."})
-            # Limpiamos el uploader para permitir otra subida
-            uploaded_custom_file = None
+    # Avisos de los documentos que terminaron de procesarse (una sola vez por documento y sesión)
+    announced = st.session_state.setdefault('custom_docs_announced', set())
+    for document in st.session_state.get('custom_docs', {}).values():
+        if document.content_hash in announced or not document.done.is_set():
+            continue
+        announced.add(document.content_hash)
+        if document.error:
+            st.sidebar.error(f"❌ {document.error}")
         else:
-             st.sidebar.error(f"❌ Error al leer o contenido vacío del documento.")
+            st.sidebar.success(f"✅ Documento '{document.file_name}' cargado al contexto RAG.")
+            # Reforzamos el mensaje de bienvenida con el nuevo contexto
+            st.session_state.messages.append({"role": "assistant", "content": f"**Progob Nota:** El documento '{document.file_name}' ha sido incorporado al contexto de conocimiento. Lo usaré para alinear mis respuestas a sus lineamientos internos."})
 
-    st.sidebar.markdown(f"**Documentos Personalizados Cargados:** {len(st.session_state.get('custom_docs_content', []))}")
+    if pending_custom_documents():
+        with st.sidebar:
+            custom_docs_progress()
+
+    loaded_docs = sum(1 for doc in st.session_state.get('custom_docs', {}).values() if doc.chunks)
+    st.sidebar.markdown(f"**Documentos Personalizados Cargados:** {loaded_docs}")
     st.sidebar.markdown("---")
     # Muestra el estado de la persistencia (descarga)
     st.sidebar.markdown(f"**Estado de Avance:** {st.session_state.get('drive_status', 'No verificado.')}")
 
+    # Uso del contexto en la última consulta (estimación local de tokens por fuente)
+    budget_report = st.session_state.get('last_context_budget')
+    if budget_report:
+        with st.sidebar.expander(f"📏 Contexto enviado: ~{budget_report['sent_tokens']:,} / {budget_report['budget_tokens']:,} tokens"):
+            st.dataframe(pd.DataFrame([
+                {'Fuente': source['name'], 'Tokens': source['sent_tokens'], 'Solicitados': source['requested_tokens'], 'Partes': f"{source['parts_sent']}/{source['parts_requested']}"}
+                for source in budget_report['sources']
+            ]), hide_index=True)
+            if budget_report['trimmed']:
+                st.caption("Se recortaron las fuentes de menor prioridad para no exceder la ventana del modelo.")
+
 
     # --- 2. Mostrar Historial del Chat ---
     # Este loop muestra el historial y es crucial
@@ -865,39 +4375,28 @@ def chat_view(user_name, user_area):
             
             # Mostrar la entrada del usuario inmediatamente
             st.session_state.messages.append({"role": "user", "content": user_prompt})
+            with st.chat_message("user"):
+                st.markdown(user_prompt)
             
-            # 3.2 Llamar a la nueva lógica de fases y obtener el contenido completo
-            response_content = handle_phase_logic(user_prompt, user_area)
+            # 3.2 Llamar a la nueva lógica de fases: devuelve el flujo de tokens de la API
+            response_generator = handle_phase_logic(user_prompt, user_area)
             
-            # 3.3 Añadir respuesta del asistente con streaming simulado
+            # 3.3 Pintar la respuesta del asistente en vivo (un solo flujo, sin simulación de tecleo)
             with st.chat_message("assistant"):
-                # Generamos el efecto de tecleo aquí
-                
-                # Usamos un generador más simple basado en caracteres
-                def stream_simulator(text):
-                    for char in text:
-                        yield char
-                        # Controlamos la velocidad: más lento para saltos de línea/puntuación
-                        if char in ['.', '!', '?']:
-                             time.sleep(0.1)
-                        elif char in [',', ';', ':']:
-                             time.sleep(0.05)
-                        else:
-                             time.sleep(0.005)
-                
-                # Streamlit escribe la respuesta simulada
-                st.write_stream(stream_simulator(response_content))
+                response_content = st.write_stream(render_stream(response_generator))
 
             # 3.4 Guardar la respuesta completa (ya streameada) en el historial
             st.session_state.messages.append({"role": "assistant", "content": response_content})
+            save_pat_progress(user_area, st.session_state.pat_data)
+            # Mientras el usuario lee las opciones propuestas, se precalcula la fase siguiente (si está activado)
+            start_speculative_prefetch(response_content, user_area)
             
             st.rerun()
 
     else:
         st.markdown(f"**✅ PROCESO COMPLETADO (LÓGICA VERTICAL):** La lógica vertical de la MIR (Problema, Propósito y Componentes) ha sido validada y el avance ha sido guardado. Escribe 'INICIAR DE NUEVO' para limpiar el historial y comenzar un nuevo ciclo.")
         if st.chat_input("Escribe 'INICIAR DE NUEVO' para reiniciar..."):
-             st.session_state.clear()
-             st.session_state['authenticated'] = True 
+             restart_pat_cycle()
              st.rerun()
 
 
@@ -909,9 +4408,57 @@ def admin_view(user_name):
     """Interfaz de administración para la gestión de usuarios (Se mantiene por ahora)."""
     st.title(f"Panel de Administrador | {user_name}")
     st.subheader("Gestión de Usuarios y Supervisión de PATs")
-    st.warning("La persistencia de Drive fue deshabilitada. El avance se guarda por descarga JSON.")
+    st.info(f"El avance de cada usuario se guarda automáticamente en el servidor ({get_progress_store().count()} PAT en curso). La descarga JSON/TXT sigue disponible como respaldo.")
     st.markdown("---")
-    df_users = load_users()
+    metrics = get_llm_metrics().snapshot()
+    st.markdown("**Uso de la API (desde el inicio del proceso)**")
+    col_requests, col_cached, col_uncached, col_completion = st.columns(4)
+    col_requests.metric("Solicitudes", metrics['requests'])
+    col_cached.metric("Tokens de prompt en caché", metrics['cached_prompt_tokens'])
+    col_uncached.metric("Tokens de prompt sin caché", metrics['uncached_prompt_tokens'])
+    col_completion.metric("Tokens generados", metrics['completion_tokens'])
+    breaker = get_circuit_breaker()
+    st.caption(
+        f"Circuit breaker: {breaker.state()} (abierto {breaker.times_opened} veces) · Reintentos: {metrics['retries']}"
+        f" · Solicitudes duplicadas (hedging{'' if LLM_HEDGE_ENABLED else ', desactivado'}): {metrics['hedges']}"
+        f" · Prefetch especulativo{'' if SPECULATIVE_PREFETCH_ENABLED else ' (desactivado)'}: {metrics['speculative_hits']} aciertos,"
+        f" {metrics['speculative_misses']} descartados"
+        f" · Borradores revisados localmente: {metrics['local_validations']}"
+        f" ({metrics['local_rejections']} respondidos sin llamar al modelo)"
+    )
+    
+    executor = get_llm_executor().snapshot()
+    st.markdown(f"**Servicio de ejecución** ({executor['max_workers']} llamadas simultáneas como máximo)")
+    col_active, col_pending, col_wait, col_rejected = st.columns(4)
+    col_active.metric("En curso", executor['active'])
+    col_pending.metric("En espera", executor['pending'], help=f"Máximo observado: {executor['peak_pending']}")
+    col_wait.metric("Espera promedio", f"{executor['avg_wait_seconds']:.1f} s")
+    col_rejected.metric("Rechazadas por saturación", executor['rejected'])
+    st.caption(
+        f"Enviadas: {executor['submitted']} · Completadas: {executor['completed']} · Canceladas (rerun/reinicio): {executor['cancelled']}"
+        f" · 429 del proveedor (reencoladas): {executor['rate_limited']} · Duración promedio: {executor['avg_job_seconds']:.1f} s"
+        f" · Límite: {LLM_RATE_LIMIT_RPM} solicitudes/min, {LLM_RATE_LIMIT_TPM:,} tokens/min"
+    )
+    
+    indicator_catalog = get_indicator_catalog()
+    if indicator_catalog.error:
+        st.warning(f"⚠️ El catálogo de indicadores no está disponible ({indicator_catalog.error}); las fases de la MIR se generan sin sugerencias locales.")
+    else:
+        st.caption(f"Catálogo de indicadores: {len(indicator_catalog.indicators)} fichas del GDM y del Manual.")
+    
+    response_cache = get_response_cache()
+    st.markdown(f"**Caché de respuestas:** {response_cache.count()} respuestas guardadas (p. ej. diagnósticos iniciales por UR).")
+    if st.button("🗑️ Vaciar caché de respuestas", key="clear_response_cache", help="Usar cuando cambien los documentos o los prompts de diagnóstico."):
+        response_cache.clear()
+        st.success("✅ Caché de respuestas vaciada.")
+    st.markdown("---")
+    users = get_user_directory().refresh()
+    if users.plaintext_passwords:
+        st.warning(
+            f"⚠️ {users.plaintext_passwords} contraseñas del listado ({users.source}) siguen en texto claro. "
+            "Ejecuta `python chatbot.py hash-passwords` para guardarlas con hash."
+        )
+    df_users = users.to_dataframe()
     if not df_users.empty:
         st.markdown("**Vista Previa de Usuarios**")
         cols_to_show = [col for col in ['nombre', 'area', 'role', 'username'] if col in df_users.columns]
@@ -925,7 +4472,7 @@ def admin_view(user_name):
 
 def main():
     """Función principal para manejar el login y enrutamiento."""
-    df_users = load_users()
+    users = get_user_directory().refresh()
     
     if 'authenticated' not in st.session_state:
         st.session_state['authenticated'] = False
@@ -944,10 +4491,10 @@ def main():
         
         # **FIX DUPLICATE ID:** Añadimos key explícita para el botón de login
         if st.sidebar.button("🔐 Ingresar", key="login_button"):
-            if df_users.empty:
+            if users.is_empty():
                 st.sidebar.error("Error de carga. El listado de usuarios está vacío. Verifique el archivo users.xlsx o la sección [users] en secrets.toml.")
             else:
-                role, name, area = authenticate(username, password, df_users)
+                role, name, area = authenticate(username, password, users)
                 
                 if role:
                     # Almacenamos los mensajes iniciales cargados (si aplica)
@@ -960,6 +4507,7 @@ def main():
                     st.session_state['role'] = role
                     st.session_state['user_name'] = name
                     st.session_state['user_area'] = area
+                    st.session_state['username'] = normalize_username(username) # Clave del avance guardado
                     st.session_state['messages'] = temp_messages # Restauramos los mensajes si existían (cargados del JSON)
                     st.session_state['current_phase'] = temp_current_phase
                     
@@ -968,7 +4516,7 @@ def main():
                 else:
                     st.sidebar.error("Usuario o contraseña incorrectos. Verifique sus credenciales.")
         
-        if df_users.empty:
+        if users.is_empty():
             st.warning(f"⚠️ **ATENCIÓN:** El listado de usuarios no ha sido cargado. Asegúrese de que exista un archivo como `{USERS_FILE_NAME}` o la sección `[users]` en su `secrets.toml`.")
     
     # Pie de página (Footer)
@@ -976,5 +4524,244 @@ def main():
     st.markdown("<p style='text-align: right; color: gray; font-size: small;'>2026 * Sergio Cortina * Chatbot Asesor</p>", unsafe_allow_html=True)
 
 
+# --------------------------------------------------------------------------
+# H. COMANDOS DE DESPLIEGUE (python chatbot.py <comando>)
+# --------------------------------------------------------------------------
+
+def cli_build_bundles():
+    """Precalcula el índice normativo y los paquetes de contexto por área para que el login sea una sola búsqueda."""
+    extracted = ingest_pdfs([path for path, _ in CORPUS_DOCUMENTS.values()])
+    if extracted:
+        print(f"{extracted} PDFs extraídos en paralelo ({PDF_INGEST_WORKERS} procesos)")
+    build_legal_index()
+    print(f"{len(build_indicator_catalog())} indicadores en el catálogo {INDICATOR_CATALOG_FILE}")
+    bundles = build_area_bundles()
+    save_area_bundles(bundles)
+    if bundles['error']:
+        print(bundles['error'])
+        return 1
+    with_articles = sum(1 for b in bundles['areas'].values() if b['reglamento_articulos'])
+    print(f"{len(bundles['areas'])} áreas empaquetadas ({with_articles} con artículos del Reglamento o la Ley Orgánica) en {AREA_BUNDLES_FILE}")
+    return 0
+
+
+def cli_hash_passwords():
+    """
+    Migra las contraseñas en claro del listado de usuarios a hashes con sal.
+    Con archivo (xlsx/csv) lo reescribe dejando un respaldo .bak; con secrets.toml imprime la lista para pegarla.
+    """
+    found_file = find_users_file()
+    df_users = load_users()
+    if df_users.empty or 'password' not in df_users.columns:
+        print("No se encontró un listado de usuarios con columna 'password'.")
+        return 1
+    passwords = [cell_to_text(value) for value in df_users['password']]
+    pending = [i for i, password in enumerate(passwords) if password and not is_password_hash(password)]
+    for i in pending:
+        passwords[i] = hash_password(passwords[i])
+    if not pending:
+        print("Todas las contraseñas ya están guardadas con hash.")
+        return 0
+    if not found_file:
+        print("# Reemplaza la lista de contraseñas en la sección [users] de secrets.toml por:")
+        print("password = " + json.dumps(passwords))
+        return 0
+    df_users['password'] = passwords
+    backup = f"{found_file}.bak"
+    os.replace(found_file, backup)
+    if found_file.endswith(('.xlsx', '.xls')):
+        df_users.to_excel(found_file, index=False, engine='openpyxl')
+    else:
+        df_users.to_csv(found_file, index=False, encoding='utf-8')
+    print(f"{len(pending)} contraseñas migradas a hash en {found_file} (respaldo del original: {backup}).")
+    return 0
+
+
+# Presupuesto de arranque en frío (python chatbot.py profile-startup falla si se excede)
+STARTUP_BUDGET_IMPORT_SECONDS = 1.0 # Importar chatbot.py (incluye streamlit)
+STARTUP_BUDGET_LOGIN_RENDER_SECONDS = 1.5 # Primera ejecución del script hasta pintar el login
+STARTUP_DEFERRED_MODULES = ("pandas", "numpy", "pypdf", "requests", "openpyxl") # No deben cargarse para el login
+
+# Se ejecuta en un proceso nuevo: tiempo hasta el primer render del login y módulos pesados ya importados
+_LOGIN_RENDER_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(sys.argv[1], default_timeout=120)
+run_started = time.perf_counter()
+app.run()
+finished = time.perf_counter()
+print(json.dumps({
+    'streamlit_import': run_started - started,
+    'script_run': finished - run_started,
+    'login_rendered': any(w.key == 'login_user' for w in app.sidebar.text_input),
+    'exceptions': [str(e.value) for e in app.exception],
+    'loaded': [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+
+def cli_profile_startup():
+    """
+    Benchmark reproducible del arranque en frío, siempre en procesos nuevos: tiempo de importación por módulo
+    (python -X importtime) y tiempo hasta el primer render del login. Devuelve 1 si se excede el presupuesto.
+    """
+    import subprocess # Sólo lo usa este comando
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import chatbot"], cwd=app_dir, capture_output=True, text=True,
+    )
+    import_seconds = time.perf_counter() - started
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        return 1
+    # Líneas "import time: self [us] | cumulative | paquete"; la sangría (2 espacios por nivel) indica quién importa a
+    # quién. Nivel 1 = lo que importa chatbot.py directamente (la primera vez que se importa en el proceso).
+    direct_imports = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S.*)$", line)
+        if match and len(match.group(3)) == 2:
+            direct_imports.append((int(match.group(2)) / 1e6, match.group(4)))
+    direct_imports.sort(reverse=True)
+
+    probe = subprocess.run(
+        [sys.executable, "-c", _LOGIN_RENDER_PROBE, os.path.join(app_dir, "chatbot.py"), *STARTUP_DEFERRED_MODULES],
+        cwd=app_dir, capture_output=True, text=True,
+    )
+    try:
+        render = json.loads(probe.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        print(probe.stderr[-2000:])
+        return 1
+
+    print("Importación por módulo (acumulado, importaciones directas de chatbot.py):")
+    for seconds, name in direct_imports[:12]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+    print(f"Importar chatbot.py (proceso nuevo): {import_seconds:.2f} s (presupuesto {STARTUP_BUDGET_IMPORT_SECONDS:.2f} s)")
+    print(f"Primer render del login: {render['script_run']:.2f} s (presupuesto {STARTUP_BUDGET_LOGIN_RENDER_SECONDS:.2f} s)"
+          f" + {render['streamlit_import']:.2f} s de importar el runtime de pruebas")
+    print(f"Módulos pesados cargados para el login: {', '.join(render['loaded']) or 'ninguno'}")
+
+    failures = []
+    if import_seconds > STARTUP_BUDGET_IMPORT_SECONDS:
+        failures.append("importación")
+    if render['script_run'] > STARTUP_BUDGET_LOGIN_RENDER_SECONDS:
+        failures.append("primer render")
+    if not render['login_rendered'] or render['exceptions']:
+        failures.append(f"el login no se pintó ({'; '.join(render['exceptions'])})")
+    if render['loaded']:
+        failures.append("módulos diferidos importados")
+    print("✅ Dentro del presupuesto." if not failures else f"❌ Fuera de presupuesto: {', '.join(failures)}.")
+    return 1 if failures else 0
+
+
+def cli_benchmark_ingest():
+    """
+    Benchmark de extracción en frío (sin caché) del corpus de docs/: tiempo de pared por número de procesos.
+    Uso: python chatbot.py benchmark-ingest [máximo de procesos]. Comprueba que el resultado no dependa del reparto.
+    """
+    if not pypdf:
+        print("Librería 'pypdf' no instalada.")
+        return 1
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else PDF_INGEST_WORKERS
+    paths = [path for path, _ in CORPUS_DOCUMENTS.values() if os.path.exists(path)]
+    worker_counts = sorted({1, max_workers} | {2 ** i for i in range(1, max_workers.bit_length()) if 2 ** i < max_workers})
+    print(f"{len(paths)} PDFs, {PDF_INGEST_PAGES_PER_TASK} páginas por tarea, {os.cpu_count()} CPUs disponibles")
+
+    baseline, baseline_seconds, failed = None, None, False
+    for workers in worker_counts:
+        started = time.perf_counter()
+        extracted = extract_pdfs_parallel(paths, workers)
+        seconds = time.perf_counter() - started
+        pages = sum(len(p) for p in extracted.values() if not isinstance(p, Exception))
+        if baseline is None:
+            baseline, baseline_seconds = extracted, seconds
+        elif {k: v for k, v in extracted.items() if not isinstance(v, Exception)} != \
+                {k: v for k, v in baseline.items() if not isinstance(v, Exception)}:
+            print(f"❌ El texto extraído con {workers} procesos difiere del extraído en serie.")
+            failed = True
+        print(f"  {workers:3d} procesos: {seconds:7.2f} s  ({pages / seconds:6.1f} págs/s, aceleración x{baseline_seconds / seconds:.2f})")
+    return 1 if failed else 0
+
+
+def cli_build_indicators():
+    """Reconstruye el catálogo de indicadores (GDM y Manual) y lo consulta. Uso: python chatbot.py build-indicators [consulta]."""
+    started = time.perf_counter()
+    try:
+        indicators = build_indicator_catalog()
+    except Exception as e:
+        print(f"❌ No se pudo construir el catálogo: {e}")
+        return 1
+    by_source = {}
+    for record in indicators:
+        by_source[record['source']] = by_source.get(record['source'], 0) + 1
+    print(f"{len(indicators)} indicadores en {time.perf_counter() - started:.2f} s ({INDICATOR_CATALOG_FILE})")
+    for source, count in by_source.items():
+        print(f"  {source}: {count}")
+    if len(sys.argv) > 2:
+        query = " ".join(sys.argv[2:])
+        catalog = IndicatorCatalog(indicators)
+        started = time.perf_counter()
+        matches = catalog.search(query)
+        print(f"\nBúsqueda '{query}' ({(time.perf_counter() - started) * 1000:.1f} ms):")
+        print(format_indicator_candidates(matches))
+    return 0
+
+
+def cli_benchmark_vectors():
+    """
+    Benchmark del índice semántico sobre el corpus actual: construcción (TF-IDF + SVD), apertura con mmap y latencia
+    de consulta (proyección + producto matriz-vector). Uso: python chatbot.py benchmark-vectors [consultas].
+    """
+    if np is None:
+        print("Librería 'numpy' no instalada.")
+        return 1
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    chunks = load_retrieval_index().chunks
+    print(f"{len(chunks)} fragmentos, {VECTOR_HASH_BUCKETS} buckets -> {VECTOR_DIM} dimensiones")
+
+    directory = tempfile.mkdtemp(prefix="vectors-benchmark-", dir=CACHE_DIR)
+    try:
+        started = time.perf_counter()
+        VectorIndex.build(chunks, directory)
+        print(f"  construcción: {time.perf_counter() - started:7.2f} s")
+        started = time.perf_counter()
+        index = VectorIndex.load(chunks, directory)
+        print(f"  apertura:     {(time.perf_counter() - started) * 1000:7.2f} ms")
+
+        # Consultas reales: el texto de fragmentos al azar (semilla fija para que sea reproducible)
+        sampler = random.Random(0)
+        queries = [" ".join(sampler.choice(chunks)['text'].split()[:12]) for _ in range(repetitions)]
+        index.rank(queries[0]) # Calentamiento (carga las páginas del mmap)
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            index.rank(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(
+            f"  consulta ({repetitions}): mediana {timings[len(timings) // 2]:.3f} ms, "
+            f"p95 {timings[int(len(timings) * 0.95) - 1]:.3f} ms, máx {timings[-1]:.3f} ms"
+        )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+CLI_COMMANDS = {
+    "build-bundles": cli_build_bundles,
+    "build-indicators": cli_build_indicators,
+    "hash-passwords": cli_hash_passwords,
+    "profile-startup": cli_profile_startup,
+    "benchmark-ingest": cli_benchmark_ingest,
+    "benchmark-vectors": cli_benchmark_vectors,
+}
+
+
 if __name__ == "__main__":
+    # `streamlit run chatbot.py` no pasa argumentos: se levanta la app. `python chatbot.py <comando>` ejecuta el comando.
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(CLI_COMMANDS[sys.argv[1]]())
     main()
\ No newline at end of file
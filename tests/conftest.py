@@ -0,0 +1,90 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+# chatbot.py es un script de Streamlit en la raíz del repositorio (no un paquete instalable)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    Servidor HTTP local para las pruebas del cliente del modelo. Cada prueba define `handler(request)`; el servidor
+    cuenta las conexiones TCP aceptadas y las solicitudes simultáneas (máximo observado).
+    """
+
+    daemon_threads = True
+    request_queue_size = 64 # Las pruebas de concurrencia abren más conexiones a la vez que el backlog por defecto (5)
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.handler = None
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive: la conexión se reutiliza entre solicitudes
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            self.server.handler(self)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def send_chunked_headers(self, content_type="text/event-stream"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_chunk(self, data):
+        """Escribe un chunk HTTP tal cual (puede cortar un evento SSE o un carácter UTF-8 a la mitad)."""
+        data = data.encode("utf-8") if isinstance(data, str) else data
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def end_chunks(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def send_json(self, data, status=200):
+        body = data.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,72 @@
+"""Presupuesto de contexto: recorte determinista por prioridad, truncado en salto de línea y reporte por fuente."""
+import chatbot
+
+
+def lines(prefix, count, width=60):
+    return "\n".join(f"{prefix} {i:03d} ".ljust(width, "x") for i in range(count))
+
+
+def section(name, priority, *parts):
+    return {'name': name, 'priority': priority, 'parts': list(parts)}
+
+
+def tokens(parts):
+    return sum(chatbot.estimate_tokens(part) for part in parts)
+
+
+def test_within_budget_nothing_is_trimmed():
+    sections = [section('persona', 0, "Eres PROGOB."), section('corpus', 2, lines("c", 5))]
+    allocated, report = chatbot.allocate_context_budget(sections, 10_000)
+    assert allocated == sections
+    assert not report['trimmed']
+    assert report['sent_tokens'] == tokens(["Eres PROGOB.", lines("c", 5)])
+
+
+def test_lowest_priority_is_trimmed_first_and_priority_zero_never():
+    persona, area, corpus = lines("p", 20), lines("a", 20), lines("c", 20)
+    sections = [section('persona', 0, persona), section('area', 1, area), section('corpus', 2, corpus)]
+    budget = tokens([persona, area]) + 50
+    allocated, report = chatbot.allocate_context_budget(sections, budget)
+    assert allocated[0]['parts'] == [persona]
+    assert allocated[1]['parts'] == [area]
+    assert allocated[2]['parts'][0].endswith(chatbot.CONTEXT_TRUNCATION_MARK)
+    assert report['sent_tokens'] <= budget
+
+
+def test_last_part_goes_first_and_is_cut_on_a_line_break():
+    first, second = lines("uno", 10), lines("dos", 10)
+    sections = [section('corpus', 2, first, second)]
+    budget = tokens([first]) + tokens([second]) // 2
+    allocated, _ = chatbot.allocate_context_budget(sections, budget)
+    kept_first, kept_second = allocated[0]['parts']
+    assert kept_first == first
+    body = kept_second[:-len(chatbot.CONTEXT_TRUNCATION_MARK)]
+    assert second.startswith(body) and second[len(body)] == "\n"
+
+
+def test_parts_that_do_not_fit_are_dropped_whole(monkeypatch):
+    big = lines("grande", 200) # ~12k caracteres
+    sections = [section('area', 1, lines("a", 5)), section('corpus', 2, lines("c", 5), big)]
+    calls = []
+    estimate = chatbot.estimate_tokens
+    monkeypatch.setattr(chatbot, "estimate_tokens", lambda text: calls.append(1) or estimate(text))
+    allocated, report = chatbot.allocate_context_budget(sections, tokens([lines("a", 5), lines("c", 5)]))
+    assert allocated[1]['parts'] == [lines("c", 5)]
+    assert len(calls) < 20 # se descarta de una vez, no línea por línea
+    assert report['sent_tokens'] <= report['budget_tokens']
+
+
+def test_report_fields():
+    sections = [section('area', 1, lines("a", 5)), section('corpus', 2, lines("c", 5), lines("d", 5))]
+    budget = tokens([lines("a", 5), lines("c", 5)])
+    _, report = chatbot.allocate_context_budget(sections, budget)
+    area, corpus = report['sources']
+    assert area == {
+        'name': 'area', 'requested_tokens': tokens([lines("a", 5)]), 'sent_tokens': tokens([lines("a", 5)]),
+        'parts_sent': 1, 'parts_requested': 1,
+    }
+    assert corpus['parts_requested'] == 2 and corpus['parts_sent'] == 1
+    assert corpus['requested_tokens'] == tokens([lines("c", 5), lines("d", 5)])
+    assert report['budget_tokens'] == budget
+    assert report['sent_tokens'] == area['sent_tokens'] + corpus['sent_tokens']
+    assert report['trimmed']
@@ -0,0 +1,87 @@
+"""Cliente HTTP compartido (get_http_session) contra un servidor local: keep-alive, tamaño del pool y timeouts."""
+import concurrent.futures
+import json
+import time
+
+import pytest
+import requests
+
+import chatbot
+
+
+def done_stream(request, tokens=("ok",), pause=0.0):
+    request.send_chunked_headers()
+    for token in tokens:
+        time.sleep(pause)
+        request.send_chunk(f"data: {json.dumps({'choices': [{'delta': {'content': token}}]})}\n\n")
+    request.send_chunk("data: [DONE]\n\n")
+    request.end_chunks()
+
+
+@pytest.fixture
+def api(stub_server, monkeypatch):
+    monkeypatch.setattr(chatbot, "LLM_API_URL", stub_server.url)
+    return stub_server
+
+
+def complete(metrics=None):
+    return "".join(chatbot.request_llm_completion(
+        {"Content-Type": "application/json"}, {"model": "stub", "stream": True}, metrics=metrics or chatbot.LLMMetrics(),
+        breaker=chatbot.CircuitBreaker(),
+    ))
+
+
+def test_session_is_shared_per_process():
+    assert chatbot.get_http_session() is chatbot.get_http_session()
+
+
+def test_sequential_requests_reuse_one_connection(api):
+    api.handler = done_stream
+    for _ in range(5):
+        assert complete() == "ok"
+    assert api.requests == 5
+    assert api.connections == 1 # Un solo handshake TCP para todos los turnos
+
+
+def test_concurrent_requests_never_exceed_the_pool(api):
+    def handler(request):
+        time.sleep(0.3)
+        request.send_json(json.dumps({"ok": True}))
+
+    api.handler = handler
+    session = chatbot.get_http_session()
+
+    def call(_):
+        with session.post(api.url, json={}, timeout=(chatbot.LLM_CONNECT_TIMEOUT, chatbot.LLM_READ_TIMEOUT)) as response:
+            return response.status_code
+
+    workers = chatbot.LLM_POOL_SIZE + 10
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        statuses = list(pool.map(call, range(workers)))
+    assert statuses == [200] * workers # pool_block: los excedentes esperan una conexión libre, no fallan
+    assert 1 < api.max_active <= chatbot.LLM_POOL_SIZE
+    assert api.connections <= chatbot.LLM_POOL_SIZE # Nunca se abren conexiones fuera del pool
+
+
+def test_read_timeout_applies_while_waiting_for_headers(api, monkeypatch):
+    monkeypatch.setattr(chatbot, "LLM_READ_TIMEOUT", 0.3)
+    api.handler = lambda request: (time.sleep(1.0), done_stream(request))
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        chatbot.post_llm_request({}, {}, chatbot.LLMMetrics())
+    assert time.monotonic() - started < 0.9
+
+
+def test_read_timeout_is_between_bytes_not_total(api, monkeypatch):
+    monkeypatch.setattr(chatbot, "LLM_READ_TIMEOUT", 0.5)
+    api.handler = lambda request: done_stream(request, tokens=["a", "b", "c", "d", "e", "f"], pause=0.2)
+    started = time.monotonic()
+    assert complete() == "abcdef" # 1.2 s de respuesta con un timeout de lectura de 0.5 s
+    assert time.monotonic() - started > 1.0
+
+
+def test_read_timeout_mid_stream_is_reported(api, monkeypatch):
+    monkeypatch.setattr(chatbot, "LLM_READ_TIMEOUT", 0.3)
+    api.handler = lambda request: done_stream(request, tokens=["a", "b"], pause=0.8)
+    text = complete()
+    assert "interrumpida" in text
@@ -0,0 +1,49 @@
+"""Catálogo de indicadores: los fallos esperados (PDF ausente o ilegible) se registran y se informan; los demás no se ocultan."""
+import logging
+
+import pytest
+
+import chatbot
+
+
+@pytest.fixture
+def fresh_catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatbot, "INDICATOR_CATALOG_FILE", str(tmp_path / "indicator_catalog.json"))
+    chatbot.get_indicator_catalog.clear()
+    yield
+    chatbot.get_indicator_catalog.clear()
+
+
+def raising(exc):
+    def build():
+        raise exc
+    return build
+
+
+def test_missing_pdf_yields_empty_catalog_with_error(fresh_catalog, monkeypatch, caplog):
+    monkeypatch.setattr(chatbot, "build_indicator_catalog", raising(FileNotFoundError("GDM.pdf")))
+    with caplog.at_level(logging.WARNING, logger=chatbot.logger.name):
+        catalog = chatbot.get_indicator_catalog()
+    assert catalog.indicators == []
+    assert catalog.error.startswith("FileNotFoundError")
+    assert catalog.search("tasa de variación") == []
+    assert "catálogo de indicadores" in caplog.text
+
+
+def test_missing_pypdf_is_reported(fresh_catalog, monkeypatch):
+    monkeypatch.setattr(chatbot, "build_indicator_catalog", raising(RuntimeError("Librería 'pypdf' no instalada.")))
+    assert "pypdf" in chatbot.get_indicator_catalog().error
+
+
+def test_parser_bugs_are_not_swallowed(fresh_catalog, monkeypatch):
+    monkeypatch.setattr(chatbot, "build_indicator_catalog", raising(KeyError("name")))
+    with pytest.raises(KeyError):
+        chatbot.get_indicator_catalog()
+
+
+def test_built_catalog_has_no_error(fresh_catalog, monkeypatch):
+    record = {'source': 'gdm', 'name': 'Tasa de variación', 'theme': '', 'definition': '', 'formula': '', 'level': 'Fin'}
+    monkeypatch.setattr(chatbot, "build_indicator_catalog", lambda: [record])
+    catalog = chatbot.get_indicator_catalog()
+    assert catalog.error is None
+    assert catalog.search("tasa de variación") == [record]
@@ -0,0 +1,97 @@
+"""Circuit breaker alrededor de request_llm_completion: toda falla se registra y la prueba semiabierta se libera."""
+import time
+
+import pytest
+import requests
+
+import chatbot
+
+
+class FakeResponse:
+    status_code = 200
+    reason = "OK"
+    headers = {}
+    encoding = None
+
+    def iter_lines(self, decode_unicode=False):
+        yield 'data: {"choices": [{"delta": {"content": "ok"}}]}'
+        yield "data: [DONE]"
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def failing(exception):
+    def post(headers, payload, metrics):
+        raise exception
+    return post
+
+
+def run(breaker, metrics=None):
+    return list(chatbot.request_llm_completion({}, {}, metrics=metrics or chatbot.LLMMetrics(), breaker=breaker))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(chatbot, "backoff_delay", lambda attempt: 0)
+
+
+def half_open_breaker():
+    """Breaker abierto por una falla previa y ya listo para dejar pasar la solicitud de prueba."""
+    breaker = chatbot.CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.state() == "semiabierto"
+    return breaker
+
+
+@pytest.mark.parametrize("exception", [
+    requests.exceptions.ChunkedEncodingError("Connection broken"),
+    requests.exceptions.InvalidHeader("bad header"),
+    RuntimeError("falla inesperada"),
+])
+def test_failed_probe_reopens_the_breaker(monkeypatch, exception):
+    monkeypatch.setattr(chatbot, "post_llm_request", failing(exception))
+    breaker = half_open_breaker()
+    tokens = run(breaker)
+    assert len(tokens) == 1 and isinstance(tokens[0], chatbot.LLMError)
+    assert breaker.probe_in_flight is False
+    assert breaker.state() == "abierto"
+    time.sleep(0.06)
+    assert breaker.allow() # Pasado el reposo se autoriza otra prueba: no queda atascado
+
+
+def test_successful_probe_closes_the_breaker(monkeypatch):
+    monkeypatch.setattr(chatbot, "post_llm_request", lambda headers, payload, metrics: FakeResponse())
+    breaker = half_open_breaker()
+    assert run(breaker) == ["ok"]
+    assert breaker.state() == "cerrado"
+    assert breaker.probe_in_flight is False
+
+
+def test_non_transient_request_errors_are_not_retried(monkeypatch):
+    monkeypatch.setattr(chatbot, "post_llm_request", failing(requests.exceptions.ChunkedEncodingError("Connection broken")))
+    breaker, metrics = chatbot.CircuitBreaker(failure_threshold=10), chatbot.LLMMetrics()
+    run(breaker, metrics)
+    assert metrics.snapshot()["retries"] == 0
+    assert breaker.failures == 1
+
+
+def test_transient_errors_are_retried_then_counted(monkeypatch):
+    monkeypatch.setattr(chatbot, "post_llm_request", failing(requests.exceptions.ConnectionError("refused")))
+    breaker, metrics = chatbot.CircuitBreaker(failure_threshold=10), chatbot.LLMMetrics()
+    tokens = run(breaker, metrics)
+    assert isinstance(tokens[-1], chatbot.LLMError)
+    assert metrics.snapshot()["retries"] == chatbot.LLM_RETRY_ATTEMPTS
+    assert breaker.failures == chatbot.LLM_RETRY_ATTEMPTS + 1
+
+
+def test_open_breaker_answers_without_calling_the_api(monkeypatch):
+    monkeypatch.setattr(chatbot, "post_llm_request", failing(AssertionError("no debe llamarse")))
+    breaker = chatbot.CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    breaker.record_failure()
+    tokens = run(breaker)
+    assert len(tokens) == 1 and "no está respondiendo" in tokens[0]
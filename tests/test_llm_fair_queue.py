@@ -0,0 +1,114 @@
+"""Cola justa del servicio de ejecución bajo contención: turno rotativo por usuario, no por orden de llegada."""
+import statistics
+import threading
+import time
+
+import pytest
+
+import chatbot
+
+
+def unlimited():
+    return chatbot.LLMRateLimiter(requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9)
+
+
+class Recorder:
+    """Registra el orden en que arrancan los trabajos y cuánto esperó cada uno en la fila."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.started = []
+        self.waits = {}
+
+    def job(self, user, label, submitted_at):
+        def produce():
+            with self.lock:
+                self.started.append((user, label))
+                self.waits.setdefault(user, []).append(time.monotonic() - submitted_at)
+            time.sleep(self.seconds)
+            yield f"{user}-{label}"
+        return produce
+
+
+def drain(jobs):
+    for job in jobs:
+        assert "".join(job.stream()) # Cada trabajo termina con su texto
+
+
+def test_dispatch_alternates_between_users_behind_a_heavy_user():
+    executor = chatbot.LLMExecutor(max_workers=1, max_pending=100, rate_limiter=unlimited())
+    recorder = Recorder(0.02)
+    now = time.monotonic()
+    jobs = [executor.submit(f"heavy-{i}", recorder.job("heavy", i, now), user_key="heavy") for i in range(10)]
+    assert jobs[0].started.wait(5) # Los demás llegan con el único hilo ocupado y 9 solicitudes de heavy en espera
+    jobs += [executor.submit(f"{user}-{i}", recorder.job(user, i, now), user_key=user) for user in ("ana", "luis") for i in range(2)]
+    drain(jobs)
+    # El primero de heavy ya corría; después cada usuario recibe un turno por ronda
+    assert recorder.started[:7] == [
+        ("heavy", 0), ("heavy", 1), ("ana", 0), ("luis", 0), ("heavy", 2), ("ana", 1), ("luis", 1),
+    ]
+
+
+def test_light_users_are_not_starved_under_contention():
+    """
+    Prueba de carga: un usuario llena la fila con 40 solicitudes y, con ella llena, 5 usuarios más envían 3 cada
+    uno a la vez desde hilos propios. En orden de llegada esperarían detrás de las 40; en turno rotativo, no.
+    """
+    executor = chatbot.LLMExecutor(max_workers=4, max_pending=200, rate_limiter=unlimited())
+    recorder = Recorder(0.01)
+    light = {"u1": 3, "u2": 3, "u3": 3, "u4": 3, "u5": 3}
+    jobs, jobs_lock = [], threading.Lock()
+    jobs += [executor.submit(f"heavy-{i}", recorder.job("heavy", i, time.monotonic()), user_key="heavy") for i in range(40)]
+    barrier = threading.Barrier(len(light))
+
+    def client(user, count):
+        barrier.wait()
+        for i in range(count):
+            job = executor.submit(f"{user}-{i}", recorder.job(user, i, time.monotonic()), user_key=user)
+            with jobs_lock:
+                jobs.append(job)
+
+    threads = [threading.Thread(target=client, args=item) for item in light.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    drain(jobs)
+
+    assert len(recorder.started) == 40 + sum(light.values())
+    # Cada ronda atiende a todos los usuarios: las 15 solicitudes ligeras arrancan en las primeras rondas
+    rounds = max(light.values())
+    last_light = max(position for position, (user, _) in enumerate(recorder.started) if user != "heavy")
+    assert last_light < rounds * (len(light) + 1) + 2 * executor.max_workers
+    # Y su espera típica es una fracción de la del usuario que satura la fila
+    light_waits = [wait for user, waits in recorder.waits.items() if user != "heavy" for wait in waits]
+    assert statistics.median(light_waits) < statistics.median(recorder.waits["heavy"]) / 2
+    assert executor.snapshot()["completed"] == 40 + sum(light.values())
+
+
+def test_jobs_are_keyed_by_login_not_display_name(monkeypatch):
+    """Dos usuarios con el mismo nombre visible no comparten carril en la fila."""
+    submitted = []
+
+    class FakeExecutor:
+        def submit(self, session_key, produce, user_key=None, cost_tokens=0):
+            submitted.append(user_key)
+            return chatbot.LLMJob.finished("ok")
+
+    monkeypatch.setattr(chatbot, "get_llm_executor", lambda: FakeExecutor())
+    monkeypatch.setattr(chatbot.st, "secrets", {"deepseek_api_key": "test"})
+    state = chatbot.st.session_state
+    for username in ("jperez", "mlopez"):
+        state["username"], state["user_name"] = username, "Usuario"
+        state["area_context"] = {"atribuciones_resumen": "Resumen"}
+        state["llm_session_key"] = f"session-{username}"
+        chatbot.start_llm_job("Persona", "Instrucciones")
+    assert submitted == ["jperez", "mlopez"]
+
+
+@pytest.fixture(autouse=True)
+def clean_session_state():
+    yield
+    for key in ("username", "user_name", "area_context", "llm_session_key", "last_context_budget"):
+        chatbot.st.session_state.pop(key, None)
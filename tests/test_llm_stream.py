@@ -0,0 +1,117 @@
+"""Streaming SSE de chat completions contra un servidor local (eventos partidos, [DONE], uso y desconexión)."""
+import json
+
+import pytest
+
+import chatbot
+
+
+def sse(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def delta(text):
+    return sse({"choices": [{"index": 0, "delta": {"content": text}}]})
+
+
+USAGE = {"prompt_tokens": 1200, "prompt_cache_hit_tokens": 1000, "prompt_cache_miss_tokens": 200, "completion_tokens": 7}
+
+
+@pytest.fixture
+def api(stub_server, monkeypatch):
+    monkeypatch.setattr(chatbot, "LLM_API_URL", stub_server.url)
+    return stub_server
+
+
+def run_completion(on_complete=None):
+    """Consume request_llm_completion completo; devuelve (tokens, métricas)."""
+    metrics = chatbot.LLMMetrics()
+    tokens = list(chatbot.request_llm_completion(
+        {"Content-Type": "application/json"}, {"model": "stub", "stream": True}, on_complete, metrics,
+        chatbot.CircuitBreaker(),
+    ))
+    return tokens, metrics
+
+
+def test_events_split_across_chunks_are_reassembled(api):
+    body = (": keep-alive\n\n" + delta("Hola") + delta(", ") + delta("¿qué") + delta(" tal?") + "data: [DONE]\n\n").encode("utf-8")
+    cuts = [
+        body.index(b"Hola") - 5, # A la mitad del JSON del primer evento
+        body.index(b"\n\n", body.index(b", ")) + 1, # Entre los dos saltos de línea que cierran un evento
+        body.index("¿".encode("utf-8")) + 1, # Dentro de un carácter UTF-8 multibyte
+        body.index("é".encode("utf-8")) + 1,
+    ]
+
+    def handler(request):
+        request.send_chunked_headers()
+        for start, end in zip([0] + cuts, cuts + [len(body)]):
+            request.send_chunk(body[start:end])
+        request.end_chunks()
+
+    api.handler = handler
+    completed = []
+    tokens, _ = run_completion(completed.append)
+    assert tokens == ["Hola", ", ", "¿qué", " tal?"]
+    assert completed == ["Hola, ¿qué tal?"]
+
+
+def test_done_ends_the_stream(api):
+    def handler(request):
+        request.send_chunked_headers()
+        request.send_chunk(delta("uno") + "data: [DONE]\n\n" + delta("ignorado"))
+        request.end_chunks()
+
+    api.handler = handler
+    tokens, _ = run_completion()
+    assert tokens == ["uno"]
+
+
+def test_usage_event_is_accounted(api):
+    def handler(request):
+        request.send_chunked_headers()
+        request.send_chunk(delta("texto"))
+        request.send_chunk(sse({"choices": [], "usage": USAGE})) # include_usage: último evento sin choices
+        request.send_chunk("data: [DONE]\n\n")
+        request.end_chunks()
+
+    api.handler = handler
+    tokens, metrics = run_completion()
+    assert tokens == ["texto"]
+    snapshot = metrics.snapshot()
+    assert snapshot["requests"] == 1
+    assert snapshot["prompt_tokens"] == 1200
+    assert snapshot["cached_prompt_tokens"] == 1000
+    assert snapshot["uncached_prompt_tokens"] == 200
+    assert snapshot["completion_tokens"] == 7
+
+
+def test_mid_stream_disconnect_reports_error_and_skips_cache(api):
+    def handler(request):
+        request.send_chunked_headers()
+        request.send_chunk(delta("parcial"))
+        request.close_connection = True # Se cierra el socket sin el chunk final
+        request.connection.shutdown(2)
+
+    api.handler = handler
+    completed = []
+    tokens, _ = run_completion(completed.append)
+    assert tokens[0] == "parcial"
+    assert isinstance(tokens[-1], chatbot.LLMError)
+    assert "interrumpida" in tokens[-1]
+    assert completed == [] # Una respuesta incompleta no llega a la caché
+
+
+def test_empty_stream_is_reported(api):
+    def handler(request):
+        request.send_chunked_headers()
+        request.send_chunk("data: [DONE]\n\n")
+        request.end_chunks()
+
+    api.handler = handler
+    tokens, _ = run_completion()
+    assert len(tokens) == 1 and isinstance(tokens[0], chatbot.LLMError)
+
+
+def test_iter_sse_events_skips_comments_and_blank_lines():
+    lines = [": ping", "", "data: {\"a\": 1}", "event: x", "data:{\"b\": 2}", "data: [DONE]", "data: {\"c\": 3}"]
+    assert list(chatbot.iter_sse_events(lines)) == [{"a": 1}, {"b": 2}]
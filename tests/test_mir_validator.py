@@ -0,0 +1,95 @@
+"""Revisión sintáctica local de enunciados MIR (Problema, Propósito y Componentes) sin llamar al modelo."""
+import pytest
+
+import chatbot
+
+
+def errors(kind, text):
+    return chatbot.validate_mir_statement(kind, text)['errors']
+
+
+def warnings(kind, text):
+    return chatbot.validate_mir_statement(kind, text)['warnings']
+
+
+@pytest.mark.parametrize("text", [
+    "La población del municipio padece falta de agua potable",
+    "El municipio no cuenta con alumbrado",
+    "La falta de alumbrado público en colonias",
+    "No hay agua potable en las colonias del norte",
+    "El Propósito es que los habitantes cuenten con agua potable",
+    "1. Luminarias instaladas; 2. Calles pavimentadas",
+])
+def test_drafts_are_reviewed(text):
+    assert chatbot.is_mir_statement(text)
+
+
+@pytest.mark.parametrize("text", [
+    "La opción B", "la b por favor", "Opción 2 está bien", "Sí, acepto la opción A",
+    "No estoy de acuerdo con eso", "Me quedo con la C", "De acuerdo, sigamos", "¿Qué es el Propósito?",
+])
+def test_replies_and_questions_are_not_reviewed(text):
+    assert not chatbot.is_mir_statement(text)
+
+
+def test_problem_well_formed():
+    assert errors('problema', "Los habitantes de las colonias del norte padecen inseguridad por calles oscuras") == []
+
+
+@pytest.mark.parametrize("text", [
+    "La población del municipio padece falta de agua potable",
+    "El municipio no cuenta con alumbrado en las colonias",
+    "No hay agua potable en las colonias del norte",
+])
+def test_problem_as_absence_of_service(text):
+    assert any("ausencia" in error for error in errors('problema', text))
+
+
+def test_problem_with_the_solution():
+    assert any("solución" in error for error in errors('problema', "Instalar luminarias en las colonias mediante un programa"))
+
+
+def test_problem_without_population_is_only_a_warning():
+    text = "Inseguridad nocturna elevada en calles mal iluminadas"
+    assert errors('problema', text) == []
+    assert warnings('problema', text)
+
+
+def test_purpose_well_formed():
+    assert errors('proposito', "Los habitantes de las colonias cuentan con alumbrado público suficiente") == []
+
+
+def test_purpose_verb_outside_the_table_is_a_warning():
+    report = chatbot.validate_mir_statement('proposito', "Los productores comercializan sus cosechas a mejor precio")
+    assert report['errors'] == []
+    assert "comercializan" in report['warnings'][0]
+
+
+@pytest.mark.parametrize("text", ["Los habitantes mejorarán su seguridad", "Los habitantes contaron con agua potable"])
+def test_purpose_in_another_tense(text):
+    assert any("no está en presente" in error for error in errors('proposito', text))
+
+
+def test_purpose_starting_with_infinitive():
+    assert any("infinitivo" in error for error in errors('proposito', "Mejorar el alumbrado público del municipio"))
+
+
+def test_purpose_without_beneficiary_or_result():
+    assert any("beneficiario" in error for error in errors('proposito', "Cuentan con alumbrado público suficiente"))
+    assert any("resultado" in error for error in errors('proposito', "Los habitantes del municipio mejoran"))
+
+
+def test_components_well_formed():
+    assert errors('componentes', "- Luminarias instaladas\n- Apoyos económicos otorgados") == []
+
+
+def test_components_as_activities_or_without_participle():
+    found = errors('componentes', "1. Instalar luminarias; 2. Programa de alumbrado")
+    assert "Componente 1" in found[0] and "infinitivo" in found[0]
+    assert "Componente 2" in found[1] and "participio" in found[1]
+
+
+def test_too_many_components_is_a_warning():
+    text = ";".join(f"Apoyo {i} entregado" for i in range(6))
+    assert errors('componentes', text) == []
+    assert warnings('componentes', text)
@@ -0,0 +1,46 @@
+"""Extracción de PDFs: el reparto por rangos de páginas no cambia el texto y la app nunca crea el pool de procesos."""
+import os
+
+import pytest
+
+import chatbot
+
+pytestmark = pytest.mark.skipif(not chatbot.pypdf, reason="pypdf no instalado")
+
+SMALL_PDF = chatbot.GUIA_TECNICA_FILE # 15 páginas
+
+
+@pytest.fixture
+def empty_pdf_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatbot, "PDF_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(chatbot, "PDF_CACHE_INDEX", str(tmp_path / "index.json"))
+
+
+def test_parallel_extraction_matches_serial():
+    serial = chatbot.extract_pdfs_parallel([SMALL_PDF], workers=1, pages_per_task=4)
+    parallel = chatbot.extract_pdfs_parallel([SMALL_PDF], workers=2, pages_per_task=4)
+    assert len(serial[SMALL_PDF]) == 15
+    assert parallel == serial
+
+
+def test_missing_pdf_is_reported_per_document():
+    extracted = chatbot.extract_pdfs_parallel([SMALL_PDF, "docs/no-existe.pdf"], workers=1)
+    assert isinstance(extracted["docs/no-existe.pdf"], OSError)
+    assert extracted[SMALL_PDF]
+
+
+def test_app_corpus_loads_serially(empty_pdf_cache, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("la app no debe crear el pool de procesos")
+
+    monkeypatch.setattr(chatbot, "CORPUS_DOCUMENTS", {"guia_tecnica": (SMALL_PDF, "GUÍA TÉCNICA PAT")})
+    monkeypatch.setattr(chatbot, "extract_pdfs_parallel", no_pool)
+    monkeypatch.setattr(chatbot.concurrent.futures, "ProcessPoolExecutor", no_pool)
+    chatbot.load_corpus.clear()
+    try:
+        document = chatbot.load_corpus()["guia_tecnica"]
+    finally:
+        chatbot.load_corpus.clear()
+    assert document["error"] is None
+    assert len(document["pages"]) == 15
+    assert os.listdir(chatbot.PDF_CACHE_DIR) # Quedó en la caché para los siguientes arranques
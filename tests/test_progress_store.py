@@ -0,0 +1,107 @@
+"""Avance en el servidor: versión optimista por usuario e importación única de cada archivo subido."""
+import json
+import sqlite3
+
+import pytest
+
+import chatbot
+
+
+@pytest.fixture
+def store(tmp_path):
+    return chatbot.ProgressStore(str(tmp_path / "progress.db"))
+
+
+def turn(messages, text):
+    return messages + [{"role": "user", "content": text}, {"role": "assistant", "content": f"Respuesta a {text}"}]
+
+
+def test_versions_increase_with_each_save(store):
+    first = turn([], "uno")
+    assert store.save("jperez", "UR", {}, "inicio", first, expected_version=0) == 1
+    assert store.save("jperez", "UR", {}, "inicio", turn(first, "dos"), expected_version=1) == 2
+    saved = store.load("jperez")
+    assert saved["version"] == 2
+    assert [m["content"] for m in saved["messages"]] == ["uno", "Respuesta a uno", "dos", "Respuesta a dos"]
+
+
+def test_stale_tab_cannot_overwrite_newer_progress(store):
+    base = turn([], "uno")
+    version = store.save("jperez", "UR", {"problema": "P"}, "inicio", base, expected_version=0)
+    tab_a = tab_b = version # Dos pestañas leyeron la misma versión
+    tab_a = store.save("jperez", "UR", {"problema": "P", "proposito": "A"}, "Componentes_Definicion", turn(base, "pestaña A"), expected_version=tab_a)
+    with pytest.raises(chatbot.StaleProgressError):
+        store.save("jperez", "UR", {"problema": "P"}, "Proposito_Definicion", turn(base, "pestaña B"), expected_version=tab_b)
+    saved = store.load("jperez")
+    assert saved["version"] == tab_a
+    assert saved["pat_data"]["proposito"] == "A"
+    assert [m["content"] for m in saved["messages"]][-2:] == ["pestaña A", "Respuesta a pestaña A"] # Sin intercalar
+
+
+def test_upload_replace_is_also_version_checked(store):
+    store.save("jperez", "UR", {}, "inicio", turn([], "uno"), expected_version=0)
+    with pytest.raises(chatbot.StaleProgressError):
+        store.save("jperez", "UR", {}, "inicio", turn([], "archivo"), replace=True, expected_version=0)
+
+
+def test_databases_without_version_column_are_migrated(tmp_path):
+    path = str(tmp_path / "progress.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE progress (username TEXT PRIMARY KEY, area TEXT, current_phase TEXT, pat_data TEXT,"
+            " message_count INTEGER, updated REAL)"
+        )
+        conn.execute("INSERT INTO progress VALUES ('jperez', 'UR', 'inicio', '{}', 0, 0)")
+    store = chatbot.ProgressStore(path)
+    assert store.load("jperez")["version"] == 1
+    assert store.save("jperez", "UR", {}, "inicio", [], expected_version=1) == 2
+
+
+class FakeUpload:
+    type = "application/json"
+    name = "avance.json"
+
+    def __init__(self, state):
+        self.data = json.dumps(state).encode("utf-8")
+
+    def getvalue(self):
+        return self.data
+
+
+def test_uploaded_progress_is_imported_once_per_content(monkeypatch):
+    upload = FakeUpload({"pat_data": {"problema": "Baja cobertura"}, "messages": [], "current_phase": "Proposito_Definicion"})
+    saves = []
+    monkeypatch.setattr(chatbot.st.sidebar, "file_uploader", lambda *args, **kwargs: upload)
+    monkeypatch.setattr(chatbot.st, "rerun", lambda: None)
+    monkeypatch.setattr(chatbot, "save_pat_progress", lambda user_area, pat_data, replace=False: saves.append(replace))
+    try:
+        for _ in range(3): # El archivo sigue en el uploader en cada recarga
+            chatbot.load_pat_progress("UR")
+        assert saves == [True]
+        upload.data = json.dumps({"pat_data": {}, "messages": [], "current_phase": "inicio"}).encode("utf-8")
+        chatbot.load_pat_progress("UR") # Otro contenido sí se importa
+        assert saves == [True, True]
+    finally:
+        for key in ("imported_progress_hashes", "messages", "current_phase", "pat_data", "drive_status"):
+            chatbot.st.session_state.pop(key, None)
+
+
+def test_restart_keeps_the_user_signed_in(store, monkeypatch):
+    monkeypatch.setattr(chatbot, "get_progress_store", lambda: store)
+    state = chatbot.st.session_state
+    identity = {
+        "authenticated": True, "role": "enlace", "user_name": "Juan", "user_area": "UR", "username": "jperez",
+    }
+    store.save("jperez", "UR", {"problema": "P"}, "Completado", turn([], "uno"), expected_version=0)
+    try:
+        state.update(identity)
+        state.update({"pat_data": {"problema": "P"}, "messages": turn([], "uno"), "current_phase": "Completado",
+                      "imported_progress_hashes": {"abc"}, "progress_version": 1})
+        chatbot.restart_pat_cycle()
+        assert {key: state[key] for key in identity} == identity
+        assert state["imported_progress_hashes"] == {"abc"}
+        for key in ("pat_data", "messages", "current_phase", "progress_version"):
+            assert key not in state
+        assert store.load("jperez") is None
+    finally:
+        state.clear()
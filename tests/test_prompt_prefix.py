@@ -0,0 +1,74 @@
+"""Orden de los mensajes para la caché de prefijos del proveedor: el prefijo compartido debe ser idéntico byte a byte."""
+import os
+
+import requests
+
+import chatbot
+
+CHUNKS = [
+    {"doc_id": "guia", "page": 12, "text": "El Problema Central se redacta como una situación negativa que afecta a la población."},
+    {"doc_id": "gdm", "page": 40, "text": "4.4.8 Cobertura en el servicio de alumbrado público (revisión anual)."},
+    {"doc_id": "guia", "page": 3, "text": "La Matriz de Indicadores para Resultados resume el programa en cuatro niveles."},
+]
+
+AREAS = {
+    "Dirección de Alumbrado Público": "Resumen: mantenimiento de luminarias.\nActividades: 1. Reparación de luminarias.",
+    "Dirección de Desarrollo Social": "Resumen: programas sociales.\nActividades: 1. Entrega de apoyos alimentarios.",
+}
+
+PHASES = {
+    "Diagnostico_Problema": "**FASE ACTUAL: Problema Central.** Valida la redacción del problema propuesto.",
+    "Proposito_Definicion": "**FASE ACTUAL: Propósito.** Propón tres opciones de Propósito a partir del problema.",
+}
+
+MEMORY = "Problema confirmado: Baja cobertura del servicio."
+
+
+def wire_body(messages):
+    """Cuerpo exactamente como lo envía requests (json= del POST a la API)."""
+    payload = {"model": chatbot.LLM_MODEL, "messages": messages, "temperature": 0.3, "max_tokens": chatbot.LLM_MAX_TOKENS}
+    return requests.Request("POST", chatbot.LLM_API_URL, json=payload).prepare().body
+
+
+def wire_prefix(messages):
+    """Bytes del cuerpo hasta el último de estos mensajes inclusive (sin cerrar la lista)."""
+    body = wire_body(messages)
+    return body[:body.rindex(b"]")] # Los campos posteriores a "messages" no contienen corchetes
+
+
+def build(area, phase, chunks=CHUNKS):
+    return chatbot.build_llm_messages(
+        chatbot.SYSTEM_PROMPT, chatbot.format_corpus_chunks(chunks), AREAS[area], PHASES[phase], MEMORY,
+    )
+
+
+def test_persona_and_corpus_prefix_is_identical_across_areas_and_phases():
+    bodies = [wire_body(build(area, phase)) for area in AREAS for phase in PHASES]
+    shared = os.path.commonprefix(bodies)
+    persona_and_corpus = wire_prefix(build(next(iter(AREAS)), next(iter(PHASES)))[:2])
+    assert shared.startswith(persona_and_corpus)
+    for body in bodies:
+        assert body.startswith(persona_and_corpus)
+
+
+def test_same_area_shares_everything_but_the_phase_instructions():
+    for area in AREAS:
+        first, second = (build(area, phase) for phase in PHASES)
+        assert first[:-1] == second[:-1]
+        assert first[-1]["role"] == second[-1]["role"] == "user"
+        prefix = wire_prefix(first[:-1])
+        assert wire_body(first).startswith(prefix) and wire_body(second).startswith(prefix)
+
+
+def test_persona_is_static():
+    for name in AREAS:
+        assert name not in chatbot.SYSTEM_PROMPT
+    messages = build(next(iter(AREAS)), next(iter(PHASES)))
+    assert messages[0] == {"role": "system", "content": chatbot.SYSTEM_PROMPT}
+
+
+def test_corpus_block_does_not_depend_on_retrieval_order():
+    # El ranking puede variar entre consultas; el bloque se ordena por documento y página
+    assert chatbot.format_corpus_chunks(CHUNKS) == chatbot.format_corpus_chunks(list(reversed(CHUNKS)))
+    area, phase = next(iter(AREAS)), next(iter(PHASES))
+    assert wire_body(build(area, phase)) == wire_body(build(area, phase, [CHUNKS[1], CHUNKS[2], CHUNKS[0]]))
@@ -0,0 +1,54 @@
+"""Recuperación del corpus: ranking BM25, fusión RRF y selección con mínimo por documento."""
+import pytest
+
+import chatbot
+
+CHUNKS = [
+    {"doc_id": "reglamento", "page": 10, "article": "Artículo 45", "text": "La Dirección de Alumbrado Público da mantenimiento a las luminarias del municipio."},
+    {"doc_id": "reglamento", "page": 11, "article": "Artículo 46", "text": "La Tesorería Municipal recauda el impuesto predial y administra la hacienda pública."},
+    {"doc_id": "guia", "page": 3, "article": None, "text": "El Problema Central se redacta como una situación negativa que afecta a la población."},
+    {"doc_id": "gdm", "page": 40, "article": None, "text": "Cobertura del alumbrado público: luminarias en funcionamiento entre luminarias instaladas."},
+]
+
+
+def test_bm25_ranks_the_matching_chunk_first():
+    index = chatbot.BM25Index(CHUNKS)
+    ranked = index.rank("recaudación del impuesto predial")
+    assert ranked[0][1] == 1
+    assert all(idx != 2 for _, idx in ranked) # sin términos en común no aparece
+
+
+def test_bm25_prefers_rarer_and_repeated_terms():
+    index = chatbot.BM25Index(CHUNKS)
+    ranked = [idx for _, idx in index.rank("luminarias alumbrado")]
+    assert ranked[:2] == [3, 0] # el GDM repite "luminarias"
+    assert [idx for _, idx in index.rank("luminarias alumbrado", doc_ids={"reglamento"})] == [0]
+
+
+def test_select_chunks_keeps_one_chunk_per_matching_document():
+    index = chatbot.BM25Index(CHUNKS)
+    ranked = index.rank("alumbrado público municipal")
+    docs = [chunk["doc_id"] for _, chunk in chatbot.select_chunks(ranked, CHUNKS, k=2, per_doc_min=1)]
+    assert set(docs) == {"reglamento", "gdm"}
+
+
+def test_rrf_rewards_agreement_between_rankings():
+    lexical = [(9.0, 0), (5.0, 1), (1.0, 2)]
+    semantic = [(0.9, 2), (0.8, 1), (0.1, 3)]
+    fused = chatbot.fuse_rankings([lexical, semantic], rrf_k=60)
+    order = [idx for _, idx in fused]
+    # 1 y 2 aparecen en ambas listas; 0 sólo gana en BM25 y 3 sólo aparece al final de la semántica
+    assert set(order[:2]) == {1, 2}
+    assert order[-1] == 3
+    assert dict((idx, score) for score, idx in fused)[1] == pytest.approx(2 / 62)
+
+
+def test_rrf_ignores_score_scales():
+    fused = chatbot.fuse_rankings([[(1000.0, 0), (999.0, 1)], [(0.2, 1), (0.1, 0)]])
+    assert fused[0][0] == fused[1][0]
+
+
+def test_chunk_document_starts_a_chunk_per_article():
+    pages = ["Artículo 1. Objeto del reglamento.\nTexto del primero.", "Artículo 2. Definiciones.\nTexto del segundo."]
+    chunks = chatbot.chunk_document("reglamento", pages)
+    assert [(chunk["page"], chunk["article"]) for chunk in chunks] == [(1, "Artículo 1"), (2, "Artículo 2")]
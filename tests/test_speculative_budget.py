@@ -0,0 +1,53 @@
+"""El prefetch especulativo revisa su presupuesto de tokens antes de encolar, no cancelando después."""
+import pytest
+
+import chatbot
+
+
+class RecordingExecutor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, session_key, produce, user_key=None, cost_tokens=0):
+        job = chatbot.LLMJob(session_key, user_key, produce, cost_tokens)
+        self.submitted.append(job)
+        return job
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    executor = RecordingExecutor()
+    monkeypatch.setattr(chatbot, "get_llm_executor", lambda: executor)
+    monkeypatch.setattr(chatbot.st, "secrets", {"deepseek_api_key": "test"})
+    state = chatbot.st.session_state
+    state["username"] = "jperez"
+    state["area_context"] = {"atribuciones_resumen": "Resumen de la UR"}
+    yield executor
+    for key in ("username", "area_context", "llm_session_key", "last_context_budget", "speculative_jobs",
+                "offered_options", "current_phase", "pat_data", "messages"):
+        state.pop(key, None)
+
+
+def test_job_over_the_limit_is_never_submitted(executor):
+    assert chatbot.start_llm_job("Persona", "Instrucciones", max_cost_tokens=chatbot.LLM_MAX_TOKENS) is None
+    assert executor.submitted == []
+    job = chatbot.start_llm_job("Persona", "Instrucciones", max_cost_tokens=chatbot.LLM_MAX_TOKENS + 1000)
+    assert executor.submitted == [job]
+
+
+def test_prefetch_only_submits_what_fits_in_the_budget(executor, monkeypatch):
+    monkeypatch.setattr(chatbot, "SPECULATIVE_PREFETCH_ENABLED", True)
+    monkeypatch.setattr(chatbot, "build_phase_request", lambda phase, statement, *args, **kwargs: {
+        'query': f"Valida: {statement}", 'rag_query': statement, 'memory_parts': [],
+    })
+    # Cabe exactamente una solicitud (prompt pequeño + max_tokens), no dos
+    monkeypatch.setattr(chatbot, "SPECULATIVE_TOKEN_BUDGET", chatbot.LLM_MAX_TOKENS + 1000)
+    state = chatbot.st.session_state
+    state["current_phase"], state["pat_data"], state["messages"] = "Proposito_Validacion", chatbot.new_pat_data(), []
+    state["offered_options"] = {"A": "Opción uno", "B": "Opción dos", "C": "Opción tres"}
+
+    chatbot.start_speculative_prefetch("", "UR")
+
+    assert len(executor.submitted) == 1
+    assert not any(job.cancelled.is_set() for job in executor.submitted)
+    assert list(state["speculative_jobs"]["jobs"].values()) == executor.submitted
@@ -0,0 +1,69 @@
+"""Decodificación en vivo del campo 'mensaje' de la salida JSON: escapes partidos entre fragmentos y sustitutos."""
+import json
+
+import pytest
+
+import chatbot
+
+
+def read_in_chunks(raw, cuts):
+    reader = chatbot.JsonStringFieldReader("mensaje")
+    text = "".join(reader.feed(raw[start:end]) for start, end in zip([0] + cuts, cuts + [len(raw)]))
+    return text, reader
+
+
+VALUES = [
+    "Línea 1\nLínea 2\t\"citada\" \\ barra / diagonal",
+    "Emoji 😀 y bandera 🇲🇽 con acentos: ñáéíóú",
+    "Control \b\f\r y unicode escapado ☃",
+]
+
+
+@pytest.mark.parametrize("value", VALUES)
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+def test_every_single_split_point_decodes_exactly(value, ensure_ascii):
+    raw = json.dumps({"mensaje": value, "pregunta": "¿Seguimos?"}, ensure_ascii=ensure_ascii)
+    for cut in range(1, len(raw)):
+        text, reader = read_in_chunks(raw, [cut])
+        assert text == value, cut
+        assert reader.finished
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_one_character_at_a_time(value):
+    raw = json.dumps({"mensaje": value}) # ensure_ascii: emojis como pares \\ud83d\\ude00
+    text, _ = read_in_chunks(raw, list(range(1, len(raw))))
+    assert text == value
+
+
+def test_surrogate_pair_split_between_its_two_escapes():
+    raw = '{"mensaje": "a\\ud83d\\ude00b"}'
+    cut = raw.index("\\ude00")
+    for cuts in ([cut], [cut - 3, cut + 1], [cut + 3]):
+        assert read_in_chunks(raw, cuts)[0] == "a😀b"
+
+
+def test_malformed_unicode_escape_stops_live_decoding():
+    raw = '{"mensaje": "Hola \\uZZZZ mundo", "pregunta": "x"}'
+    text, reader = read_in_chunks(raw, [raw.index("ZZ")])
+    assert text == "Hola "
+    assert reader.finished
+    assert reader.feed(" más") == ""
+
+
+def test_malformed_low_surrogate_escape_stops_live_decoding():
+    text, reader = read_in_chunks('{"mensaje": "a\\ud83d\\uXYZW"}', [])
+    assert text == "a" and reader.finished
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('{"mensaje": "a\\ud83db"}', "a�b"), # Sustituto alto seguido de texto
+    ('{"mensaje": "a\\ud83d\\n"}', "a�\n"), # Seguido de otro escape
+    ('{"mensaje": "a\\ud83d\\u00e9"}', "a�é"), # Seguido de un \\u que no es sustituto bajo
+    ('{"mensaje": "a\\ude00b"}', "a�b"), # Sustituto bajo suelto
+    ('{"mensaje": "a\\ud83d"}', "a�"), # Al cierre de la cadena
+])
+def test_unpaired_surrogates_are_replaced(raw, expected):
+    assert read_in_chunks(raw, [])[0] == expected
+    assert read_in_chunks(raw, list(range(1, len(raw))))[0] == expected
+    assert read_in_chunks(raw, [])[0].encode("utf-8") # Siempre se puede pintar (UTF-8 válido)
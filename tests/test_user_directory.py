@@ -0,0 +1,47 @@
+"""Copia en caché del listado de usuarios: nunca con contraseñas en claro y siempre con permisos 0600."""
+import os
+import stat
+
+import pytest
+
+import chatbot
+
+
+@pytest.fixture
+def users_file(tmp_path, monkeypatch):
+    path = tmp_path / "users.csv"
+    monkeypatch.setattr(chatbot, "find_users_file", lambda: str(path))
+    monkeypatch.setattr(chatbot, "USERS_CACHE_FILE", str(tmp_path / "cache" / "users.json"))
+    return path
+
+
+def write_users(path, password):
+    path.write_text(f"username,password,role,area,nombre\njperez,{password},enlace,Tesorería,Juan\n", encoding="utf-8")
+
+
+def test_hashed_listing_is_cached_private(users_file):
+    write_users(users_file, chatbot.hash_password("secreta"))
+    directory = chatbot.UserDirectory().refresh()
+    assert chatbot.authenticate("JPerez", "secreta", directory)[0] == "enlace"
+    assert stat.S_IMODE(os.stat(chatbot.USERS_CACHE_FILE).st_mode) == 0o600
+
+
+def test_cached_listing_is_served_without_reading_the_file(users_file, monkeypatch):
+    write_users(users_file, chatbot.hash_password("secreta"))
+    chatbot.UserDirectory().refresh()
+    monkeypatch.setattr(chatbot, "load_users", lambda: pytest.fail("debió leerse la copia en caché"))
+    assert chatbot.UserDirectory().refresh().get("jperez")
+
+
+def test_plaintext_passwords_are_never_cached(users_file):
+    write_users(users_file, chatbot.hash_password("secreta"))
+    chatbot.UserDirectory().refresh()
+    assert os.path.exists(chatbot.USERS_CACHE_FILE)
+
+    write_users(users_file, "secreta") # Listado heredado, con la contraseña en claro
+    os.utime(users_file, ns=(0, os.stat(users_file).st_mtime_ns + 10 ** 9))
+    directory = chatbot.UserDirectory().refresh()
+    assert directory.plaintext_passwords == 1
+    assert chatbot.authenticate("jperez", "secreta", directory)[0] == "enlace" # El login sigue funcionando
+    assert not os.path.exists(chatbot.USERS_CACHE_FILE) # Y la copia anterior se retiró
+    assert not [name for name in os.listdir(os.path.dirname(chatbot.USERS_CACHE_FILE)) if name.endswith(".tmp")]